@@ -22,6 +22,19 @@ const int PIN_FREQ_B = 12;
 const unsigned int FREQ_TARGET = 50;
 const unsigned int FREQ_COUNTS = 500;
 
+// Двоичный поток: кадр на каждый период вместо строки с частотой раз в
+// FREQ_COUNTS периодов. Разбирается rrdtool_graph/cycle_stream.py
+// (ingest.py --binary). Кадр 10 байт, little-endian:
+//   A5 5A | номер периода uint16 | micros() в конце периода uint32 | Fletcher-16
+// Контрольная сумма считается по номеру и времени (6 байт), сначала sum1,
+// затем sum2. 500 байт в секунду не помещаются в 9600 бод с запасом,
+// по этому скорость порта выше.
+const boolean STREAM_CYCLES = false;
+const long SERIAL_BAUD = STREAM_CYCLES ? 57600 : 9600;
+const byte FRAME_MAGIC_0 = 0xA5;
+const byte FRAME_MAGIC_1 = 0x5A;
+const unsigned long PERIOD_TARGET = 1000000 / FREQ_TARGET;
+
 inline void wait_for_stable() {
 	// delay(1); // А надо ли?
 }
@@ -43,7 +56,7 @@ void setup() {
 	digitalWrite(PIN_LED_INFO_LOW, LOW);
 
 	// Ожидаем порт
-	Serial.begin(9600);
+	Serial.begin(SERIAL_BAUD);
 	while(!Serial);
 
 	// Ждем пока прибор включат в розетку и ждем еще 250 мс, прежде чем начать.
@@ -58,7 +71,72 @@ void setup() {
 	digitalWrite(PIN_LED_SYS, LOW);
 }
 
+// Состояние I, в начале которого заканчивается период
+int stream_a, stream_b;
+boolean stream_synced = false;
+unsigned int stream_seq = 0;
+
+void send_frame(unsigned int seq, unsigned long time) {
+	byte frame[10];
+	frame[0] = FRAME_MAGIC_0;
+	frame[1] = FRAME_MAGIC_1;
+	frame[2] = seq & 0xFF;
+	frame[3] = seq >> 8;
+	for (int i = 0; i < 4; ++i)
+		frame[4 + i] = (time >> (8 * i)) & 0xFF;
+	unsigned int sum1 = 0, sum2 = 0;
+	for (int i = 2; i < 8; ++i) {
+		sum1 = (sum1 + frame[i]) % 255;
+		sum2 = (sum2 + sum1) % 255;
+	}
+	frame[8] = sum1;
+	frame[9] = sum2;
+	// Буфер передачи больше кадра, write не ждет отправки
+	Serial.write(frame, sizeof(frame));
+}
+
+// Один период за вызов: синхронизация только при первом вызове, дальше
+// каждый период заканчивается там же, где начинается следующий.
+void loop_stream() {
+	static unsigned long last_time;
+	if (!stream_synced) {
+		do {
+			stream_a = digitalRead(PIN_FREQ_A);
+			stream_b = digitalRead(PIN_FREQ_B);
+		} while (stream_a == stream_b);
+		while (digitalRead(PIN_FREQ_A) == stream_a || digitalRead(PIN_FREQ_B) == stream_b);
+		wait_for_stable();
+		stream_a = !stream_a;
+		stream_b = !stream_b;
+		last_time = micros();
+		stream_synced = true;
+	}
+
+	while (digitalRead(PIN_FREQ_A) == stream_a || digitalRead(PIN_FREQ_B) == stream_b);
+	wait_for_stable();
+	while (digitalRead(PIN_FREQ_A) != stream_a || digitalRead(PIN_FREQ_B) != stream_b);
+	wait_for_stable();
+	unsigned long time = micros();
+
+	send_frame(++stream_seq, time);
+
+	// Период короче номинального - частота выше
+	if (time - last_time < PERIOD_TARGET) {
+		digitalWrite(PIN_LED_INFO_HI, LOW);
+		digitalWrite(PIN_LED_INFO_LOW, HIGH);
+	} else {
+		digitalWrite(PIN_LED_INFO_HI, HIGH);
+		digitalWrite(PIN_LED_INFO_LOW, LOW);
+	}
+	last_time = time;
+}
+
 void loop() {
+	if (STREAM_CYCLES) {
+		loop_stream();
+		return;
+	}
+
 	unsigned int switch_counter = FREQ_COUNTS;
 	unsigned long start, elapsed;
 	boolean started = false;
@@ -0,0 +1,41 @@
+#!/bin/sh
+# Устанавливает файлы роутера в каталог КОРЕНЬ: на смонтированный корень
+# роутера или в каталог сборки образа (для копирования по ssh - во временный
+# каталог и затем scp -r). Кроме etc/ и root/ из openwrt_daemon ставит общие
+# с rrdtool_graph модули: в репозитории они есть только в rrdtool_graph.
+# С --check ничего не копирует и завершается с ошибкой, если установленные
+# в КОРЕНЬ модули отличаются от rrdtool_graph (для CI и pre-commit).
+#   ./install.sh /mnt/router
+#   ./install.sh --check /mnt/router
+MODULES="stats_store.py event_index.py cycle_stream.py"
+
+check=0
+if [ "$1" = "--check" ]; then check=1; shift; fi
+if [ $# -ne 1 ]; then
+	echo "Использование: $0 [--check] КОРЕНЬ" >&2
+	exit 2
+fi
+target="$1"
+case "$target" in /*) ;; *) target="$PWD/$target" ;; esac
+cd "$(dirname "$0")" || exit 1
+
+if [ $check -eq 1 ]; then
+	status=0
+	for module in $MODULES; do
+		if ! cmp -s "../rrdtool_graph/$module" "$target/root/freq_report/$module"; then
+			echo "Отличается от rrdtool_graph/$module: $target/root/freq_report/$module" >&2
+			status=1
+		fi
+	done
+	exit $status
+fi
+
+mkdir -p "$target/etc/init.d" "$target/root/freq_report" || exit 1
+cp -p etc/init.d/freq_report "$target/etc/init.d/freq_report" || exit 1
+for file in root/freq_report/*; do
+	[ -f "$file" ] || continue
+	cp -p "$file" "$target/$file" || exit 1
+done
+for module in $MODULES; do
+	cp "../rrdtool_graph/$module" "$target/root/freq_report/$module" || exit 1
+done
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+import sys, os, time, signal, asyncio, argparse, collections, termios, tty
+
+# Замена service.sh: читает частоту из порта Arduino, ставит метку времени
+# в момент получения строки и пачками сбрасывает накопленное в rrdtool update
+# (или в rrdcached через --daemon), вместо пары fork на каждое измерение.
+# С --stats заодно пополняет хранилище статистики (stats_store.py).
+# С --binary читает двоичный поток периодов (cycle_stream.py, нужен numpy):
+# в RRD идут средние по 500 периодов, как в текстовом режиме прошивки, а ряд
+# частоты каждого периода с --highres дописывается в файл.
+# С --events измерения проходят через детектор событий (event_index.py):
+# выходы за полосы, выбросы за границы из статистики и пропуски.
+#
+# stats_store.py, event_index.py и cycle_stream.py - модули rrdtool_graph,
+# рядом с ingest.py их кладет openwrt_daemon/install.sh при установке на
+# роутер. При запуске из репозитория - PYTHONPATH=rrdtool_graph.
+
+DEFAULT_RRD = '/root/freq_report/freq.rrd'
+DEFAULT_PORT = '/dev/ttyUSB0'
+
+BAUDS = {
+	9600: termios.B9600, 19200: termios.B19200, 38400: termios.B38400,
+	57600: termios.B57600, 115200: termios.B115200,
+}
+
+# rrd_lock в rrdtool не ждет: пока filter_rrd.py или выгрузка держат файл,
+# update завершается с этой ошибкой, и пачка повторяется позже
+LOCK_ERROR = 'could not lock'
+
+def log(*args):
+	print(*args, file=sys.stderr, flush=True)
+
+class Ingest(object):
+	def __init__(self, args):
+		super(Ingest, self).__init__()
+		self.args = args
+		self.buffer = collections.deque(maxlen=args.buffer)
+		self.last_time = 0
+		self.dropped = 0
+		self.flush_event = asyncio.Event()
+		self.retry = False # Последний сброс не удался
+		self.stop_event = asyncio.Event()
+		self.stats = None
+		if args.stats is not None:
+			import stats_store
+			self.stats = stats_store.StatsStore(args.stats)
+		self.events = None
+		self.bounds_time = None
+		if args.events is not None:
+			import event_index
+			self.event_index = event_index
+			self.events = event_index.Detector(event_index.EventIndex(args.events, writable=True))
+		self.cycle_stream = None
+		self.decoder = None
+		self.highres = list() # Ряды высокого разрешения до следующего сброса
+		self.reported = (0, 0, 0)
+		if args.binary:
+			import cycle_stream
+			self.cycle_stream = cycle_stream
+
+	def open_port(self):
+		fd = os.open(self.args.port, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+		# Двоичный поток портится построчной обработкой терминала
+		if (self.args.baud is not None or self.args.binary) and os.isatty(fd):
+			tty.setraw(fd)
+		if self.args.baud is not None and os.isatty(fd):
+			attrs = termios.tcgetattr(fd)
+			attrs[4] = attrs[5] = BAUDS[self.args.baud]
+			termios.tcsetattr(fd, termios.TCSANOW, attrs)
+		return os.fdopen(fd, 'rb', buffering=0)
+
+	def add_sample(self, line):
+		now = int(time.time())
+		try:
+			value = float(line)
+		except ValueError:
+			log('Не число: {!r}'.format(line))
+			return
+		self.add_value(now, value, line)
+
+	def add_frames(self, data):
+		highres, averages = self.decoder.feed(data, time.time())
+		if len(highres) > 0 and self.args.highres is not None: self.highres.append(highres)
+		# События - по каждому периоду, с точностью до долей секунды
+		if self.events is not None:
+			for timestamp, value in zip(highres['time'].tolist(), highres['freq'].tolist()):
+				self.events.add(timestamp, value)
+		for timestamp, value in averages:
+			# Как Serial.println(freq, 6) в прошивке
+			self.add_value(int(timestamp), value, '{:.6f}'.format(value))
+
+	def add_value(self, now, value, line):
+		# rrdtool не принимает два обновления в одну секунду
+		if now <= self.last_time:
+			log('Пропуск {!r}: время {} не больше предыдущего {}'.format(line, now, self.last_time))
+			return
+		self.last_time = now
+		if len(self.buffer) == self.buffer.maxlen:
+			self.dropped += 1
+		self.buffer.append('{}:{}'.format(now, line))
+		if self.stats is not None: self.stats.add(now, value)
+		if self.events is not None and self.decoder is None: self.events.add(now, value)
+		if len(self.buffer) >= self.args.batch:
+			self.flush_event.set()
+
+	async def read_port(self):
+		loop = asyncio.get_running_loop()
+		while not self.stop_event.is_set():
+			try:
+				port = self.open_port()
+			except OSError as e:
+				log('Порт {} недоступен: {}'.format(self.args.port, e))
+			else:
+				log('Порт {} открыт'.format(self.args.port))
+				reader = asyncio.StreamReader()
+				transport, protocol = await loop.connect_read_pipe(
+					lambda: asyncio.StreamReaderProtocol(reader), port)
+				try:
+					if self.cycle_stream is not None:
+						# Новое подключение - новая синхронизация с потоком
+						self.decoder = self.cycle_stream.Decoder()
+						self.reported = (0, 0, 0)
+						while True:
+							data = await reader.read(4096)
+							if len(data) == 0: break
+							self.add_frames(data)
+					else:
+						while True:
+							line = await reader.readline()
+							if len(line) == 0: break
+							line = line.decode('ascii', errors='replace').strip()
+							if len(line) > 0: self.add_sample(line)
+				except (OSError, ValueError) as e:
+					log('Ошибка чтения {}: {}'.format(self.args.port, e))
+				finally:
+					transport.close()
+				log('Порт {} закрыт'.format(self.args.port))
+			# Как и в service.sh: ждем и пробуем снова
+			try:
+				await asyncio.wait_for(self.stop_event.wait(), self.args.reconnect)
+			except asyncio.TimeoutError:
+				pass
+
+	# rrdtool update; код возврата (None, если rrdtool не запустился) и stderr
+	async def update(self, values):
+		cmdline = [ self.args.rrdtool, 'update' ]
+		if self.args.daemon is not None: cmdline += [ '--daemon', self.args.daemon ]
+		cmdline += [ self.args.rrd ] + values
+		try:
+			process = await asyncio.create_subprocess_exec(*cmdline,
+				stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+			stdout, stderr = await process.communicate()
+		except OSError as e:
+			return None, str(e)
+		return process.returncode, stderr.decode('utf-8', errors='replace').strip()
+
+	# Вернуть неотправленные значения в начало очереди. Они старше всего в
+	# очереди; если места нет, отбрасываются самые старые, как при переполнении.
+	def requeue(self, values):
+		room = self.buffer.maxlen - len(self.buffer)
+		if room < len(values):
+			self.dropped += len(values) - room
+			values = values[len(values) - room:]
+		self.buffer.extendleft(reversed(values))
+
+	# Пачка целиком или, после ошибки, по одному значению: update с несколькими
+	# значениями останавливается на первом отвергнутом, а остальные теряет.
+	# Возвращает False, если отправку надо отложить до следующего сброса.
+	async def send(self, batch):
+		status, error = await self.update(batch)
+		log('{} - {} значений, {} .. {}'.format(status, len(batch), batch[0], batch[-1]))
+		if status == 0: return True
+		log('Ошибка rrdtool update: {}'.format(error))
+		if status is None or LOCK_ERROR in error:
+			self.requeue(batch)
+			return False
+		for i, value in enumerate(batch):
+			status, error = await self.update([ value ])
+			if status == 0: continue
+			if status is None or LOCK_ERROR in error:
+				self.requeue(batch[i:])
+				return False
+			# Уже записанное до ошибки тоже отвергается: время не больше последнего
+			log('Значение {} отвергнуто: {}'.format(value, error))
+		return True
+
+	async def flush(self):
+		while len(self.buffer) > 0:
+			batch = [ self.buffer.popleft() for i in range(min(self.args.batch, len(self.buffer))) ]
+			if not await self.send(batch):
+				# Повтор раньше следующего сброса: блокировка обычно недолгая
+				self.retry = True
+				break
+		if self.stats is not None:
+			try:
+				self.stats.flush()
+				self.stats.forget(self.last_time)
+			except OSError as e:
+				log('Ошибка записи статистики: {}'.format(e))
+		if self.dropped > 0:
+			log('Буфер переполнен, потеряно значений: {}'.format(self.dropped))
+			self.dropped = 0
+		if len(self.highres) > 0:
+			highres, self.highres = self.highres, list()
+			try:
+				with open(self.args.highres, 'ab') as f:
+					for part in highres: f.write(part.tobytes())
+			except OSError as e:
+				log('Ошибка записи {}: {}'.format(self.args.highres, e))
+		if self.events is not None:
+			try:
+				self.update_bounds()
+				events = [ event for event in self.events.flush() if not event.provisional ]
+				if len(events) > 0: log('Событий: {}'.format(len(events)))
+			except OSError as e:
+				log('Ошибка записи событий: {}'.format(e))
+		if self.decoder is not None:
+			counters = (self.decoder.dropped, self.decoder.skipped, self.decoder.resets)
+			if counters != self.reported:
+				log('Поток периодов: {}'.format(self.decoder.summary()))
+				self.reported = counters
+
+	# Границы выбросов - процентили статистики за последние сутки, раз в час
+	def update_bounds(self):
+		if self.stats is None or self.last_time == 0: return
+		if self.bounds_time is not None and self.last_time - self.bounds_time < 3600: return
+		bucket = self.stats.query(self.last_time - 86400, self.last_time + 1)
+		error = self.event_index.DEFAULT_ERROR
+		self.events.set_bounds(bucket.percentile(error), bucket.percentile(100 - error))
+		self.bounds_time = self.last_time
+
+	async def flush_loop(self):
+		while not self.stop_event.is_set():
+			interval = min(self.args.retry_interval, self.args.flush_interval) if self.retry else self.args.flush_interval
+			self.retry = False
+			try:
+				await asyncio.wait_for(self.flush_event.wait(), interval)
+			except asyncio.TimeoutError:
+				pass
+			self.flush_event.clear()
+			try:
+				await self.flush()
+			except OSError as e:
+				log('Ошибка сброса: {}'.format(e))
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		for signum in (signal.SIGTERM, signal.SIGINT):
+			loop.add_signal_handler(signum, self.stop)
+		reader = asyncio.ensure_future(self.read_port())
+		flusher = asyncio.ensure_future(self.flush_loop())
+		await self.stop_event.wait()
+		reader.cancel()
+		flusher.cancel()
+		await asyncio.gather(reader, flusher, return_exceptions=True)
+		# Накопленное не теряется при остановке сервиса
+		await self.flush()
+		if self.events is not None: self.events.finish()
+
+	def stop(self):
+		log('Остановка')
+		self.stop_event.set()
+		self.flush_event.set()
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	args.add_argument('rrd', type=str, nargs='?', default=DEFAULT_RRD,
+		help='Путь к RRD-файлу, по умолчанию = {}'.format(DEFAULT_RRD))
+	args.add_argument('--port', dest='port', type=str, default=DEFAULT_PORT,
+		help='Порт Arduino, по умолчанию = {}'.format(DEFAULT_PORT))
+	args.add_argument('--baud', dest='baud', type=int, choices=sorted(BAUDS.keys()), default=None,
+		help='Настроить скорость порта, по умолчанию настройки порта не меняются')
+	args.add_argument('--flush-interval', dest='flush_interval', type=float, default=60,
+		help='Как часто сбрасывать значения в RRD, в секундах, по умолчанию = 60')
+	args.add_argument('--retry-interval', dest='retry_interval', type=float, default=5,
+		help='Пауза перед повтором неудачного сброса (например, RRD заблокирован filter_rrd.py), '
+			'в секундах, по умолчанию = 5')
+	args.add_argument('--batch', dest='batch', type=int, default=360,
+		help='Наибольшее число значений в одном rrdtool update, по умолчанию = 360')
+	args.add_argument('--buffer', dest='buffer', type=int, default=8640,
+		help='Наибольшее число значений в памяти, старые отбрасываются, по умолчанию = 8640')
+	args.add_argument('--reconnect', dest='reconnect', type=float, default=10,
+		help='Пауза перед повторным открытием порта, в секундах, по умолчанию = 10')
+	args.add_argument('--daemon', dest='daemon', type=str, default=None,
+		help='Адрес rrdcached, передается в rrdtool update --daemon')
+	args.add_argument('--stats', dest='stats', type=str, default=None,
+		help='Каталог статистики для stats_store.py, обычно <rrd>.stats, по умолчанию не ведется')
+	args.add_argument('--events', dest='events', type=str, default=None,
+		help='Индекс событий для event_index.py, обычно <rrd>.events, по умолчанию не ведется; '
+			'выбросы ищутся только вместе с --stats')
+	args.add_argument('--binary', dest='binary', action='store_true',
+		help='Двоичный поток периодов от прошивки с STREAM_CYCLES = true, нужен numpy')
+	args.add_argument('--highres', dest='highres', type=str, default=None,
+		help='С --binary: дописывать в этот файл частоту каждого периода (cycle_stream.HIGHRES), по умолчанию не пишется')
+	args.add_argument('--rrdtool', dest='rrdtool', type=str, default='rrdtool',
+		help='Путь к rrdtool, по умолчанию = rrdtool')
+
+	args = args.parse_args()
+	asyncio.run(Ingest(args).run())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+from lib import *
+import numpy
+
+# Статистика графиков без рендера: операторы RPN и VDEF из rrdtool на numpy,
+# с той же семантикой NaN, что и в rrd_rpn.c / vdef_calc из rrd_graph.c.
+# Имена результатов совпадают с именами VDEF в normal_graph.py, diff_graph.py
+# и spread_graph.py.
+
+def _c_round(value):
+	return int(math.floor(value + 0.5))
+
+# --- CDEF ---
+
+def limit(a, mn, mx):
+	if mn is None or mx is None or math.isnan(mn) or math.isnan(mx): return numpy.full(a.shape, numpy.nan)
+	with numpy.errstate(invalid='ignore'):
+		return numpy.where((a >= mn) & (a <= mx), a, numpy.nan)
+
+def prev(a):
+	return numpy.concatenate(([ numpy.nan ], a[:-1]))
+
+# TREND/TRENDNAN: среднее за окно в dur секунд, заканчивающееся на текущей строке.
+# Пока истории меньше окна - NaN. TREND дает NaN, если в окне есть NaN, TRENDNAN их пропускает.
+# Для двумерных массивов считается по последней оси.
+def trend(a, dur, step, nan=True):
+	rows = max(int(math.ceil(dur / step)), 1)
+	out = numpy.full(a.shape, numpy.nan)
+	if rows > a.shape[-1]: return out
+	valid = ~numpy.isnan(a)
+	zeros = numpy.zeros(a.shape[:-1] + (1, ))
+	sums = numpy.concatenate((zeros, numpy.cumsum(numpy.where(valid, a, 0.0), axis=-1)), axis=-1)
+	counts = numpy.concatenate((zeros, numpy.cumsum(valid, axis=-1)), axis=-1)
+	window_sums = sums[..., rows:] - sums[..., :-rows]
+	window_counts = counts[..., rows:] - counts[..., :-rows]
+	ok = (window_counts > 0) if nan else (window_counts == rows)
+	out[..., rows - 1:] = numpy.divide(window_sums, window_counts, out=numpy.full(window_sums.shape, numpy.nan), where=ok)
+	return out
+
+# SHIFT:vname:offset - сдвиг данных во времени на offset секунд, по последней оси
+def shift(a, offset, step):
+	length = a.shape[-1]
+	rows = max(min(int(offset / step), length), -length)
+	out = numpy.full(a.shape, numpy.nan)
+	if rows >= 0: out[..., rows:] = a[..., :length - rows]
+	else: out[..., :rows] = a[..., -rows:]
+	return out
+
+# --- VDEF, None вместо NaN ---
+
+def _none(value):
+	value = float(value)
+	return None if math.isnan(value) else value
+
+def percentnan(a, percent):
+	values = numpy.sort(a[~numpy.isnan(a)])
+	if len(values) == 0: return None
+	return _none(values[_c_round(percent * (len(values) - 1) / 100.0)])
+
+def minimum(a):
+	values = a[numpy.isfinite(a)]
+	return _none(values.min()) if len(values) > 0 else None
+
+def maximum(a):
+	values = a[numpy.isfinite(a)]
+	return _none(values.max()) if len(values) > 0 else None
+
+def average(a):
+	values = a[numpy.isfinite(a)]
+	return _none(values.mean()) if len(values) > 0 else None
+
+def stdev(a):
+	values = a[numpy.isfinite(a)]
+	if len(values) == 0: return None
+	mean = values.sum() / len(values)
+	return _none(math.sqrt(max((values * values).sum() / len(values) - mean * mean, 0.0)))
+
+def last(a):
+	values = a[numpy.isfinite(a)]
+	return _none(values[-1]) if len(values) > 0 else None
+
+# --- Статистика графиков ---
+
+def normal_stats(r_min, r_max, r_avg, error):
+	g_min = percentnan(r_min, error)
+	g_max = percentnan(r_max, 100 - error)
+	f_avg = limit(r_avg, g_min, g_max)
+	return dict(g_min=g_min, g_max=g_max, g_avg=average(f_avg), g_last=last(f_avg), g_stdev=stdev(f_avg))
+
+def diff_stats(r_min, r_max, error, step):
+	g_min = percentnan(r_min, error)
+	g_max = percentnan(r_max, 100 - error)
+	f_min = limit(r_min, g_min, g_max)
+	f_max = limit(r_max, g_min, g_max)
+	f_diff_min = (f_min - prev(f_max)) / step
+	f_diff_max = (f_max - prev(f_min)) / step
+	return dict(
+		g_diff_min=minimum(f_diff_min), g_diff_max=maximum(f_diff_max),
+		g_last_min=last(f_diff_min), g_last_max=last(f_diff_max),
+		# Как в diff_graph.py: g_last_avg берется из f_diff_max
+		g_last_avg=last(f_diff_max),
+	)
+
+def spread_stats(r_min, r_max, error):
+	g_min = percentnan(r_min, error)
+	g_max = percentnan(r_max, 100 - error)
+	r_diff = limit(r_max, g_min, g_max) - limit(r_min, g_min, g_max)
+	return dict(g_diff_min=minimum(r_diff), g_diff_max=maximum(r_diff), g_last=last(r_diff))
+
+GRAPH_STATS = ('normal', 'diff', 'spread')
+
+SERIES = (('r_min', 'MIN'), ('r_max', 'MAX'), ('r_avg', 'AVERAGE'))
+
+# Шаги, которые план рендера (plan_cmdline) закрепит за r_min, r_max и r_avg
+# графика normal на этом окне: функция -> шаг
+def plan_steps(arg_rrd, arg_start, arg_end):
+	defs = [ 'DEF:{}={}:freq:{}'.format(name, arg_rrd, cf) for name, cf in SERIES ]
+	steps = planned_steps(plan_cmdline(defs, detect_window(arg_rrd, arg_start, arg_end))[0])
+	return { cf: steps.get((arg_rrd, 'freq', cf)) for name, cf in SERIES }
+
+# Ряды r_min, r_max, r_avg. step - шаг, закрепленный планом рендера, один на
+# все ряды или по функциям (plan_steps): строки читаются с ним и без укрупнения
+# до 960. Без step - как у графика шириной 960 точек, когда rrdtool сам
+# выбирает RRA (--no-plan). При разных шагах xport отдает ряды с наименьшим.
+def fetch_xport(arg_rrd, arg_start, arg_end, step=None):
+	steps = step if isinstance(step, dict) else { cf: step for name, cf in SERIES }
+	pinned = [ int(value) for value in steps.values() if value is not None ]
+	maxrows = 960
+	if len(pinned) > 0:
+		start, end = detect_window(arg_rrd, arg_start, arg_end)
+		maxrows = max(count_rows(start, end, min(pinned)) + 1, maxrows)
+	start, step, series = xport_full([
+		'rrdtool', 'xport', '--maxrows', str(maxrows), '--start', arg_start, '--end', arg_end,
+	] + [
+		'DEF:{}={}:freq:{}{}'.format(name, arg_rrd, cf, '' if steps[cf] is None else ':step={}'.format(steps[cf]))
+		for name, cf in SERIES
+	] + [ 'XPORT:{0}:{0}'.format(name) for name, cf in SERIES ])
+	series = { name: numpy.asarray(values, dtype=numpy.float64) for name, values in series.items() }
+	return start, step, series
+
+# То же прямо из файла: RRA с шагом плана или, без него, как выбрал бы rrdtool
+def fetch_native(arg_rrd, arg_start, arg_end, step=None):
+	from rrd_file import RRDFile
+	start, end = detect_window(arg_rrd, arg_start, arg_end)
+	steps = step if isinstance(step, dict) else { cf: step for name, cf in SERIES }
+	series = dict()
+	with RRDFile(arg_rrd) as rrd:
+		for name, cf in SERIES:
+			same = [ rra for rra in rrd.rra if rra.cf == cf and steps[cf] is not None and rra.step == int(steps[cf]) ]
+			if len(same) > 0:
+				fetch_start, fetch_step, values = rrd.fetch_rra(same[0], start, end)
+			else:
+				fetch_start, fetch_step, values = rrd.fetch(cf, start, end, max((end - start) // 960, 1))
+			series[name] = values.copy()
+	return fetch_start, fetch_step, series
+
+def compute(start, step, series, error):
+	r_min, r_max, r_avg = series['r_min'], series['r_max'], series['r_avg']
+	return dict(
+		start=start, end=start + step * len(r_avg), step=step, rows=len(r_avg),
+		normal=normal_stats(r_min, r_max, r_avg, error),
+		diff=diff_stats(r_min, r_max, error, step),
+		spread=spread_stats(r_min, r_max, error),
+	)
+
+# Те же значения, посчитанные rrdtool: команды рендера графиков (с планом
+# и оптимизацией, как mk_production_cmdline) с PRINT каждого VDEF
+def compute_rrdtool(arg_rrd, arg_start, arg_end, error, stats):
+	from normal_graph import NormalGraph
+	from diff_graph import DiffGraph
+	from spread_graph import SpreadGraph
+	graphs = dict(normal=NormalGraph, diff=DiffGraph, spread=SpreadGraph)
+	result = dict()
+	for name in GRAPH_STATS:
+		graph = graphs[name]()
+		graph.setup([ arg_rrd, os.devnull, '--start', arg_start, '--end', arg_end, '--error', str(error) ])
+		impl_cmdline = unpack_list(graph.mk_cmdline()) + [ 'PRINT:{0}:{0}=%le'.format(vname) for vname in stats[name] ]
+		production_cmdline = graph.mk_production_cmdline(impl_cmdline)
+		prints = parse_prints(rrd_backend().graph(production_cmdline[2:])['prints'])
+		result[name] = { vname: None if math.isnan(value) else value for vname, value in prints.items() if vname in stats[name] }
+	return result
+
+def compare(ours, theirs, tolerance):
+	mismatches = list()
+	for name in GRAPH_STATS:
+		for vname, value in ours[name].items():
+			other = theirs[name].get(vname)
+			if value is None or other is None:
+				if value is not other: mismatches.append((name, vname, value, other))
+			elif not math.isclose(value, other, rel_tol=tolerance, abs_tol=tolerance):
+				mismatches.append((name, vname, value, other))
+	return mismatches
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	args.add_argument('rrd', type=argtype_file,
+		help='Путь к RRD-файлу.')
+	args.add_argument('--start', dest='start', type=str, default='end-24h',
+		help='Аналогичен --start из rrdtool, по умолчанию = end-24h')
+	args.add_argument('--end', dest='end', type=str, default='now',
+		help='Аналогичен --end из rrdtool, по умолчанию = now')
+	args.add_argument('--error', dest='error', type=float, default=0.5,
+		help='Какой объем в %% минимальных и максимальных данных считать ошибочными, по умолчанию = 0.5')
+	args.add_argument('--source', dest='source', choices=('xport', 'native'), default='xport',
+		help='Откуда брать ряды: xport - через rrdtool, native - прямо из файла, по умолчанию = xport')
+	args.add_argument('--check', dest='check', action='store_true',
+		help='Сверить результат со значениями, которые печатает rrdtool graph.')
+	args.add_argument('--tolerance', dest='tolerance', type=float, default=1e-6,
+		help='Допустимое расхождение при --check, по умолчанию = 1e-6')
+	args = args.parse_args()
+
+	fetch = fetch_native if args.source == 'native' else fetch_xport
+	# Те же строки, что прочитает рендер графика normal
+	start, step, series = fetch(args.rrd, args.start, args.end, plan_steps(args.rrd, args.start, args.end))
+	result = compute(start, step, series, args.error)
+
+	if args.check:
+		theirs = compute_rrdtool(args.rrd, args.start, args.end, args.error,
+			{ name: list(result[name].keys()) for name in GRAPH_STATS })
+		mismatches = compare(result, theirs, args.tolerance)
+		result['check'] = dict(
+			rrdtool=theirs,
+			mismatches=[ dict(graph=name, vname=vname, ours=value, rrdtool=other) for name, vname, value, other in mismatches ],
+		)
+
+	json.dump(result, sys.stdout, indent='\t')
+	print()
+	if args.check and len(result['check']['mismatches']) > 0: sys.exit(1)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import re, time
+
+# Разбор времени в формате AT, как в rrd_parsetime из librrd, без запуска rrdtool.
+# Поддерживается подмножество: now, start, end, время эпохи и смещения вида
+# -24h, +7d, -1mon-2h. Всё остальное (noon, yesterday, даты) - None,
+# тогда интервал определяется через rrdtool.
+
+ABSOLUTE = 'absolute'
+RELATIVE_TO_START = 'start'
+RELATIVE_TO_END = 'end'
+
+SECONDS, MINUTES, HOURS, DAYS, WEEKS, MONTHS, YEARS, MONTHS_MINUTES = range(8)
+
+MULTIPLIERS = {
+	'second': SECONDS, 'seconds': SECONDS, 'sec': SECONDS, 's': SECONDS,
+	'minute': MINUTES, 'minutes': MINUTES, 'min': MINUTES, 'm': MONTHS_MINUTES,
+	'hour': HOURS, 'hours': HOURS, 'hr': HOURS, 'h': HOURS,
+	'day': DAYS, 'days': DAYS, 'd': DAYS,
+	'week': WEEKS, 'weeks': WEEKS, 'wk': WEEKS, 'w': WEEKS,
+	'month': MONTHS, 'months': MONTHS, 'mon': MONTHS,
+	'year': YEARS, 'years': YEARS, 'yr': YEARS, 'y': YEARS,
+}
+
+BASE_RE = re.compile(r'(now|start|end|[0-9]{9,})?')
+DELTA_RE = re.compile(r'([+-])([0-9]+)([a-z]*)')
+
+class AtTime(object):
+	def __init__(self, kind, tm, offset):
+		super(AtTime, self).__init__()
+		self.kind = kind
+		# Для ABSOLUTE - [год, месяц, день, час, минута, секунда] местного времени,
+		# для относительных - только смещения [годы, месяцы, дни].
+		self.tm = tm
+		self.offset = offset # Смещение в секундах
+
+	def __repr__(self):
+		return 'AtTime({!r}, {!r}, {!r})'.format(self.kind, self.tm, self.offset)
+
+def _mktime(year, month, day, hour, minute, second):
+	# Как mktime из C: выход дня или месяца за пределы переносится
+	year += (month - 1) // 12
+	month = (month - 1) % 12 + 1
+	return int(time.mktime((year, month, day, hour, minute, second, 0, 0, -1)))
+
+def _localtm(timestamp):
+	tm = time.localtime(timestamp)
+	return [ tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec ]
+
+def parse(spec, now=None):
+	if now is None: now = int(time.time())
+	spec = re.sub(r'\s+', '', spec.lower())
+
+	base = BASE_RE.match(spec)
+	word, pos = base.group(1), base.end()
+	if word in ('start', 'end'):
+		at = AtTime(RELATIVE_TO_START if word == 'start' else RELATIVE_TO_END, [ 0, 0, 0 ], 0)
+	elif word is None or word == 'now':
+		if word is None and pos == len(spec): return None
+		at = AtTime(ABSOLUTE, _localtm(now), 0)
+	else:
+		at = AtTime(ABSOLUTE, _localtm(int(word)), 0)
+
+	prev_multiplier = None
+	while pos < len(spec):
+		delta = DELTA_RE.match(spec, pos)
+		if delta is None: return None
+		pos = delta.end()
+		sign = -1 if delta.group(1) == '-' else 1
+		value = int(delta.group(2))
+		# Число без единиц - секунды, как end-86400
+		multiplier = MULTIPLIERS.get(delta.group(3)) if delta.group(3) else SECONDS
+		if multiplier is None: return None
+
+		if multiplier == MONTHS_MINUTES:
+			if prev_multiplier in (DAYS, WEEKS, MONTHS, YEARS): multiplier = MONTHS
+			elif prev_multiplier in (SECONDS, MINUTES, HOURS): multiplier = MINUTES
+			elif value < 6: multiplier = MONTHS
+			else: multiplier = MINUTES
+		prev_multiplier = multiplier
+
+		# Годы, месяцы и дни двигают календарную дату, остальное - секунды
+		value *= sign
+		if multiplier == YEARS: at.tm[0] += value
+		elif multiplier == MONTHS: at.tm[1] += value
+		elif multiplier == WEEKS: at.tm[2] += value * 7
+		elif multiplier == DAYS: at.tm[2] += value
+		elif multiplier == HOURS: at.offset += value * 60 * 60
+		elif multiplier == MINUTES: at.offset += value * 60
+		else: at.offset += value
+
+	return at
+
+def _apply(base, relative):
+	tm = _localtm(base)
+	tm[0] += relative.tm[0]
+	tm[1] += relative.tm[1]
+	tm[2] += relative.tm[2]
+	return _mktime(*tm) + relative.offset
+
+# Аналог rrd_proc_start_end: (start, end) в секундах эпохи или None
+def resolve_window(start_spec, end_spec, now=None):
+	if now is None: now = int(time.time())
+	start_at, end_at = parse(start_spec, now), parse(end_spec, now)
+	if start_at is None or end_at is None: return None
+
+	if start_at.kind == RELATIVE_TO_START or end_at.kind == RELATIVE_TO_END: return None
+	if start_at.kind == RELATIVE_TO_END and end_at.kind == RELATIVE_TO_START: return None
+
+	if start_at.kind == RELATIVE_TO_END:
+		end = _mktime(*end_at.tm) + end_at.offset
+		start = _apply(end, start_at)
+	else:
+		start = _mktime(*start_at.tm) + start_at.offset
+		if end_at.kind == RELATIVE_TO_START: end = _apply(start, end_at)
+		else: end = _mktime(*end_at.tm) + end_at.offset
+
+	return start, end
+
+if __name__ == '__main__':
+	import argparse
+	args = argparse.ArgumentParser()
+	args.add_argument('start', type=str)
+	args.add_argument('end', type=str, nargs='?', default='now')
+	args = args.parse_args()
+	print(resolve_window(args.start, args.end))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+from lib import *
+from normal_graph import NormalGraph
+from diff_graph import DiffGraph
+from spread_graph import SpreadGraph
+from overlap_graph import OverlapGraph
+
+# Пакетный рендер: все графики из манифеста в одном процессе.
+#
+# Манифест - текстовый файл, одна задача на строку:
+#   <тип графика> <путь к изображению> [опции графика...]
+# например:
+#   normal  /www/freq/normal_24h.png  --start end-24h
+#   diff    /www/freq/diff_7d.png     --start end-7d
+#   overlap /www/freq/overlap_7d.png  --width 86400 --depth 7
+# Пустые строки и #комментарии пропускаются, опции разбираются как в shell.
+#
+# Длины периодов и выгрузки для определения пределов одинаковы для графиков
+# разного типа с тем же интервалом, по этому они выполняются один раз на весь пакет.
+
+GRAPHS = {
+	'normal': NormalGraph,
+	'diff': DiffGraph,
+	'spread': SpreadGraph,
+	'overlap': OverlapGraph,
+}
+
+# Задачи манифеста: (тип графика, изображение, опции)
+def parse_manifest(manifest):
+	import shlex
+	specs = list()
+	for line_n, line in enumerate(manifest, start=1):
+		parts = shlex.split(line, comments=True)
+		if len(parts) == 0: continue
+		if len(parts) < 2 or parts[0] not in GRAPHS:
+			raise Exception('Строка {}: ожидается \'<{}> <изображение> [опции]\', получено {!r}.'.format(
+				line_n, '|'.join(GRAPHS.keys()), line.strip()))
+		specs.append((parts[0], parts[1], parts[2:]))
+	return specs
+
+def mk_graph(spec, arg_rrd):
+	name, image, options = spec
+	graph = GRAPHS[name]()
+	graph.setup([ arg_rrd, image ] + options)
+	return graph
+
+def read_manifest(manifest, arg_rrd):
+	return [ mk_graph(spec, arg_rrd) for spec in parse_manifest(manifest) ]
+
+def run_job(graph):
+	if graph.arg_cmd:
+		return graph.mk_production_cmdline()
+	return graph.produce()
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	args.add_argument('rrd', type=argtype_file,
+		help='Путь к RRD-файлу.')
+	args.add_argument('manifest', type=argparse.FileType('r'),
+		help='Путь к манифесту задач.')
+	args.add_argument('--jobs', dest='jobs', type=int, default=os.cpu_count() or 1,
+		help='Число одновременных рендеров, по умолчанию = число CPU')
+	args.add_argument('--backend', dest='backend', choices=BACKENDS, default=None,
+		help='Как вызывать rrdtool (см. --backend графиков); auto для нескольких --jobs - pipe, '
+			'по умолчанию = $RRDTOOL_BACKEND или auto')
+	args = args.parse_args()
+
+	backend = select_threaded_backend(args.backend, max(args.jobs, 1))
+
+	jobs = read_manifest(args.manifest, args.rrd)
+	print('Задач в пакете: {}, потоков: {}, rrdtool: {}'.format(len(jobs), args.jobs, backend.name), file=sys.stderr)
+
+	cache = CallCache()
+	for graph in jobs: graph.shared_cache = cache
+
+	failed = 0
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+		futures = { executor.submit(run_job, graph): graph for graph in jobs }
+		for future in concurrent.futures.as_completed(futures):
+			graph = futures[future]
+			try:
+				status = future.result()
+			except Exception as e:
+				failed += 1
+				print('{}: ошибка: {!r}'.format(graph.arg_image, e), file=sys.stderr)
+				continue
+			if isinstance(status, subprocess.CompletedProcess):
+				if status.returncode != 0: failed += 1
+				print('{}: код {}'.format(graph.arg_image, status.returncode), file=sys.stderr)
+			else:
+				print('{}: {!r}'.format(graph.arg_image, status), file=sys.stderr)
+
+	print('Готово, ошибок: {}'.format(failed), file=sys.stderr)
+	sys.exit(1 if failed > 0 else 0)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+from lib import *
+import platform, resource, statistics, tempfile, contextlib
+import synth_rrd
+from filter_xml import IntervalIndex, filter_stream
+from normal_graph import NormalGraph
+from diff_graph import DiffGraph
+from spread_graph import SpreadGraph
+from overlap_graph import OverlapGraph
+
+# Замеры конвейера графиков на синтетическом RRD (synth_rrd.py):
+#   generate      - создание RRD
+#   graph         - produce() каждого графика для окон от суток до всей истории
+#   detect_length - длина периода: graphv против разбора времени в Python
+#   detect_limits - пределы: пробный рендер против xport
+#   filter_xml    - пропускная способность filter_stream на rrdtool dump
+#   overlap       - OverlapGraph в зависимости от глубины, оба движка
+# Результат - JSON, --compare сравнивает медианы с прошлым прогоном.
+
+WINDOWS = ('1d', '7d', '31d', '1y', '10y')
+DEPTHS = (2, 4, 8, 16, 32)
+GRAPHS = { 'normal': NormalGraph, 'diff': DiffGraph, 'spread': SpreadGraph }
+
+def children_cpu():
+	usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return usage.ru_utime + usage.ru_stime
+
+def measure(function, repeat):
+	runs = list()
+	result = None
+	for i in range(repeat):
+		wall, cpu, children = time.perf_counter(), time.process_time(), children_cpu()
+		result = function()
+		runs.append(dict(
+			wall=time.perf_counter() - wall,
+			cpu=time.process_time() - cpu,
+			children_cpu=children_cpu() - children,
+		))
+	walls = [ run['wall'] for run in runs ]
+	return dict(
+		runs=len(runs), wall_min=min(walls), wall_median=statistics.median(walls),
+		cpu_median=statistics.median(run['cpu'] for run in runs),
+		children_cpu_median=statistics.median(run['children_cpu'] for run in runs),
+	), result
+
+class Bench(object):
+	def __init__(self, args, directory):
+		super(Bench, self).__init__()
+		self.args = args
+		self.directory = directory
+		self.results = list()
+
+	def run(self, bench, params, function):
+		print('{} {}'.format(bench, json.dumps(params, ensure_ascii=False)), file=sys.stderr)
+		entry = dict(bench=bench, params=params)
+		try:
+			timing, extra = measure(function, self.args.repeat)
+			entry.update(timing)
+			if isinstance(extra, dict): entry.update(extra)
+		except Exception as e:
+			entry['error'] = repr(e)
+			print('\tошибка: {!r}'.format(e), file=sys.stderr)
+		self.results.append(entry)
+		return entry
+
+	def graph(self, cls, rrd, options):
+		graph = cls()
+		graph.setup([ rrd, os.path.join(self.directory, 'graph.png') ] + options)
+		status = graph.produce()
+		if status.returncode != 0: raise Exception('rrdtool завершился с кодом {}'.format(status.returncode))
+		# Размер команды, собранной в produce(): повторная сборка - лишние выгрузки и свертка
+		return dict(cmdline_bytes=graph.cmdline_size[1] if graph.cmdline_size is not None else None)
+
+	def bench_span(self, span_text, end):
+		span = synth_rrd.parse_span(span_text, end)
+		rrd = os.path.join(self.directory, 'bench_{}.rrd'.format(span_text))
+		info = dict()
+		def generate():
+			info.update(synth_rrd.write_rrd(rrd, end, span, self.args.seed))
+			return dict(rrd_bytes=info['bytes'], rows=info['rows'])
+		self.run('generate', dict(span=span_text), generate)
+
+		windows = [ window for window in WINDOWS if synth_rrd.parse_span(window, end) <= span ]
+		for window in windows:
+			for name, cls in GRAPHS.items():
+				self.run('graph', dict(span=span_text, graph=name, window=window),
+					lambda: self.graph(cls, rrd, [ '--start', 'end-' + window ]))
+
+		for window in windows:
+			start = 'end-' + window
+			self.run('detect_length', dict(span=span_text, window=window, method='graphv'),
+				lambda: detect_window_rrdtool(rrd, start, 'now'))
+			self.run('detect_length', dict(span=span_text, window=window, method='python'),
+				lambda: detect_window(rrd, start, 'now'))
+			for method in ('graph', 'xport'):
+				def detect():
+					graph = NormalGraph()
+					graph.setup([ rrd, os.devnull, '--start', start, '--detect', method ])
+					b_min, b_max = graph.detect_limits(unpack_list(graph.mk_cmdline()))
+					return dict(b_min=b_min, b_max=b_max)
+				self.run('detect_limits', dict(span=span_text, window=window, method=method), detect)
+
+		dump = os.path.join(self.directory, 'bench_{}.xml'.format(span_text))
+		# dump делается в первом прогоне, пропускная способность считается без него
+		def filter_xml():
+			if not os.path.exists(dump):
+				with open(dump, 'wb') as f:
+					subprocess.run([ 'rrdtool', 'dump', rrd ], stdout=f, env=rrdtool_env(), check=True)
+			index = IntervalIndex(info['gaps'])
+			with open(dump, 'rb') as input_xml, open(os.devnull, 'wb') as output_xml:
+				started = time.perf_counter()
+				stats = filter_stream(input_xml, output_xml, index)
+				elapsed = max(time.perf_counter() - started, 1e-9)
+			return dict(
+				xml_bytes=stats['bytes'], xml_rows=stats['rows'], blacklisted=stats['blacklisted'], intervals=len(index),
+				mib_per_sec=stats['bytes'] / elapsed / 1024 / 1024, rows_per_sec=stats['rows'] / elapsed,
+			)
+		self.run('filter_xml', dict(span=span_text), filter_xml)
+		if os.path.exists(dump): os.unlink(dump)
+
+		for depth in DEPTHS:
+			if depth * LENGTH_DAY > span: break
+			for engine in ('rrdtool', 'fold'):
+				self.run('overlap', dict(span=span_text, depth=depth, engine=engine),
+					lambda: self.graph(OverlapGraph, rrd, [ '--depth', str(depth), '--engine', engine ]))
+
+def rrdtool_version():
+	try:
+		output = subprocess.run([ 'rrdtool' ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+		return output.decode('utf-8', errors='replace').splitlines()[0].strip()
+	except (OSError, IndexError):
+		return None
+
+def git_revision():
+	try:
+		output = subprocess.run([ 'git', 'rev-parse', 'HEAD' ], cwd=os.path.dirname(os.path.abspath(__file__)),
+			stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+		return output.stdout.decode('ascii').strip() or None
+	except OSError:
+		return None
+
+def result_key(entry):
+	return entry['bench'], json.dumps(entry['params'], sort_keys=True)
+
+def compare(previous, results):
+	previous = { result_key(entry): entry for entry in previous if 'wall_median' in entry }
+	for entry in results:
+		old = previous.get(result_key(entry))
+		if old is None or 'wall_median' not in entry: continue
+		ratio = entry['wall_median'] / old['wall_median'] if old['wall_median'] > 0 else math.inf
+		print('{:>7.2f}x  {:9.4f} -> {:9.4f} сек  {} {}'.format(
+			ratio, old['wall_median'], entry['wall_median'], entry['bench'],
+			json.dumps(entry['params'], ensure_ascii=False)), file=sys.stderr)
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	args.add_argument('--span', dest='spans', action='append', default=None,
+		help='Длина синтетической истории, можно несколько раз, по умолчанию = 1d и 1y')
+	args.add_argument('--repeat', dest='repeat', type=int, default=3,
+		help='Повторов каждого замера, по умолчанию = 3')
+	args.add_argument('--seed', dest='seed', type=int, default=1,
+		help='Зерно генератора данных, по умолчанию = 1')
+	args.add_argument('--out', dest='out', type=str, default=None,
+		help='Куда записать JSON, по умолчанию - stdout')
+	args.add_argument('--compare', dest='compare', type=argparse.FileType('r'), default=None,
+		help='JSON прошлого прогона для сравнения медиан')
+	args = args.parse_args()
+
+	spans = args.spans if args.spans is not None else [ '1d', '1y' ]
+	for span in spans: synth_rrd.parse_span(span)
+	end = int(time.time())
+
+	with tempfile.TemporaryDirectory(prefix='bench_') as directory:
+		bench = Bench(args, directory)
+		# Вывод rrdtool graph не должен попасть в JSON
+		with contextlib.redirect_stdout(sys.stderr):
+			for span in spans: bench.bench_span(span, end)
+
+	report = dict(
+		meta=dict(
+			time=end, python=platform.python_version(), platform=platform.platform(),
+			rrdtool=rrdtool_version(), revision=git_revision(), repeat=args.repeat, seed=args.seed, spans=spans,
+		),
+		results=bench.results,
+	)
+	if args.compare is not None: compare(json.load(args.compare)['results'], bench.results)
+
+	if args.out is not None:
+		with open(args.out, 'w') as f:
+			json.dump(report, f, indent='\t', ensure_ascii=False)
+	else:
+		json.dump(report, sys.stdout, indent='\t', ensure_ascii=False)
+		print()
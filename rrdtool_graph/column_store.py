@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+import sys, os, json, math, time, argparse
+import numpy
+from rrd_file import RRDFile
+import attime
+
+# Поколоночная выгрузка RRD для анализа без rrdtool dump и разбора XML.
+# Каталог (по умолчанию <rrd>.columns/) содержит meta.json и по каталогу на
+# каждый RRA (AVERAGE_10, MAX_120, ...), в нем по файлу на DS и кусок:
+#   <ds>_<номер куска>.bin - chunk_rows значений dtype, little-endian, NaN где нет данных
+# Куски выровнены по времени: строка времени t лежит в куске
+# t // step // chunk_rows на месте t // step % chunk_rows, так что индекс
+# времени - это сама сетка, а в meta.json хранятся только границы выгруженного.
+# Запрос по интервалу отображает в память только куски, которые его задевают.
+# Повторная выгрузка дописывает строки новее последней выгруженной, а то, что
+# уже вытеснено из кольцевых буферов RRD, остается в выгрузке.
+
+VERSION = 1
+DEFAULT_CHUNK_ROWS = 8192
+DTYPES = { 'float32': '<f4', 'float64': '<f8' }
+
+def default_path(rrd):
+	return rrd + '.columns'
+
+def archive_name(cf, step):
+	return '{}_{}'.format(cf, step)
+
+class Archive(object):
+	def __init__(self, store, cf, step, first, last):
+		super(Archive, self).__init__()
+		self.store = store
+		self.cf = cf
+		self.step = step
+		self.first = first # Время первой и последней выгруженной строки
+		self.last = last
+		self.name = archive_name(cf, step)
+		self.directory = os.path.join(store.directory, self.name)
+
+	def __repr__(self):
+		return 'Archive({}, step={}, {} .. {})'.format(self.cf, self.step, self.first, self.last)
+
+	def to_dict(self):
+		return dict(cf=self.cf, step=self.step, first=self.first, last=self.last)
+
+	def chunk_path(self, ds, chunk):
+		return os.path.join(self.directory, '{}_{:06d}.bin'.format(ds, chunk))
+
+	# Номер куска и место в нем строки времени t (t кратно step)
+	def locate(self, t):
+		row = t // self.step
+		return row // self.store.chunk_rows, row % self.store.chunk_rows
+
+	def chunk(self, ds, chunk):
+		path = self.chunk_path(ds, chunk)
+		if not os.path.exists(path): return None
+		return numpy.memmap(path, dtype=self.store.dtype, mode='r', shape=(self.store.chunk_rows,))
+
+	# Время и значения строк из [start, end]. Без копирования, если интервал
+	# в пределах одного куска; отсутствующие куски - NaN.
+	def query(self, start, end, ds=None):
+		ds = self.store.ds[0] if ds is None else ds
+		if ds not in self.store.ds: raise KeyError(ds)
+		if self.first is None: return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=self.store.dtype)
+		start = max(start, self.first)
+		end = min(end, self.last)
+		start += -start % self.step
+		end -= end % self.step
+		if end < start: return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=self.store.dtype)
+		times = numpy.arange(start, end + 1, self.step, dtype=numpy.int64)
+		(chunk_from, row_from), (chunk_to, row_to) = self.locate(start), self.locate(end)
+		parts = list()
+		for chunk in range(chunk_from, chunk_to + 1):
+			begin = row_from if chunk == chunk_from else 0
+			stop = row_to + 1 if chunk == chunk_to else self.store.chunk_rows
+			values = self.chunk(ds, chunk)
+			parts.append(values[begin:stop] if values is not None else numpy.full(stop - begin, numpy.nan, dtype=self.store.dtype))
+		return times, parts[0] if len(parts) == 1 else numpy.concatenate(parts)
+
+	# Дописать строки (times кратны step и возрастают). Новые куски создаются
+	# целиком из NaN, строки пишутся на свои места.
+	def write(self, ds, times, values):
+		os.makedirs(self.directory, exist_ok=True)
+		values = numpy.asarray(values, dtype=self.store.dtype)
+		chunks = times // self.step // self.store.chunk_rows
+		bounds = numpy.flatnonzero(numpy.diff(chunks)) + 1
+		for begin, stop in zip([ 0 ] + bounds.tolist(), bounds.tolist() + [ len(times) ]):
+			chunk, row = self.locate(int(times[begin]))
+			path = self.chunk_path(ds, chunk)
+			if not os.path.exists(path):
+				with open(path, 'wb') as f:
+					f.write(numpy.full(self.store.chunk_rows, numpy.nan, dtype=self.store.dtype).tobytes())
+			with open(path, 'r+b') as f:
+				f.seek(row * self.store.dtype.itemsize)
+				f.write(values[begin:stop].tobytes())
+
+class ColumnStore(object):
+	def __init__(self, directory):
+		super(ColumnStore, self).__init__()
+		self.directory = directory
+		self.meta_path = os.path.join(directory, 'meta.json')
+		with open(self.meta_path, 'r') as f:
+			meta = json.load(f)
+		if meta.get('version') != VERSION:
+			raise Exception('Неизвестная версия {!r}.'.format(self.meta_path))
+		self.dtype = numpy.dtype(meta['dtype'])
+		self.chunk_rows = meta['chunk_rows']
+		self.ds = meta['ds']
+		self.rrd = meta['rrd']
+		self.archives = [ Archive(self, a['cf'], a['step'], a['first'], a['last']) for a in meta['archives'] ]
+
+	@classmethod
+	def create(cls, directory, rrd, ds, dtype='float64', chunk_rows=DEFAULT_CHUNK_ROWS):
+		os.makedirs(directory, exist_ok=True)
+		meta = dict(version=VERSION, rrd=rrd, ds=ds, dtype=DTYPES[dtype], chunk_rows=chunk_rows, archives=list())
+		with open(os.path.join(directory, 'meta.json'), 'w') as f:
+			json.dump(meta, f, indent='\t')
+		return cls(directory)
+
+	# meta.json пишется после данных: прерванная выгрузка повторится с того же места
+	def save(self):
+		meta = dict(
+			version=VERSION, rrd=self.rrd, ds=self.ds, dtype=self.dtype.str, chunk_rows=self.chunk_rows,
+			archives=[ archive.to_dict() for archive in self.archives ],
+		)
+		temp = self.meta_path + '.tmp'
+		with open(temp, 'w') as f:
+			json.dump(meta, f, indent='\t')
+		os.replace(temp, self.meta_path)
+
+	def archive(self, cf, step):
+		for archive in self.archives:
+			if archive.cf == cf and archive.step == step: return archive
+		raise KeyError(archive_name(cf, step))
+
+	# Как RRDFile.find_rra: архив с функцией cf и наибольшим шагом не больше step
+	def find(self, cf, step=None):
+		candidates = [ a for a in self.archives if a.cf == cf and (step is None or a.step <= step) ]
+		if len(candidates) == 0: candidates = [ a for a in self.archives if a.cf == cf ]
+		if len(candidates) == 0: raise KeyError(cf)
+		if step is None: return min(candidates, key=lambda a: a.step)
+		return max(candidates, key=lambda a: a.step)
+
+	# Выгрузка строк RRD новее уже выгруженных. Возвращает число записанных строк по архивам.
+	def export(self, rrd):
+		if [ ds['name'] for ds in rrd.ds ] != self.ds:
+			raise Exception('DS {!r} не совпадают с выгрузкой {!r}.'.format(rrd.path, self.directory))
+		written = dict()
+		for rra in rrd.rra:
+			try:
+				archive = self.archive(rra.cf, rra.step)
+			except KeyError:
+				archive = Archive(self, rra.cf, rra.step, None, None)
+				self.archives.append(archive)
+			times = None
+			for ds in self.ds:
+				series = rrd.series(rra, ds)
+				times = series.times()
+				values = series.values()
+				if archive.last is not None:
+					new = times > archive.last
+					times, values = times[new], values[new]
+				if len(times) > 0: archive.write(ds, times, values)
+			written[archive.name] = len(times)
+			if len(times) > 0:
+				archive.first = int(times[0]) if archive.first is None else archive.first
+				archive.last = int(times[-1])
+		self.save()
+		return written
+
+def export(rrd_path, directory, dtype='float64', chunk_rows=DEFAULT_CHUNK_ROWS):
+	with RRDFile(rrd_path) as rrd:
+		# rrdtool update не правит файл, пока он читается
+		rrd.lock()
+		if os.path.exists(os.path.join(directory, 'meta.json')):
+			store = ColumnStore(directory)
+		else:
+			store = ColumnStore.create(directory, os.path.abspath(rrd_path), [ ds['name'] for ds in rrd.ds ], dtype, chunk_rows)
+		return store, store.export(rrd)
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	commands = args.add_subparsers(dest='command', required=True)
+	command = commands.add_parser('export',
+		help='Выгрузить или дописать RRA из RRD-файла.')
+	command.add_argument('rrd', type=str)
+	command.add_argument('directory', type=str, nargs='?', default=None,
+		help='Каталог выгрузки, по умолчанию = <rrd>.columns')
+	command.add_argument('--dtype', dest='dtype', choices=sorted(DTYPES.keys()), default='float64',
+		help='Тип значений для новой выгрузки, по умолчанию = float64')
+	command.add_argument('--chunk-rows', dest='chunk_rows', type=int, default=DEFAULT_CHUNK_ROWS,
+		help='Строк в куске для новой выгрузки, по умолчанию = {}'.format(DEFAULT_CHUNK_ROWS))
+	command = commands.add_parser('info',
+		help='Архивы выгрузки и их границы.')
+	command.add_argument('directory', type=str)
+	command = commands.add_parser('query',
+		help='Строки "время:значение" архива за интервал.')
+	command.add_argument('directory', type=str)
+	command.add_argument('cf', type=str, choices=('MIN', 'AVERAGE', 'MAX'))
+	command.add_argument('--step', dest='step', type=int, default=None,
+		help='Наибольший шаг архива, по умолчанию - самый подробный')
+	command.add_argument('--start', dest='start', type=str, default='end-1d',
+		help='Начало в формате AT-style, по умолчанию = end-1d')
+	command.add_argument('--end', dest='end', type=str, default=None,
+		help='Конец в формате AT-style, по умолчанию - последняя выгруженная строка')
+	command.add_argument('--ds', dest='ds', type=str, default=None,
+		help='DS, по умолчанию - первый')
+
+	args = args.parse_args()
+
+	if args.command == 'export':
+		directory = args.directory if args.directory is not None else default_path(args.rrd)
+		started = time.time()
+		store, written = export(args.rrd, directory, args.dtype, args.chunk_rows)
+		for name, rows in written.items():
+			print('{}: {} строк'.format(name, rows), file=sys.stderr)
+		print('{}: {} строк за {:.2f} сек'.format(directory, sum(written.values()), time.time() - started), file=sys.stderr)
+	elif args.command == 'info':
+		store = ColumnStore(args.directory)
+		print('{}: {}, ds = {}, {}, {} строк в куске'.format(store.directory, store.rrd, ', '.join(store.ds), store.dtype, store.chunk_rows))
+		for archive in store.archives:
+			rows = 0 if archive.first is None else (archive.last - archive.first) // archive.step + 1
+			print('{}: {} строк, {} .. {}'.format(archive.name, rows, archive.first, archive.last))
+	else:
+		store = ColumnStore(args.directory)
+		archive = store.find(args.cf, args.step)
+		# now - последняя выгруженная строка: выгрузка может быть старой
+		window = attime.resolve_window(args.start, args.end if args.end is not None else 'now', archive.last)
+		if window is None: raise Exception('Неверный интервал: {!r} .. {!r}.'.format(args.start, args.end))
+		times, values = archive.query(window[0], window[1], args.ds)
+		for t, value in zip(times.tolist(), values.tolist()):
+			print('{}:{}'.format(t, 'U' if math.isnan(value) else repr(value)))
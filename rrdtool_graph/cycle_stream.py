@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import sys, os, time, tty, argparse
+import numpy
+
+# Двоичный поток периодов из arduino_firmware.ino (STREAM_CYCLES = true):
+# кадр на каждый период сети, 10 байт, little-endian:
+#   A5 5A | seq: uint16 | micros: uint32 | sum1 sum2
+# seq растет на 1 с каждым периодом, micros - конец периода по часам Arduino
+# (переполняется раз в ~71 минуту), sum1 и sum2 - Fletcher-16 по seq и micros.
+# Decoder разбирает поток пачками через numpy.frombuffer, находит пропавшие
+# кадры по seq и выдает частоту каждого периода и частоту по FREQ_COUNTS
+# периодам - то же значение, что прошивка печатает текстом раз в ~10 секунд.
+
+FRAME = numpy.dtype([ ('magic', '<u2'), ('seq', '<u2'), ('micros', '<u4'), ('sum1', 'u1'), ('sum2', 'u1') ])
+MAGIC = b'\xa5\x5a'
+MAGIC_VALUE = 0x5aa5
+# Вес байта в sum2: sum2 = sum((n - i) * b[i]) mod 255 для n байт
+WEIGHTS = numpy.arange(6, 0, -1, dtype=numpy.uint32)
+
+# Как в прошивке
+FREQ_TARGET = 50
+FREQ_COUNTS = 500
+
+# Периоды вне 10..40 мс (25..100 Hz) и пропуск длиннее FREQ_COUNTS кадров -
+# перезапуск прошивки или потеря синхронизации: среднее начинается заново.
+PERIOD_MIN = 10000
+PERIOD_MAX = 40000
+MAX_GAP = FREQ_COUNTS
+
+# Ряд высокого разрешения: время конца периода (эпоха, сек) и частота.
+# Файл ingest.py --highres - эти записи подряд, читается numpy.fromfile.
+HIGHRES = numpy.dtype([ ('time', '<f8'), ('freq', '<f4') ])
+
+def checksums(raw):
+	body = raw[:, 2:8].astype(numpy.uint32)
+	return body.sum(axis=1) % 255, (body * WEIGHTS).sum(axis=1) % 255
+
+def valid_frames(raw):
+	sum1, sum2 = checksums(raw)
+	magic = (raw[:, 0] == MAGIC[0]) & (raw[:, 1] == MAGIC[1])
+	return magic & (raw[:, 8] == sum1) & (raw[:, 9] == sum2)
+
+def encode(seq, micros):
+	frames = numpy.zeros(len(seq), dtype=FRAME)
+	frames['magic'] = MAGIC_VALUE
+	frames['seq'] = numpy.asarray(seq) % 0x10000
+	frames['micros'] = numpy.asarray(micros) % 0x100000000
+	raw = frames.view(numpy.uint8).reshape(len(frames), FRAME.itemsize)
+	frames['sum1'], frames['sum2'] = checksums(raw)
+	return frames.tobytes()
+
+class Decoder(object):
+	def __init__(self, counts=FREQ_COUNTS):
+		super(Decoder, self).__init__()
+		self.counts = counts
+		self.buffer = b''
+		self.frames = 0
+		self.dropped = 0 # Пропавших кадров по разрыву seq
+		self.skipped = 0 # Байт вне целых кадров: помехи, битые кадры
+		self.resets = 0
+		# Последний кадр: seq, micros и сквозные номер периода и время в мкс
+		self.last = None
+		# Начало текущего среднего: сквозные номер периода и время
+		self.anchor = None
+
+	# Целые кадры из буфера. Обычно поток выровнен и проверяется одним
+	# вызовом numpy на всю пачку; после битого кадра - поиск следующей сигнатуры.
+	def split(self):
+		data, position, parts = self.buffer, 0, list()
+		while len(data) - position >= FRAME.itemsize:
+			count = (len(data) - position) // FRAME.itemsize
+			raw = numpy.frombuffer(data, numpy.uint8, count * FRAME.itemsize, position).reshape(count, FRAME.itemsize)
+			bad = numpy.flatnonzero(~valid_frames(raw))
+			good = count if len(bad) == 0 else int(bad[0])
+			if good > 0: parts.append(raw[:good].copy().view(FRAME).ravel())
+			position += good * FRAME.itemsize
+			if good == count: break
+			following = data.find(MAGIC, position + 1)
+			if following < 0:
+				# Последний байт может быть началом сигнатуры
+				following = len(data) - 1
+			self.skipped += following - position
+			position = following
+		self.buffer = data[position:]
+		if len(parts) == 0: return numpy.zeros(0, dtype=FRAME)
+		return numpy.concatenate(parts)
+
+	# Пачка байт, полученная в момент now (время хоста, сек).
+	# Возвращает ряд HIGHRES и список (время, частота) средних по counts периодам.
+	# Время кадра - now минус его отставание от последнего кадра пачки по часам
+	# Arduino, так уход кварца не накапливается. Без now - время по часам
+	# Arduino от первого кадра, для разбора записей.
+	def feed(self, data, now=None):
+		self.buffer += data
+		frames = self.split()
+		if len(frames) == 0: return numpy.zeros(0, dtype=HIGHRES), list()
+		self.frames += len(frames)
+
+		seq = frames['seq'].astype(numpy.int64)
+		micros = frames['micros'].astype(numpy.int64)
+		previous_seq = numpy.empty_like(seq)
+		previous_micros = numpy.empty_like(micros)
+		previous_seq[1:], previous_micros[1:] = seq[:-1], micros[:-1]
+		if self.last is not None:
+			previous_seq[0], previous_micros[0] = self.last[0], self.last[1]
+		cycles = (seq - previous_seq) % 0x10000
+		elapsed = (micros - previous_micros) % 0x100000000
+		ok = (cycles >= 1) & (cycles <= MAX_GAP) & (elapsed >= cycles * PERIOD_MIN) & (elapsed <= cycles * PERIOD_MAX)
+		if self.last is None: ok[0] = False
+		self.dropped += int((cycles[ok] - 1).sum())
+		self.resets += int((~ok).sum()) - (1 if self.last is None else 0)
+
+		# Сквозные номер периода и время; на разрыве приращения нет
+		base_cycle, base_clock = (self.last[2], self.last[3]) if self.last is not None else (0, 0)
+		cycle = base_cycle + numpy.cumsum(numpy.where(ok, cycles, 0))
+		clock = base_clock + numpy.cumsum(numpy.where(ok, elapsed, 0))
+		self.last = (int(seq[-1]), int(micros[-1]), int(cycle[-1]), int(clock[-1]))
+		times = clock / 1e6 if now is None else now - (clock[-1] - clock) / 1e6
+
+		highres = numpy.zeros(int(ok.sum()), dtype=HIGHRES)
+		highres['time'] = times[ok]
+		highres['freq'] = 1e6 * cycles[ok] / elapsed[ok]
+
+		averages = list()
+		resets = numpy.flatnonzero(~ok).tolist()
+		bounds = [ 0 ] + resets + [ len(frames) ]
+		for begin, end in zip(bounds[:-1], bounds[1:]):
+			if begin == end: continue
+			if begin in resets or self.anchor is None:
+				self.anchor = (int(cycle[begin]), int(clock[begin]))
+			while True:
+				i = begin + int(numpy.searchsorted(cycle[begin:end], self.anchor[0] + self.counts))
+				if i >= end: break
+				averages.append((float(times[i]), 1e6 * (cycle[i] - self.anchor[0]) / (clock[i] - self.anchor[1])))
+				self.anchor = (int(cycle[i]), int(clock[i]))
+		return highres, averages
+
+	def summary(self):
+		return 'кадров: {}, пропало: {}, лишних байт: {}, разрывов: {}'.format(
+			self.frames, self.dropped, self.skipped, self.resets)
+
+# Поток с частотой около 50 Hz и случайными потерями и помехами - для проверки
+# декодера и ingest.py --binary без Arduino.
+def synth(seconds, seed=1, drop=0.0, noise=0.0):
+	random = numpy.random.default_rng(seed)
+	count = int(seconds * FREQ_TARGET)
+	drift = 0.05 * numpy.sin(numpy.arange(count) * 2 * numpy.pi / (FREQ_TARGET * 600.0))
+	periods = 1e6 / (FREQ_TARGET + drift + random.normal(0, 0.01, count))
+	micros = numpy.cumsum(numpy.rint(periods)).astype(numpy.int64) + int(random.integers(0, 0x100000000))
+	seq = numpy.arange(1, count + 1)
+	keep = random.random(count) >= drop
+	data = bytearray(encode(seq[keep], micros[keep]))
+	# Помехи: случайные байты поверх потока
+	for position in random.integers(0, len(data), int(len(data) * noise)):
+		data[position] = int(random.integers(0, 256))
+	return bytes(data)
+
+def decode_file(path, chunk, highres_path):
+	decoder = Decoder()
+	highres_file = open(highres_path, 'wb') if highres_path is not None else None
+	with open(path, 'rb') as f:
+		while True:
+			data = f.read(chunk)
+			if len(data) == 0: break
+			highres, averages = decoder.feed(data)
+			for timestamp, freq in averages:
+				print('{:.3f}:{:.6f}'.format(timestamp, freq))
+			if highres_file is not None: highres_file.write(highres.tobytes())
+	if highres_file is not None: highres_file.close()
+	print(decoder.summary(), file=sys.stderr)
+
+# Запись проигрывается через псевдотерминал с темпом прошивки:
+# ingest.py --binary --port <путь из stderr> читает его как порт Arduino.
+def replay(path, speed, hold):
+	master, slave = os.openpty()
+	# Двоичные данные: без построчного ввода, эха и замены \r
+	tty.setraw(slave)
+	print(os.ttyname(slave), file=sys.stderr, flush=True)
+	with open(path, 'rb') as f:
+		data = f.read()
+	rate = FRAME.itemsize * FREQ_TARGET * speed
+	chunk = FRAME.itemsize * FREQ_TARGET // 10
+	started = time.time()
+	for position in range(0, len(data), chunk):
+		delay = started + position / rate - time.time()
+		if delay > 0: time.sleep(delay)
+		os.write(master, data[position:position + chunk])
+	# Читателю нужно время дочитать
+	time.sleep(hold)
+	os.close(slave)
+	os.close(master)
+	print('Отправлено {} байт за {:.1f} сек'.format(len(data), time.time() - started), file=sys.stderr)
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	commands = args.add_subparsers(dest='command', required=True)
+	command = commands.add_parser('synth',
+		help='Записать синтетический поток.')
+	command.add_argument('output', type=str)
+	command.add_argument('--seconds', dest='seconds', type=float, default=600,
+		help='Длительность, по умолчанию = 600')
+	command.add_argument('--drop', dest='drop', type=float, default=0.0,
+		help='Доля пропавших кадров, по умолчанию = 0')
+	command.add_argument('--noise', dest='noise', type=float, default=0.0,
+		help='Доля испорченных байт, по умолчанию = 0')
+	command.add_argument('--seed', dest='seed', type=int, default=1,
+		help='Зерно генератора, по умолчанию = 1')
+	command = commands.add_parser('decode',
+		help='Разобрать записанный поток: средние "время:частота" в stdout, время от начала записи.')
+	command.add_argument('input', type=str)
+	command.add_argument('--chunk', dest='chunk', type=int, default=4096,
+		help='Размер пачки в байтах, по умолчанию = 4096')
+	command.add_argument('--highres', dest='highres', type=str, default=None,
+		help='Куда записать ряд высокого разрешения, по умолчанию не пишется')
+	command = commands.add_parser('replay',
+		help='Проиграть записанный поток через псевдотерминал, его путь - в stderr.')
+	command.add_argument('input', type=str)
+	command.add_argument('--speed', dest='speed', type=float, default=1.0,
+		help='Во сколько раз быстрее прошивки, по умолчанию = 1')
+	command.add_argument('--hold', dest='hold', type=float, default=2.0,
+		help='Сколько секунд держать терминал открытым после записи, по умолчанию = 2')
+
+	args = args.parse_args()
+
+	if args.command == 'synth':
+		data = synth(args.seconds, args.seed, args.drop, args.noise)
+		with open(args.output, 'wb') as f:
+			f.write(data)
+		print('{}: {} байт'.format(args.output, len(data)), file=sys.stderr)
+	elif args.command == 'decode':
+		decode_file(args.input, args.chunk, args.highres)
+	else:
+		replay(args.input, args.speed, args.hold)
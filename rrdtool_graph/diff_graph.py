@@ -17,8 +17,7 @@ class DiffGraph(FloatingPeriodGraph):
 			'DEF:r_max={}:freq:MAX'.format(self.arg_rrd),
 			'DEF:r_avg={}:freq:AVERAGE'.format(self.arg_rrd),
 			
-			'VDEF:g_min=r_min,{},PERCENTNAN'.format(self.arg_error),
-			'VDEF:g_max=r_max,{},PERCENTNAN'.format(100 - self.arg_error),
+			self.mk_error_bounds_cmdline(),
 			
 			cdef('f_min', expr_drop('r_min', 'g_min', 'g_max')),
 			cdef('f_max', expr_drop('r_max', 'g_min', 'g_max')),
@@ -43,18 +42,13 @@ class DiffGraph(FloatingPeriodGraph):
 			'VDEF:g_last_max=f_diff_max,LAST',
 			'VDEF:g_last_avg=f_diff_max,LAST',
 
-			cdef('e_min', 'r_min,g_min,LT'),
-			cdef('e_max', 'r_max,g_max,GT'),
-			cdef('e_miss', 'r_avg,UN'),
+			self.mk_markers_defs(),
 			cdef('ztick', expr_0tick(period, 'r_avg')),
 
 			'TEXTALIGN:left',
 
 			comment('Маркеры:'),
-			tick('e_miss', '#BFBFBF', fraction=1, legend='  Нет данных'),
-			tick('ztick', '#FFFF00', fraction=1),
-			tick('e_min', '#0000FF', fraction=0.02, legend='  Возм. ошибки вниз'),
-			tick('e_max', '#FF0000', fraction=-0.02, legend='  Возм. ошибки вверх\\n'),
+			self.mk_markers_ticks(tick('ztick', '#FFFF00', fraction=1)),
 			'HRULE:0#7F007F::dashes',
 			
 			comment_header(
@@ -84,6 +78,23 @@ class DiffGraph(FloatingPeriodGraph):
 			print_max('g_diff_max'),
 		]
 
+	def mk_limits_cmdline(self):
+		return self.mk_period_cmdline() + [
+			'DEF:r_min={}:freq:MIN'.format(self.arg_rrd),
+			'DEF:r_max={}:freq:MAX'.format(self.arg_rrd),
+			'XPORT:r_min:r_min',
+			'XPORT:r_max:r_max',
+		]
+
+	def calc_limits(self, step, series):
+		g_min, g_max = self.calc_error_bounds(series)
+		f_min = rpn_limit(series['r_min'], g_min, g_max)
+		f_max = rpn_limit(series['r_max'], g_min, g_max)
+		# f_min,PREV(f_max),-,STEPWIDTH,/ и f_max,PREV(f_min),-,STEPWIDTH,/
+		f_diff_min = [ (v - p) / step for v, p in zip(f_min, rpn_prev(f_max)) ]
+		f_diff_max = [ (v - p) / step for v, p in zip(f_max, rpn_prev(f_min)) ]
+		return vdef_minimum(f_diff_min), vdef_maximum(f_diff_max)
+
 
 if __name__ == '__main__':
 	DiffGraph().run()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+import sys, os, math, mmap, time, struct, argparse
+
+# Индекс событий рядом с freq.rrd (freq.rrd.events), пополняется при приеме
+# измерений (ingest.py --events): выходы за полосы ±0.2 и ±0.4 Hz (ГОСТ
+# 32144-2013), выбросы за процентили ошибочных данных и пропуски данных.
+# Событие - начало, конец, время и значение пика. Файл только дописывается:
+# заголовок и записи фиксированного размера в порядке конца события, так что
+# выборка за интервал - двоичный поиск, сколько бы лет ни накопилось.
+# Время - секунды эпохи с дробной частью: события из двоичного потока
+# периодов (cycle_stream.py) короче секунды. Только стандартная библиотека:
+# модуль работает и на роутере.
+#
+# Поиск просматривает записи с концом до end + наибольшая длительность, поэтому
+# события длиннее LONG (долгие пропуски) пишутся в отдельный маленький файл
+# <index>.long того же формата и не растягивают просмотр основного. Еще
+# незакрытые события детектор при каждом сбросе записывает в <index>.open
+# (перезаписывается целиком): графики с --events видят их до закрытия.
+
+MAGIC = b'FEVT'
+VERSION = 1
+# magic, version, размер записи, время последнего измерения, наибольшая длительность
+HEADER = struct.Struct('<4sHHdd')
+# start, end, peak_time, peak, kind
+RECORD = struct.Struct('<ddddB7x')
+
+KINDS = ('gap', 'band_low', 'band_high', 'limit_low', 'limit_high', 'outlier_low', 'outlier_high')
+KIND_NAMES = {
+	'gap': 'Нет данных',
+	'band_low': 'Ниже 49.8 Hz', 'band_high': 'Выше 50.2 Hz',
+	'limit_low': 'Ниже 49.6 Hz', 'limit_high': 'Выше 50.4 Hz',
+	'outlier_low': 'Возм. ошибка вниз', 'outlier_high': 'Возм. ошибка вверх',
+}
+
+NOMINAL = 50.0
+BAND = 0.2
+LIMIT = 0.4
+GAP = 15 # heartbeat из make_rrd.sh
+LONG = 60 * 60
+DEFAULT_ERROR = 0.5
+
+def default_path(rrd):
+	return rrd + '.events'
+
+class Event(object):
+	def __init__(self, kind, start, end, peak_time=math.nan, peak=math.nan, provisional=False):
+		super(Event, self).__init__()
+		self.kind = kind
+		self.start = start
+		self.end = end
+		self.peak_time = peak_time
+		self.peak = peak
+		self.provisional = provisional # Еще не закрыто: конец - последнее измерение
+
+	def __repr__(self):
+		return 'Event({}, {!r} .. {!r}, peak={!r}{})'.format(
+			self.kind, self.start, self.end, self.peak, ', provisional' if self.provisional else '')
+
+	def pack(self):
+		return RECORD.pack(self.start, self.end, self.peak_time, self.peak, KINDS.index(self.kind))
+
+	@classmethod
+	def unpack_from(cls, buffer, offset, provisional=False):
+		start, end, peak_time, peak, kind = RECORD.unpack_from(buffer, offset)
+		return cls(KINDS[kind], start, end, peak_time, peak, provisional)
+
+# split=False - сам файл <index>.long, без своих .long и .open
+class EventIndex(object):
+	def __init__(self, path, writable=False, split=True):
+		super(EventIndex, self).__init__()
+		self.path = path
+		self.writable = writable
+		self.long = None
+		self.open_path = path + '.open' if split else None
+		if writable and not os.path.exists(path):
+			with open(path, 'wb') as f:
+				f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, math.nan, 0.0))
+		self.file = open(path, 'r+b' if writable else 'rb')
+		magic, version, record_size, self.seen, self.max_duration = HEADER.unpack(self.file.read(HEADER.size))
+		if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+			self.file.close()
+			raise Exception('{!r} не индекс событий или неизвестной версии.'.format(path))
+		if math.isnan(self.seen): self.seen = None
+		if writable:
+			# Недописанная запись после сбоя
+			self.file.truncate(HEADER.size + len(self) * RECORD.size)
+		if split and (writable or os.path.exists(path + '.long')):
+			try:
+				self.long = EventIndex(path + '.long', writable, split=False)
+			except Exception:
+				self.file.close()
+				raise
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		if self.long is not None: self.long.close()
+		self.file.close()
+
+	def __len__(self):
+		return (os.fstat(self.file.fileno()).st_size - HEADER.size) // RECORD.size
+
+	def write_header(self):
+		self.file.seek(0)
+		self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, math.nan if self.seen is None else self.seen, self.max_duration))
+
+	# Заголовок с новой наибольшей длительностью пишется раньше записей:
+	# читатель с прежним заголовком не пропустит длинное событие.
+	# provisional - незакрытые события для <index>.open, None - не трогать его.
+	def append(self, events, seen=None, provisional=None):
+		if not self.writable: raise Exception('{!r} открыт только для чтения.'.format(self.path))
+		if self.long is not None:
+			self.long.append([ event for event in events if event.end - event.start > LONG ], seen)
+			events = [ event for event in events if event.end - event.start <= LONG ]
+		if len(events) > 0:
+			duration = max(event.end - event.start for event in events)
+			if duration > self.max_duration:
+				self.max_duration = duration
+				self.write_header()
+			self.file.seek(0, os.SEEK_END)
+			self.file.write(b''.join(event.pack() for event in events))
+		if seen is not None: self.seen = seen
+		self.write_header()
+		self.file.flush()
+		if provisional is not None and self.open_path is not None: self.write_open(provisional)
+
+	def write_open(self, events):
+		if len(events) == 0:
+			if os.path.exists(self.open_path): os.remove(self.open_path)
+			return
+		temp = self.open_path + '.tmp'
+		with open(temp, 'wb') as f:
+			f.write(b''.join(event.pack() for event in events))
+		os.replace(temp, self.open_path)
+
+	def read_open(self):
+		if self.open_path is None: return list()
+		try:
+			with open(self.open_path, 'rb') as f:
+				data = f.read()
+		except FileNotFoundError:
+			return list()
+		return [ Event.unpack_from(data, offset, provisional=True) for offset in range(0, len(data) - RECORD.size + 1, RECORD.size) ]
+
+	# События, пересекающиеся с [start, end], в порядке конца: из этого файла,
+	# <index>.long и незакрытые из <index>.open.
+	def query(self, start, end, kinds=None):
+		events = self.scan(start, end, kinds)
+		if self.long is not None: events += self.long.scan(start, end, kinds)
+		for event in self.read_open():
+			if event.start <= end and event.end >= start and (kinds is None or event.kind in kinds): events.append(event)
+		events.sort(key=lambda event: event.end)
+		return events
+
+	# Записи упорядочены по концу: поиск первой с концом не раньше start,
+	# дальше - пока конец не позже end + наибольшая длительность.
+	def scan(self, start, end, kinds=None):
+		count = len(self)
+		if count == 0: return list()
+		with mmap.mmap(self.file.fileno(), HEADER.size + count * RECORD.size, access=mmap.ACCESS_READ) as buffer:
+			end_at = lambda i: struct.unpack_from('<d', buffer, HEADER.size + i * RECORD.size + 8)[0]
+			low, high = 0, count
+			while low < high:
+				middle = (low + high) // 2
+				if end_at(middle) < start: low = middle + 1
+				else: high = middle
+			events = list()
+			for i in range(low, count):
+				event = Event.unpack_from(buffer, HEADER.size + i * RECORD.size)
+				if event.end > end + self.max_duration: break
+				if event.start > end: continue
+				if kinds is None or event.kind in kinds: events.append(event)
+			return events
+
+# Для CallCache: результат зависит только от аргументов
+def query(path, start, end, kinds=None):
+	with EventIndex(path) as index:
+		return index.query(start, end, kinds)
+
+# Потоковый детектор: по одному измерению, закрытые события копятся до flush(),
+# незакрытые при каждом flush() пишутся в <index>.open.
+# Событие выхода начинается с предыдущего измерения, как строка RRD
+# (значение относится к интервалу до момента измерения), и заканчивается
+# последним измерением за пределом.
+class Detector(object):
+	def __init__(self, index, gap=GAP):
+		super(Detector, self).__init__()
+		self.index = index
+		self.gap = gap
+		self.bounds = None # Границы ошибочных данных (низ, верх) или None
+		self.open = dict() # Вид события -> незакрытое Event
+		self.pending = list()
+		self.last_time = index.seen
+
+	def set_bounds(self, low, high):
+		self.bounds = None if low is None or high is None else (low, high)
+
+	def outside(self, value):
+		kinds = list()
+		if value < NOMINAL - BAND: kinds.append('band_low')
+		if value > NOMINAL + BAND: kinds.append('band_high')
+		if value < NOMINAL - LIMIT: kinds.append('limit_low')
+		if value > NOMINAL + LIMIT: kinds.append('limit_high')
+		if self.bounds is not None:
+			if value < self.bounds[0]: kinds.append('outlier_low')
+			if value > self.bounds[1]: kinds.append('outlier_high')
+		return kinds
+
+	def close(self, kind):
+		self.pending.append(self.open.pop(kind))
+
+	def add(self, timestamp, value):
+		if self.last_time is not None and timestamp <= self.last_time: return
+		if math.isnan(value): return
+		previous = self.last_time
+		if previous is not None and timestamp - previous > self.gap:
+			for kind in list(self.open.keys()): self.close(kind)
+			self.pending.append(Event('gap', previous, timestamp))
+			previous = None
+		start = timestamp if previous is None else previous
+		outside = self.outside(value)
+		for kind in list(self.open.keys()):
+			if kind not in outside: self.close(kind)
+		for kind in outside:
+			event = self.open.get(kind)
+			if event is None:
+				self.open[kind] = Event(kind, start, timestamp, timestamp, value)
+				continue
+			event.end = timestamp
+			if (value < event.peak) if kind.endswith('_low') else (value > event.peak):
+				event.peak_time, event.peak = timestamp, value
+		self.last_time = timestamp
+
+	# Закрытые события и, в конце, незакрытые (provisional) на момент сброса
+	def flush(self):
+		events, self.pending = self.pending, list()
+		provisional = [ Event(event.kind, event.start, event.end, event.peak_time, event.peak, provisional=True) for event in self.open.values() ]
+		self.index.append(events, self.last_time, provisional)
+		return events + provisional
+
+	# При остановке незакрытые события закрываются последним измерением
+	def finish(self):
+		for kind in list(self.open.keys()): self.close(kind)
+		return self.flush()
+
+def format_time(timestamp):
+	milliseconds = int(round(timestamp * 1000))
+	return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(milliseconds // 1000)) + '.{:03d}'.format(milliseconds % 1000)
+
+def format_event(event):
+	peak = '' if math.isnan(event.peak) else ', пик {:.4f} Hz в {}'.format(event.peak, format_time(event.peak_time))
+	return '{} .. {} ({:.3f} сек) {}{}{}'.format(
+		format_time(event.start), format_time(event.end), event.end - event.start, KIND_NAMES[event.kind], peak,
+		' (не закрыто)' if event.provisional else '')
+
+if __name__ == '__main__':
+	import attime
+	args = argparse.ArgumentParser()
+	args.add_argument('index', type=str,
+		help='Путь к индексу событий, обычно <rrd>.events')
+	commands = args.add_subparsers(dest='command', required=True)
+	command = commands.add_parser('add',
+		help='Обработать измерения "время:значение" со стандартного ввода, как для rrdtool update.')
+	command.add_argument('--low', dest='low', type=float, default=None,
+		help='Нижняя граница ошибочных данных, по умолчанию выбросы не ищутся')
+	command.add_argument('--high', dest='high', type=float, default=None,
+		help='Верхняя граница ошибочных данных, по умолчанию выбросы не ищутся')
+	command = commands.add_parser('list',
+		help='События за интервал.')
+	command.add_argument('--start', dest='start', type=str, default='end-1d',
+		help='Начало в формате AT-style, по умолчанию = end-1d')
+	command.add_argument('--end', dest='end', type=str, default='now',
+		help='Конец в формате AT-style, по умолчанию = now')
+	command.add_argument('--kind', dest='kinds', choices=KINDS, action='append', default=None,
+		help='Только события этого вида, можно несколько раз, по умолчанию - все')
+
+	args = args.parse_args()
+
+	if args.command == 'add':
+		with EventIndex(args.index, writable=True) as index:
+			detector = Detector(index)
+			detector.set_bounds(args.low, args.high)
+			for line in sys.stdin:
+				line = line.strip()
+				if len(line) == 0: continue
+				timestamp, value = line.split(':', 1)
+				detector.add(float(timestamp), math.nan if value == 'U' else float(value))
+			events = detector.finish()
+		print('Добавлено событий: {}'.format(len(events)), file=sys.stderr)
+	else:
+		window = attime.resolve_window(args.start, args.end)
+		if window is None: raise Exception('Неверный интервал: {!r} .. {!r}.'.format(args.start, args.end))
+		started = time.time()
+		with EventIndex(args.index) as index:
+			events = index.query(window[0], window[1], args.kinds)
+			total = len(index) + (len(index.long) if index.long is not None else 0)
+		for event in events:
+			print(format_event(event))
+		print('Событий: {} из {}, {:.3f} сек'.format(len(events), total, time.time() - started), file=sys.stderr)
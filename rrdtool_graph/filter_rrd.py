@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import argparse, math, sys
+from filter_xml import read_blacklist
+from rrd_file import RRDFile
+
+# Аналог dump -> filter_xml.py -> restore, но без пересборки файла:
+# строки всех RRA, время которых попадает в черный список, заполняются NaN
+# прямо в RRD-файле. Читаются и пишутся только затронутые страницы.
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	args.add_argument('rrd', type=str,
+		help='Путь к RRD-файлу, правится на месте.')
+	args.add_argument('blacklist', type=argparse.FileType('r'),
+		help='Черный список в формате filter_xml.py.')
+	args.add_argument('--dry-run', dest='dry_run', action='store_true',
+		help='Только вывести, какие строки будут затерты.')
+
+	args = args.parse_args()
+
+	index = read_blacklist(args.blacklist)
+
+	blacklisted = 0
+	with RRDFile(args.rrd, writable=not args.dry_run) as rrd:
+		rrd.lock()
+		for rra in rrd.rra:
+			rra_blacklisted = 0
+			for begin, end in index:
+				ages = rra.age_range(begin, end)
+				if ages is None: continue
+				for row_from, row_to in rra.row_spans(*ages):
+					if not args.dry_run: rrd.fill_rows(rra, row_from, row_to, math.nan)
+					rra_blacklisted += row_to - row_from
+			# Попадания - по строкам черного списка, пересекающиеся считаются в каждой
+			for j, (begin, end) in enumerate(index.intervals):
+				ages = rra.age_range(begin, end)
+				if ages is not None: index.hits[j] += ages[1] - ages[0] + 1
+			if rra_blacklisted > 0:
+				print('RRA #{} {} шаг {} сек: {} строк'.format(rra.index, rra.cf, rra.step, rra_blacklisted), file=sys.stderr)
+			blacklisted += rra_blacklisted
+
+	print('Blacklisted {} lines.'.format(blacklisted), file=sys.stderr)
+	for line in index.report():
+		print(line, file=sys.stderr)
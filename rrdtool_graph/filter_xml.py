@@ -1,45 +1,151 @@
 #!/usr/bin/env python3
-import argparse, re, sys
+import argparse, bisect, re, sys, time
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Строка данных из rrdtool dump:
+#   <!-- 2019-01-01 00:00:10 MSK / 1546290010 --> <row><v>5.0e+01</v></row>
+ROW_RE = re.compile(rb'/ ([0-9]+) -->([^\n]*?<row>)([^\n]*?)(</row>)')
+TIME_RE = re.compile(rb'/ ([0-9]+) -->[^\n]*?<row>')
+VALUE_RE = re.compile(rb'<v>[^<>]+</v>')
+
+# Отсортированные и слитые интервалы [begin, end], поиск за O(log n).
+# Попадания считаются по исходным интервалам (строкам черного списка):
+# intervals и hits - в исходном порядке, sources - какие исходные интервалы
+# вошли в слитый. Обратные интервалы (end < begin) пусты и в слияние не входят.
+class IntervalIndex(object):
+	def __init__(self, intervals, lines=None):
+		super(IntervalIndex, self).__init__()
+		self.intervals = [ (begin, end) for begin, end in intervals ]
+		self.lines = lines
+		merged = list()
+		nonempty = [ j for j, (begin, end) in enumerate(self.intervals) if begin <= end ]
+		for j in sorted(nonempty, key=lambda j: self.intervals[j]):
+			begin, end = self.intervals[j]
+			if len(merged) > 0 and begin <= merged[-1][1] + 1:
+				merged[-1][1] = max(merged[-1][1], end)
+				merged[-1][2].append(j)
+			else:
+				merged.append([begin, end, [ j ]])
+		self.begins = [ begin for begin, end, sources in merged ]
+		self.ends = [ end for begin, end, sources in merged ]
+		self.sources = [ sources for begin, end, sources in merged ]
+		self.hits = [ 0 ] * len(self.intervals)
+
+	def __len__(self):
+		return len(self.begins)
+
+	def __iter__(self):
+		return zip(self.begins, self.ends)
+
+	# Индекс интервала, содержащего time, или -1
+	def find(self, time):
+		i = bisect.bisect_right(self.begins, time) - 1
+		if i >= 0 and time <= self.ends[i]: return i
+		return -1
+
+	# Учесть попадание time в слитый интервал i во всех его исходных
+	def count(self, i, time):
+		for j in self.sources[i]:
+			if self.intervals[j][0] <= time <= self.intervals[j][1]: self.hits[j] += 1
+
+	# Исходные интервалы с номерами строк (если известны) и попаданиями
+	def report(self):
+		for j, ((begin, end), hits) in enumerate(zip(self.intervals, self.hits)):
+			line = '' if self.lines is None else 'строка {}: '.format(self.lines[j])
+			yield '{}{}:{}\t{}'.format(line, begin, end, hits)
+
+	# Индексы интервалов, пересекающихся с [begin, end]
+	def overlapping(self, begin, end):
+		i = max(bisect.bisect_right(self.begins, begin) - 1, 0)
+		while i < len(self.begins) and self.begins[i] <= end:
+			if self.ends[i] >= begin: yield i
+			i += 1
+
+def read_blacklist(blacklist):
+	intervals, lines = list(), list()
+	line_n = 0
+	while True:
+		line = blacklist.readline()
+		if line == '': break
+		line_n += 1
+		line = re.sub(r'#.*', '', line) # replace #comments
+		if line.strip() == '': continue
+		search = re.search(r'([0-9]+):([0-9]+)', line)
+		if search is None:
+			print('Не распознана строка черного списка: {!r}'.format(line.strip()), file=sys.stderr)
+			continue
+		begin, end = int(search.group(1)), int(search.group(2))
+		if end < begin:
+			print('Пропущен обратный интервал в строке {}: {}:{}'.format(line_n, begin, end), file=sys.stderr)
+			continue
+		intervals.append(( begin, end ))
+		lines.append(line_n)
+	return IntervalIndex(intervals, lines)
+
+def filter_stream(input_xml, output_xml, index, chunk_size=CHUNK_SIZE):
+	stats = dict(rows=0, blacklisted=0, bytes=0)
+
+	def filter_row(match):
+		stats['rows'] += 1
+		time = int(match.group(1))
+		i = index.find(time)
+		if i < 0: return match.group(0)
+		index.count(i, time)
+		stats['blacklisted'] += 1
+		return b''.join((
+			b'/ ', match.group(1), b' -->', match.group(2),
+			VALUE_RE.sub(b'<v> NaN </v>', match.group(3)), match.group(4),
+		))
+
+	def filter_chunk(chunk):
+		# Блоки без пересечений с черным списком пишутся как есть
+		times = list(map(int, TIME_RE.findall(chunk)))
+		if len(times) == 0 or next(index.overlapping(min(times), max(times)), None) is None:
+			stats['rows'] += len(times)
+			return chunk
+		return ROW_RE.sub(filter_row, chunk)
+
+	tail = b''
+	while True:
+		chunk = input_xml.read(chunk_size)
+		if len(chunk) == 0: break
+		stats['bytes'] += len(chunk)
+		chunk = tail + chunk
+		# Обрабатываются только целые строки, остаток ждет следующего блока
+		cut = chunk.rfind(b'\n') + 1
+		chunk, tail = chunk[:cut], chunk[cut:]
+		output_xml.write(filter_chunk(chunk))
+	if len(tail) > 0:
+		output_xml.write(filter_chunk(tail))
+
+	return stats
 
 if __name__ == '__main__':
 	args = argparse.ArgumentParser()
-	args.add_argument('input_xml', type=argparse.FileType('r'))
+	args.add_argument('input_xml', type=argparse.FileType('rb'))
 	args.add_argument('blacklist', type=argparse.FileType('r'))
-	args.add_argument('output_xml', type=argparse.FileType('w'))
+	args.add_argument('output_xml', type=argparse.FileType('wb'))
+	args.add_argument('--chunk', dest='chunk', type=int, default=CHUNK_SIZE,
+		help='Размер блока чтения в байтах, по умолчанию = {}'.format(CHUNK_SIZE))
+	args.add_argument('--stats', dest='stats', action='store_true',
+		help='Вывести скорость обработки и число попаданий по каждой строке черного списка.')
 
 	args = args.parse_args()
 
-	blacklist = list()
+	index = read_blacklist(args.blacklist)
 
-	while True:
-		line = args.blacklist.readline()
-		if line == '': break
-		try:
-			line = re.sub(r'#.*', '', line) # replace #comments
-			search = re.search(r'([0-9]+):([0-9]+)', line)
-			blacklist.append(( int(search.group(1)), int(search.group(2)) ))
-		except Exception as e:
-			print(e)
-
-	blacklisted = 0
-	while True:
-		line = args.input_xml.readline()
-		if line == '': break
-		try:
-			search_time = re.search(r' / ([0-9]+) -->', line)
-			if search_time is not None:
-				time = int(search_time .group(1))
-				time_blacklisted = False
-				for begin, end in blacklist:
-					if begin <= time and time <= end: 
-						# print('Blacklisting {} for {}:{}'.format(time, begin, end))
-						time_blacklisted = True
-						break
-				if time_blacklisted:
-					blacklisted += 1
-					line = re.sub(r'<v>[^<>]+</v>', r'<v> NaN </v>', line)
-		except Exception as e:
-			print(e)
-		args.output_xml.write(line)
-
-	print('Blacklisted {} lines.'.format(blacklisted), file=sys.stderr)
+	time_start = time.monotonic()
+	stats = filter_stream(args.input_xml, args.output_xml, index, chunk_size=args.chunk)
+	args.output_xml.flush()
+	elapsed = max(time.monotonic() - time_start, 1e-9)
+
+	print('Blacklisted {} lines.'.format(stats['blacklisted']), file=sys.stderr)
+
+	if args.stats:
+		print('Интервалов: {} (после слияния {}), строк: {}, за {:.3f} сек: {:.0f} строк/сек, {:.1f} МиБ/сек'.format(
+			len(index.intervals), len(index), stats['rows'], elapsed,
+			stats['rows'] / elapsed, stats['bytes'] / elapsed / 1024 / 1024,
+		), file=sys.stderr)
+		for line in index.report():
+			print(line, file=sys.stderr)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+from lib import *
+import numpy
+from rrd_file import RRDFile
+
+# Соответствие ГОСТ 32144-2013 4.2.1 по неделям или месяцам: доля времени
+# в пределах ±0.2 Hz (нужно не менее 95%) и ±0.4 Hz (нужно 100%).
+# RRD читается кусками не более --chunk строк, поэтому память не зависит
+# от длины интервала. С --state состояние сохраняется, и повторный запуск
+# обрабатывает только строки, появившиеся с прошлого раза.
+
+NOMINAL = 50.0
+BANDS = ((0.2, 95.0), (0.4, 100.0)) # (отклонение, требуемая доля времени в %)
+STATE_VERSION = 1
+
+def period_bounds(timestamp, period):
+	tm = time.localtime(timestamp)
+	if period == 'week':
+		day = tm.tm_mday - tm.tm_wday
+		begin = int(time.mktime((tm.tm_year, tm.tm_mon, day, 0, 0, 0, 0, 0, -1)))
+		end = int(time.mktime((tm.tm_year, tm.tm_mon, day + 7, 0, 0, 0, 0, 0, -1)))
+		key = time.strftime('%G-W%V', time.localtime(begin))
+	else:
+		begin = int(time.mktime((tm.tm_year, tm.tm_mon, 1, 0, 0, 0, 0, 0, -1)))
+		end = int(time.mktime((tm.tm_year, tm.tm_mon + 1, 1, 0, 0, 0, 0, 0, -1)))
+		key = time.strftime('%Y-%m', time.localtime(begin))
+	return key, begin, end
+
+# Накопленная статистика одного периода, все длительности в секундах.
+# Выход за полосу считается по AVERAGE (10-секундное среднее, как в ГОСТ),
+# дополнительно - по огибающей MIN/MAX, то есть с учетом худших значений.
+class PeriodStats(object):
+	def __init__(self, key, begin, end):
+		super(PeriodStats, self).__init__()
+		self.key = key
+		self.begin = begin
+		self.end = end
+		self.processed = 0
+		self.known = 0
+		self.envelope_known = 0
+		self.inside = [ 0 for band in BANDS ]
+		self.envelope_inside = [ 0 for band in BANDS ]
+		self.longest = [ 0 for band in BANDS ]
+		self.longest_start = [ None for band in BANDS ]
+		self.run = [ None for band in BANDS ] # Незакрытый выход за полосу: [начало, длительность]
+		self.run_end = None
+		self.sum = 0.0
+		self.min = None
+		self.max = None
+
+	@classmethod
+	def from_dict(cls, data):
+		stats = cls(data['key'], data['begin'], data['end'])
+		stats.__dict__.update(data)
+		return stats
+
+	def to_dict(self):
+		return dict(self.__dict__)
+
+	def track_runs(self, i, t0, step, outside):
+		padded = numpy.concatenate(([ False ], outside, [ False ]))
+		edges = numpy.flatnonzero(padded[1:] != padded[:-1])
+		begins, ends = edges[0::2], edges[1::2]
+		if len(begins) == 0:
+			self.run[i] = None
+			return
+		lengths = (ends - begins) * step
+		starts = t0 + begins * step
+		# Выход, начатый в прошлом куске, продолжается
+		if self.run[i] is not None and begins[0] == 0 and self.run_end == t0:
+			lengths[0] += self.run[i][1]
+			starts[0] = self.run[i][0]
+		k = int(numpy.argmax(lengths))
+		if lengths[k] > self.longest[i]:
+			self.longest[i] = int(lengths[k])
+			self.longest_start[i] = int(starts[k])
+		self.run[i] = [ int(starts[-1]), int(lengths[-1]) ] if ends[-1] == len(outside) else None
+
+	# Строки подряд с шагом step, первая начинается в t0
+	def update(self, t0, step, avg, r_min, r_max):
+		known = ~numpy.isnan(avg)
+		envelope_known = ~numpy.isnan(r_min) & ~numpy.isnan(r_max)
+		self.processed += len(avg) * step
+		self.known += int(known.sum()) * step
+		self.envelope_known += int(envelope_known.sum()) * step
+		if known.any(): self.sum += float(avg[known].sum()) * step
+		with numpy.errstate(invalid='ignore'):
+			for i, (band, share) in enumerate(BANDS):
+				low, high = NOMINAL - band, NOMINAL + band
+				inside = known & (avg >= low) & (avg <= high)
+				self.inside[i] += int(inside.sum()) * step
+				self.envelope_inside[i] += int((envelope_known & (r_min >= low) & (r_max <= high)).sum()) * step
+				self.track_runs(i, t0, step, known & ~inside)
+		if envelope_known.any():
+			r_min_min, r_max_max = float(numpy.nanmin(r_min[envelope_known])), float(numpy.nanmax(r_max[envelope_known]))
+			self.min = r_min_min if self.min is None else min(self.min, r_min_min)
+			self.max = r_max_max if self.max is None else max(self.max, r_max_max)
+		self.run_end = t0 + len(avg) * step
+
+	def result(self, until):
+		elapsed = max(min(self.end, until) - self.begin, 1)
+		bands = list()
+		for i, (band, share) in enumerate(BANDS):
+			longest_start = self.longest_start[i]
+			bands.append(dict(
+				band=band, required=share,
+				share=100.0 * self.inside[i] / self.known if self.known > 0 else None,
+				envelope_share=100.0 * self.envelope_inside[i] / self.envelope_known if self.envelope_known > 0 else None,
+				longest=self.longest[i],
+				longest_start=longest_start,
+				longest_end=longest_start + self.longest[i] if longest_start is not None else None,
+			))
+		if self.known > 0: complies = all(band['share'] >= band['required'] for band in bands)
+		else: complies = None
+		return dict(
+			period=self.key, begin=self.begin, end=self.end, complete=until >= self.end,
+			coverage=100.0 * self.known / elapsed,
+			mean=self.sum / self.known if self.known > 0 else None,
+			min=self.min, max=self.max,
+			bands=bands, complies=complies,
+		)
+
+class Report(object):
+	def __init__(self, rrd_path, period):
+		super(Report, self).__init__()
+		self.rrd_path = os.path.abspath(rrd_path)
+		self.period = period
+		self.next = None # Начало первой необработанной строки
+		self.periods = list()
+
+	def load(self, path):
+		with open(path, 'r') as f:
+			data = json.load(f)
+		if data.get('version') != STATE_VERSION:
+			raise Exception('Неизвестная версия состояния в {!r}.'.format(path))
+		if data['rrd'] != self.rrd_path or data['period'] != self.period:
+			raise Exception('Состояние {!r} сохранено для {} по периодам {}.'.format(path, data['rrd'], data['period']))
+		self.next = data['next']
+		self.periods = [ PeriodStats.from_dict(stats) for stats in data['periods'] ]
+
+	def save(self, path):
+		data = dict(
+			version=STATE_VERSION, rrd=self.rrd_path, period=self.period, next=self.next,
+			periods=[ stats.to_dict() for stats in self.periods ],
+		)
+		temp = path + '.tmp'
+		with open(temp, 'w') as f:
+			json.dump(data, f)
+		os.replace(temp, path)
+
+	def period_stats(self, timestamp):
+		if len(self.periods) > 0 and self.periods[-1].begin <= timestamp < self.periods[-1].end:
+			return self.periods[-1]
+		stats = PeriodStats(*period_bounds(timestamp, self.period))
+		self.periods.append(stats)
+		return stats
+
+	# Для каждого куска - самый подробный RRA, который его покрывает,
+	# MIN и MAX берутся из RRA с тем же шагом.
+	def process(self, rrd, until, chunk_rows):
+		rows_read = 0
+		while self.next < until:
+			t = self.next
+			stats = self.period_stats(t)
+			rra = rrd.choose_rra('AVERAGE', t, min(stats.end, until), rrd.pdp_step)
+			chunk_end = min(stats.end, until, t + chunk_rows * rra.step)
+			# Кусок заканчивается там, где начинается более подробный RRA
+			for other in rrd.rra:
+				cal_start = other.first_row_time - other.step
+				if other.cf == 'AVERAGE' and other.step < rra.step and t < cal_start < chunk_end:
+					chunk_end = cal_start
+			start, step, avg = rrd.fetch_rra(rra, t, chunk_end)
+			envelope = list()
+			for cf in ('MIN', 'MAX'):
+				same = [ other for other in rrd.rra if other.cf == cf and other.step == step ]
+				if len(same) > 0: envelope.append(rrd.fetch_rra(same[0], t, chunk_end)[2])
+				else: envelope.append(numpy.full(len(avg), numpy.nan))
+			# Строка, начавшаяся до t, уже учтена в прошлом куске
+			skip = 1 if start < t else 0
+			if len(avg) > skip:
+				stats.update(start + skip * step, step, avg[skip:], envelope[0][skip:], envelope[1][skip:])
+				rows_read += len(avg) - skip
+			self.next = start + len(avg) * step
+		return rows_read
+
+	def results(self):
+		return [ stats.result(self.next) for stats in self.periods ]
+
+def data_range(rrd):
+	archives = [ rra for rra in rrd.rra if rra.cf == 'AVERAGE' ]
+	if len(archives) == 0: raise Exception('В {!r} нет AVERAGE RRA.'.format(rrd.path))
+	oldest = min(rra.first_row_time - rra.step for rra in archives)
+	# Строки cur_row закончены, новее них данных нет
+	newest = min(archives, key=lambda rra: rra.step).last_row_time
+	return oldest, newest
+
+def format_seconds(seconds):
+	return humanize_time(seconds) if seconds > 0 else '-'
+
+def format_share(value):
+	return '{:7.3f}%'.format(value) if value is not None else '      -'
+
+def print_results(results):
+	for result in results:
+		verdict = { True: 'соответствует', False: 'НЕ соответствует', None: 'нет данных' }[result['complies']]
+		if not result['complete']: verdict += ' (период не завершен)'
+		print('{} {} .. {}: {}, покрытие {:.1f}%'.format(
+			result['period'],
+			time.strftime('%Y-%m-%d', time.localtime(result['begin'])),
+			time.strftime('%Y-%m-%d', time.localtime(result['end'] - 1)),
+			verdict, result['coverage']))
+		for band in result['bands']:
+			print('\t±{} Hz: {} (огибающая {}, нужно {:.0f}%), наиб. выход {}'.format(
+				band['band'], format_share(band['share']), format_share(band['envelope_share']),
+				band['required'], format_seconds(band['longest'])))
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	args.add_argument('rrd', type=argtype_file,
+		help='Путь к RRD-файлу.')
+	args.add_argument('--period', dest='period', choices=('week', 'month'), default='week',
+		help='По каким периодам считать, по умолчанию = week')
+	args.add_argument('--start', dest='start', type=int, default=None,
+		help='С какого времени (секунды эпохи) начинать, если нет сохраненного состояния, по умолчанию - с самых старых данных')
+	args.add_argument('--state', dest='state', type=str, default=None,
+		help='Файл состояния для инкрементального пересчета.')
+	args.add_argument('--chunk', dest='chunk', type=int, default=8640,
+		help='Сколько строк читать за раз, по умолчанию = 8640')
+	args.add_argument('--json', dest='json', action='store_true',
+		help='Вывести результат в JSON.')
+
+	args = args.parse_args()
+
+	report = Report(args.rrd, args.period)
+	if args.state is not None and os.path.exists(args.state):
+		report.load(args.state)
+
+	with RRDFile(args.rrd) as rrd:
+		oldest, newest = data_range(rrd)
+		if report.next is None: report.next = args.start if args.start is not None else oldest
+		rows_read = report.process(rrd, newest, args.chunk)
+
+	print('Обработано строк: {}, данные до {}'.format(rows_read, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(report.next))), file=sys.stderr)
+	if args.state is not None: report.save(args.state)
+
+	if args.json:
+		json.dump(report.results(), sys.stdout, indent='\t')
+		print()
+	else:
+		print_results(report.results())
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+from lib import *
+import signal, collections
+from batch_graph import parse_manifest, mk_graph
+
+# Демон перерисовки графиков из манифеста batch_graph.py. Вместо рендера всех
+# графиков по расписанию раз в --interval секунд проверяет, изменилось ли что-то,
+# что видно на картинке:
+#   - данные дошли до следующего столбца пикселей: последнее обновление RRD
+#     (всех датчиков) // (ширина интервала / 960);
+#   - изменились входы: строка задачи в манифесте или файлы --input
+#     (например, черный список filter_rrd.py);
+#   - изображения нет.
+# Изменившиеся задачи встают в очередь, рендеры идут по одному с паузой
+# --spacing между ними, чтобы не нагружать CPU всплесками. Годовой график при
+# этом перерисовывается раз в ~9 часов, а не на каждом проходе.
+#
+# Состояние задач и счетчики (очередь, рендеры, пропуски, ошибки) пишутся в
+# --status (JSON), с ним же перезапуск демона не перерисовывает все заново.
+
+STATUS_VERSION = 1
+
+class Job(object):
+	def __init__(self, spec):
+		super(Job, self).__init__()
+		self.spec = spec
+		self.image = spec[1]
+		self.state = None # Отпечаток последнего удачного рендера
+		self.renders = 0
+		self.skipped = 0
+		self.failed = 0
+		self.last_render = None
+		self.last_duration = None
+		self.last_returncode = None
+
+	def to_dict(self):
+		return dict(
+			graph=self.spec[0], image=self.image, state=self.state, renders=self.renders, skipped=self.skipped,
+			failed=self.failed, last_render=self.last_render, last_duration=self.last_duration,
+			last_returncode=self.last_returncode,
+		)
+
+class Scheduler(object):
+	def __init__(self, args):
+		super(Scheduler, self).__init__()
+		self.args = args
+		self.jobs = list()
+		self.queue = collections.deque()
+		self.queued = dict() # Изображение -> отпечаток, с которым задача встала в очередь
+		self.checks = 0
+		self.started = time.time()
+		self.load_manifest()
+		self.load_status()
+
+	def load_manifest(self):
+		with open(self.args.manifest, 'r') as f:
+			specs = parse_manifest(f)
+		old = { job.image: job for job in self.jobs }
+		self.jobs = list()
+		for spec in specs:
+			# Измененная строка задачи меняет отпечаток, и график перерисуется
+			job = old.get(spec[1])
+			if job is None: job = Job(spec)
+			job.spec = spec
+			self.jobs.append(job)
+		self.manifest_mtime = os.stat(self.args.manifest).st_mtime_ns
+
+	def load_status(self):
+		if self.args.status is None or not os.path.exists(self.args.status): return
+		try:
+			with open(self.args.status, 'r') as f:
+				status = json.load(f)
+		except (OSError, ValueError) as e:
+			print('Состояние {} не прочитано: {}'.format(self.args.status, e), file=sys.stderr)
+			return
+		if status.get('version') != STATUS_VERSION: return
+		saved = { job['image']: job for job in status.get('jobs', []) }
+		for job in self.jobs:
+			if job.image in saved: job.state = saved[job.image].get('state')
+
+	def save_status(self):
+		if self.args.status is None: return
+		status = dict(
+			version=STATUS_VERSION, time=int(time.time()), uptime=int(time.time() - self.started), checks=self.checks,
+			queue=len(self.queue), renders=sum(job.renders for job in self.jobs),
+			skipped=sum(job.skipped for job in self.jobs), failed=sum(job.failed for job in self.jobs),
+			jobs=[ job.to_dict() for job in self.jobs ],
+		)
+		temp = self.args.status + '.tmp'
+		with open(temp, 'w') as f:
+			json.dump(status, f, indent='\t', ensure_ascii=False)
+		os.replace(temp, self.args.status)
+
+	def inputs_state(self):
+		inputs = list()
+		for path in self.args.inputs or []:
+			try:
+				stat = os.stat(path)
+				inputs.append([ path, stat.st_mtime_ns, stat.st_size ])
+			except OSError:
+				inputs.append([ path, None, None ])
+		return inputs
+
+	# Отпечаток всего, от чего зависит картинка задачи, с точностью до пикселя
+	def job_state(self, job, cache, inputs):
+		graph = mk_graph(job.spec, self.args.rrd)
+		graph.shared_cache = cache
+		start, end = graph.get_schedule_window()
+		pixel = max((end - start) // 960, 1)
+		last_update = max(graph.shared(detect_last_update, rrd) for label, rrd in graph.arg_sensors)
+		return dict(
+			spec=hashlib.sha1(json.dumps(job.spec).encode('utf-8')).hexdigest(),
+			column=min(end, last_update) // pixel, pixel=pixel, inputs=inputs,
+		)
+
+	def check(self):
+		self.checks += 1
+		if os.stat(self.args.manifest).st_mtime_ns != self.manifest_mtime:
+			print('Манифест изменился, перечитываю', file=sys.stderr)
+			self.load_manifest()
+		cache = CallCache()
+		inputs = self.inputs_state()
+		added = 0
+		for job in self.jobs:
+			try:
+				state = self.job_state(job, cache, inputs)
+			except Exception as e:
+				print('{}: ошибка проверки: {!r}'.format(job.image, e), file=sys.stderr)
+				continue
+			if job.image in self.queued:
+				self.queued[job.image] = state
+			elif state == job.state and os.path.exists(job.image):
+				job.skipped += 1
+			else:
+				self.queued[job.image] = state
+				self.queue.append(job)
+				added += 1
+		if added > 0:
+			print('Проверка {}: в очередь {}, в очереди {}, пропущено всего {}'.format(
+				self.checks, added, len(self.queue), sum(job.skipped for job in self.jobs)), file=sys.stderr)
+
+	def render(self, job):
+		state = self.queued.pop(job.image)
+		started = time.time()
+		try:
+			graph = mk_graph(job.spec, self.args.rrd)
+			# Вывод rrdtool graph (размеры, PRINT) не нужен
+			with contextlib.redirect_stdout(sys.stderr):
+				status = graph.produce()
+			returncode = status.returncode
+		except Exception as e:
+			print('{}: ошибка: {!r}'.format(job.image, e), file=sys.stderr)
+			returncode = None
+		job.last_render = int(started)
+		job.last_duration = time.time() - started
+		job.last_returncode = returncode
+		if returncode == 0:
+			job.renders += 1
+			job.state = state
+		else:
+			job.failed += 1
+		print('{}: код {}, {:.2f} сек, в очереди {}'.format(job.image, returncode, job.last_duration, len(self.queue)), file=sys.stderr)
+
+	def run(self):
+		while True:
+			next_check = time.time() + self.args.interval
+			self.check()
+			self.save_status()
+			# Рендеры до следующей проверки, по одному, с паузой между ними
+			while len(self.queue) > 0 and time.time() < next_check:
+				self.render(self.queue.popleft())
+				self.save_status()
+				time.sleep(max(min(self.args.spacing, next_check - time.time()), 0))
+			if self.args.once and len(self.queue) == 0: return
+			time.sleep(max(next_check - time.time(), 0))
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	args.add_argument('rrd', type=argtype_file,
+		help='Путь к RRD-файлу.')
+	args.add_argument('manifest', type=str,
+		help='Путь к манифесту задач (как у batch_graph.py), перечитывается при изменении.')
+	args.add_argument('--interval', dest='interval', type=float, default=60,
+		help='Как часто проверять задачи, в секундах, по умолчанию = 60')
+	args.add_argument('--spacing', dest='spacing', type=float, default=5,
+		help='Пауза между рендерами в секундах, по умолчанию = 5')
+	args.add_argument('--input', dest='inputs', type=str, action='append', default=None,
+		help='Файл, при изменении которого перерисовываются все графики (например, черный список), можно несколько раз')
+	args.add_argument('--status', dest='status', type=str, default=None,
+		help='Файл состояния и счетчиков (JSON), по умолчанию не ведется')
+	args.add_argument('--once', dest='once', action='store_true',
+		help='Одна проверка и рендер очереди, затем выход.')
+	args = args.parse_args()
+
+	# SIGTERM от init.d - как Ctrl+C: состояние уже сохранено после каждого рендера
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		Scheduler(args).run()
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+from lib import *
+import asyncio, tempfile, urllib.parse
+from batch_graph import GRAPHS
+
+# HTTP-сервер графиков: GET /<тип графика>.png?<опции> рендерит график, как
+# <тип>_graph.py <rrd> <изображение> --<опция> <значение> ..., например:
+#   /normal.png?start=end-7d&trend=3600
+#   /overlap.png?width=86400&depth=7&engine=fold
+# Флаги (--compat) задаются как compat=1.
+#
+# Одинаковые запросы, пришедшие во время рендера, получают результат того же
+# рендера. Одновременно выполняется не более --renders рендеров.
+# Способ вызова rrdtool (--backend) задается при запуске сервера и один на все
+# рендеры: auto при нескольких --renders - пул 'rrdtool -', а не librrd, вызовы
+# которой идут по очереди.
+
+# Эти опции задаются только при запуске сервера (--timing и --profile пишут в файлы,
+# --sensor и --events открыли бы любой файл)
+SERVER_OPTIONS = ('--cmd', '--cache', '--cache-size', '--stats', '--events', '--timing', '--profile', '--backend', '--sensor', '--label')
+
+CHUNK_SIZE = 64 * 1024
+
+class RequestError(Exception):
+	def __init__(self, status, message):
+		super(RequestError, self).__init__(message)
+		self.status = status
+
+REASONS = { 200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error' }
+
+class GraphServer(object):
+	def __init__(self, args):
+		super(GraphServer, self).__init__()
+		self.args = args
+		self.semaphore = asyncio.Semaphore(max(args.renders, 1))
+		self.in_flight = dict() # Ключ запроса -> Task рендера
+		self.renders = 0
+		self.coalesced = 0
+
+	# Опции графика из строки запроса, в порядке ключей - чтобы одинаковые
+	# запросы с разным порядком параметров давали один ключ.
+	def mk_options(self, name, query):
+		graph = GRAPHS[name]()
+		graph.init_argparse()
+		actions = { option: action for action in graph.argparse._actions for option in action.option_strings }
+		options = list()
+		for key, value in sorted(urllib.parse.parse_qsl(query, keep_blank_values=True)):
+			option = '--' + key.replace('_', '-')
+			if option not in actions or option in SERVER_OPTIONS or option in ('-h', '--help'):
+				raise RequestError(400, 'Неизвестная опция: {}'.format(key))
+			if actions[option].nargs == 0:
+				if value.lower() in ('', '1', 'true', 'yes'): options.append(option)
+				elif value.lower() not in ('0', 'false', 'no'): raise RequestError(400, 'Флаг {}: {!r}'.format(key, value))
+			else:
+				# Одним словом: значение, начинающееся с '-', не станет опцией
+				options.append('{}={}'.format(option, value))
+		return options
+
+	def mk_server_options(self, graph):
+		options = list()
+		if self.args.cache is not None: options += [ '--cache', self.args.cache, '--cache-size', str(self.args.cache_size) ]
+		if self.args.stats is not None: options += [ '--stats', self.args.stats ]
+		if self.args.events is not None: options += [ '--events', self.args.events ]
+		options += [ '--backend', rrd_backend().name ]
+		# Остальные датчики - только тем графикам, что умеют рисовать несколько
+		if graph.multi_sensor:
+			if self.args.label is not None: options += [ '--label', self.args.label ]
+			for sensor in self.args.sensors or []: options += [ '--sensor', sensor ]
+		return options
+
+	def render_sync(self, name, options):
+		fd, image = tempfile.mkstemp(prefix='graph_server_', suffix='.png')
+		os.close(fd)
+		try:
+			graph = GRAPHS[name]()
+			try:
+				graph.setup([ self.args.rrd, image ] + options + self.mk_server_options(graph))
+			except SystemExit:
+				raise RequestError(400, 'Неверные опции: {}'.format(' '.join(options)))
+			status = graph.produce()
+			if status.returncode != 0:
+				raise RequestError(500, 'rrdtool завершился с кодом {}'.format(status.returncode))
+			with open(image, 'rb') as f:
+				return f.read()
+		finally:
+			os.unlink(image)
+
+	async def render(self, name, options):
+		async with self.semaphore:
+			self.renders += 1
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(None, self.render_sync, name, options)
+
+	async def get_image(self, name, options):
+		key = (name, tuple(options))
+		task = self.in_flight.get(key)
+		if task is None:
+			task = asyncio.ensure_future(self.render(name, options))
+			self.in_flight[key] = task
+			task.add_done_callback(lambda task: self.in_flight.pop(key, None))
+		else:
+			self.coalesced += 1
+		# shield: отключение одного клиента не отменяет рендер для остальных
+		return await asyncio.shield(task)
+
+	async def respond(self, writer, status, content_type, body, head=False):
+		writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n'.format(
+			status, REASONS.get(status, ''), content_type, len(body)).encode('ascii'))
+		if not head:
+			for offset in range(0, len(body), CHUNK_SIZE):
+				writer.write(body[offset:offset + CHUNK_SIZE])
+				await writer.drain()
+		await writer.drain()
+
+	def mk_index(self):
+		lines = [ 'Графики: /<тип>.png?<опция>=<значение>&...', '' ]
+		for name in GRAPHS.keys():
+			graph = GRAPHS[name]()
+			graph.init_argparse()
+			options = sorted(set(option[2:] for action in graph.argparse._actions for option in action.option_strings
+				if option.startswith('--') and option not in SERVER_OPTIONS and option != '--help'))
+			lines.append('/{}.png: {}'.format(name, ', '.join(options)))
+		lines += [ '', 'Рендеров: {}, объединено запросов: {}, сейчас выполняется: {}'.format(
+			self.renders, self.coalesced, len(self.in_flight)) ]
+		return ('\n'.join(lines) + '\n').encode('utf-8')
+
+	async def handle(self, reader, writer):
+		head = False
+		try:
+			request_line = (await reader.readline()).decode('latin-1').strip()
+			while True:
+				header = await reader.readline()
+				if header in (b'\r\n', b'\n', b''): break
+			parts = request_line.split()
+			if len(parts) != 3: raise RequestError(400, 'Неверный запрос')
+			method, target = parts[0], urllib.parse.urlsplit(parts[1])
+			if method not in ('GET', 'HEAD'): raise RequestError(405, 'Только GET и HEAD')
+			head = method == 'HEAD'
+			path = target.path.strip('/')
+			if path == '':
+				await self.respond(writer, 200, 'text/plain; charset=utf-8', self.mk_index(), head)
+				return
+			name = path[:-4] if path.endswith('.png') else path
+			if name not in GRAPHS: raise RequestError(404, 'Нет графика {!r}'.format(path))
+			options = self.mk_options(name, target.query)
+			started = time.time()
+			image = await self.get_image(name, options)
+			print('{} {} - {} байт, {:.2f} сек'.format(method, parts[1], len(image), time.time() - started), file=sys.stderr)
+			await self.respond(writer, 200, 'image/png', image, head)
+		except RequestError as e:
+			print('{} - {}'.format(e.status, e), file=sys.stderr)
+			await self.respond(writer, e.status, 'text/plain; charset=utf-8', (str(e) + '\n').encode('utf-8'), head)
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		except Exception as e:
+			print('Ошибка: {!r}'.format(e), file=sys.stderr)
+			await self.respond(writer, 500, 'text/plain; charset=utf-8', (repr(e) + '\n').encode('utf-8'), head)
+		finally:
+			try:
+				writer.close()
+				await writer.wait_closed()
+			except ConnectionError:
+				pass
+
+	async def run(self):
+		server = await asyncio.start_server(self.handle, self.args.host, self.args.port)
+		print('Слушаю {}:{}'.format(self.args.host, self.args.port), file=sys.stderr)
+		async with server:
+			await server.serve_forever()
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	args.add_argument('rrd', type=argtype_file,
+		help='Путь к RRD-файлу.')
+	args.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+		help='Адрес, по умолчанию = 127.0.0.1')
+	args.add_argument('--port', dest='port', type=int, default=8080,
+		help='Порт, по умолчанию = 8080')
+	args.add_argument('--renders', dest='renders', type=int, default=2,
+		help='Наибольшее число одновременных рендеров, по умолчанию = 2')
+	args.add_argument('--backend', dest='backend', choices=BACKENDS, default=None,
+		help='Как вызывать rrdtool (см. --backend графиков); auto для нескольких --renders - pipe, '
+			'по умолчанию = $RRDTOOL_BACKEND или auto')
+	args.add_argument('--cache', dest='cache', type=str, default=None,
+		help='Каталог кэша готовых изображений, по умолчанию кэш не используется')
+	args.add_argument('--cache-size', dest='cache_size', type=float, default=64.0,
+		help='Наибольший размер кэша в МиБ, по умолчанию = 64')
+	args.add_argument('--stats', dest='stats', type=str, default=None,
+		help='Каталог статистики (stats_store.py), передается графикам')
+	args.add_argument('--events', dest='events', type=str, default=None,
+		help='Индекс событий (event_index.py), передается графикам')
+	args.add_argument('--label', dest='label', type=str, default=None,
+		help='Метка датчика из rrd, по умолчанию - имя файла без расширения')
+	args.add_argument('--sensor', dest='sensors', type=str, action='append', default=None,
+		help='Еще один датчик, МЕТКА=RRD, можно несколько раз; передается графикам, которые их поддерживают')
+
+	args = args.parse_args()
+	backend = select_threaded_backend(args.backend, max(args.renders, 1))
+	print('rrdtool: {}'.format(backend.name), file=sys.stderr)
+	try:
+		asyncio.run(GraphServer(args).run())
+	except KeyboardInterrupt:
+		pass
@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
-import sys, os, io, re, pathlib, subprocess, argparse
+import sys, os, re, math, time, json, queue, atexit, shutil, hashlib, pathlib, subprocess, argparse, threading, resource, contextlib
+import concurrent.futures
+import xml.etree.ElementTree
+import stats_store
+import event_index
+import rpn
 
 LENGTH_MINUTE = 60
 LENGTH_HOUR = LENGTH_MINUTE * 60
@@ -167,6 +172,16 @@ def argtype_file(str_path):
 	# if not os.access(path, os.R_OK): raise argparse.ArgumentTypeError('Нет права на чтение {!r}.'.format(str(path)))
 	return str(path)
 
+# Датчик для --sensor: МЕТКА=RRD
+def argtype_sensor(str_arg):
+	label, sep, path = str_arg.partition('=')
+	if sep == '' or len(label) == 0:
+		raise argparse.ArgumentTypeError('Ожидается МЕТКА=RRD, получено {!r}.'.format(str_arg))
+	return label, argtype_file(path)
+
+def sensor_label(path):
+	return os.path.splitext(os.path.basename(path))[0]
+
 def argtype_value_or_scale(str_arg):
 	if str_arg == 'auto':
 		return ( 'auto', None )
@@ -175,39 +190,133 @@ def argtype_value_or_scale(str_arg):
 	else:
 		return ( 'value', int(str_arg) )
 
-def detect_length(arg_rrd, arg_start, arg_end):
+def detect_window(arg_rrd, arg_start, arg_end):
+	import attime
+	window = attime.resolve_window(arg_start, arg_end)
+	if window is not None: return window
+	return detect_window_rrdtool(arg_rrd, arg_start, arg_end)
+
+def detect_window_rrdtool(arg_rrd, arg_start, arg_end):
 	cmdline = [
-		'rrdtool', 'graphv', os.devnull,
+		os.devnull,
 		'--start', arg_start, '--end', arg_end,
 		'--width', '256', '--height', '128', '--full-size-mode',
 		'DEF:dummy={}:freq:AVERAGE'.format(arg_rrd),
 		'VDEF:global_dummy=dummy,AVERAGE',
 		'GPRINT:global_dummy:%3.4lf'
 	]
-	process = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=sys.stdout)
-
-	time_start = -1
-	time_end = -1
-
-	stdout = io.TextIOWrapper(process.stdout)
-	while True:
-		line = stdout.readline().strip()
-		if len(line) == 0: break
-		try:
-			time_start = int(re.match(r'graph_start = ([0-9]+)', line).group(1))
-		except Exception: pass
-		try:
-			time_end = int(re.match(r'graph_end = ([0-9]+)', line).group(1))
-		except Exception: pass
+	info = rrd_backend().graphv(cmdline)
+	time_start = info.get('graph_start', -1)
+	time_end = info.get('graph_end', -1)
 
 	if time_start < 0: raise Exception('Не обнаружен \'graph_start\' в \'{!r}\'.'.format(cmdline))
 	if time_end < 0: raise Exception('Не обнаружен \'graph_end\' в \'{!r}\'.'.format(cmdline))
 
-	time = time_end - time_start
-	if time < 0: raise Exception('\'graph_end\' ({}) < \'graph_start\' ({})!'.format(time_end, time_start))
+	if time_end < time_start: raise Exception('\'graph_end\' ({}) < \'graph_start\' ({})!'.format(time_end, time_start))
+
+	return time_start, time_end
+
+def detect_length(arg_rrd, arg_start, arg_end):
+	time_start, time_end = detect_window(arg_rrd, arg_start, arg_end)
+	length = time_end - time_start
+	print('Обнаружена длина периода: {} сек'.format(length), file=sys.stderr)
+	return length
+
+# Время последнего обновления RRD: из заголовка файла, либо через rrdtool last,
+# если файл создан на другой архитектуре.
+def detect_last_update(arg_rrd):
+	try:
+		from rrd_file import RRDFile
+		with RRDFile(arg_rrd) as rrd:
+			return rrd.last_up
+	except Exception:
+		return rrd_backend().last(arg_rrd)
+
+DEF_RE = re.compile(r'^DEF:([\w-]+)=(.+):(\w+):(AVERAGE|MIN|MAX|LAST)((?::\w+=[^:]*)*)$')
+
+def count_rows(start, end, step):
+	return max(-(-(end - start) // step), 0)
 
-	print('Обнаружена длина периода: {} сек'.format(time), file=sys.stderr)
-	return time
+# План чтения RRA. Без :step= rrdtool берет RRA с шагом, ближайшим к ширине
+# пикселя, среди покрывающих интервал DEF, а у периодов overlap_graph.py с
+# разными start= выбор может разойтись. Здесь для каждого DEF без :step=
+# выбирается самый подробный RRA, который покрывает интервал и дает не больше
+# двух строк на пиксель (шаг не меньше половины пикселя), а если такого нет -
+# самый грубый из покрывающих; выбор закрепляется через :step=. Если шаги у DEF
+# разошлись, все переводятся на наибольший из них там, где такой RRA покрывает
+# интервал, - строки периодов совпадают, и строк не больше, чем без плана.
+# Возвращает новую команду и отчет: строк по плану и при выборе rrdtool.
+def plan_cmdline(cmdline, window, width=960):
+	from rrd_file import RRDFile
+	import attime
+	pixel = max((window[1] - window[0]) // width, 1)
+	planned = list()
+	with contextlib.ExitStack() as stack:
+		files = dict()
+		for index, arg in enumerate(cmdline):
+			match = DEF_RE.match(arg)
+			if match is None: continue
+			vname, path, ds, cf, options = match.groups()
+			options = dict(option.partition('=')[::2] for option in options.split(':')[1:])
+			if 'step' in options: continue
+			start, end = window
+			if 'start' in options or 'end' in options:
+				resolved = attime.resolve_window(options.get('start', str(start)), options.get('end', str(end)))
+				if resolved is None: continue
+				start, end = resolved
+			if path not in files:
+				try: files[path] = stack.enter_context(RRDFile(path))
+				except Exception: files[path] = None
+			rrd = files[path]
+			if rrd is None: continue
+			covering = [ rra for rra in rrd.rra if rra.cf == cf and rra.last_row_time - rra.row_cnt * rra.step <= start ]
+			if len(covering) == 0: continue
+			coarse = [ rra for rra in covering if 2 * rra.step >= pixel ]
+			chosen = min(coarse, key=lambda rra: rra.step) if len(coarse) > 0 else max(covering, key=lambda rra: rra.step)
+			naive = rrd.choose_rra(cf, start, end, pixel)
+			planned.append(dict(index=index, start=start, end=end, covering=covering, chosen=chosen, naive=naive))
+
+	if len(planned) > 0:
+		common = max(item['chosen'].step for item in planned)
+		for item in planned:
+			same = [ rra for rra in item['covering'] if rra.step == common ]
+			if len(same) > 0: item['chosen'] = same[0]
+
+	cmdline = list(cmdline)
+	for item in planned:
+		cmdline[item['index']] += ':step={}'.format(item['chosen'].step)
+	report = dict(
+		defs=len(planned), pixel=pixel,
+		steps=sorted(set(item['chosen'].step for item in planned)),
+		naive_steps=sorted(set(item['naive'].step for item in planned)),
+		rows=sum(count_rows(item['start'], item['end'], item['chosen'].step) for item in planned),
+		naive_rows=sum(count_rows(item['start'], item['end'], item['naive'].step) for item in planned),
+	)
+	return cmdline, report
+
+# Шаги :step= из DEF команды: (файл, DS, функция) -> шаг (строкой)
+def planned_steps(planned):
+	steps = dict()
+	for arg in planned:
+		match = DEF_RE.match(arg)
+		if match is None: continue
+		vname, path, ds, cf, options = match.groups()
+		options = dict(option.partition('=')[::2] for option in options.split(':')[1:])
+		if 'step' in options: steps.setdefault((path, ds, cf), options['step'])
+	return steps
+
+# Закрепить в DEF команды cmdline те же :step=, что план выбрал для DEF того же
+# файла, DS и функции в planned: вспомогательные выгрузки (пределы) должны
+# читать тот же RRA, что и рендер.
+def pin_steps(cmdline, planned):
+	steps = planned_steps(planned)
+	pinned = list()
+	for arg in cmdline:
+		match = DEF_RE.match(arg)
+		if match is not None and ':step=' not in match.group(5) and match.group(2, 3, 4) in steps:
+			arg += ':step={}'.format(steps[match.group(2, 3, 4)])
+		pinned.append(arg)
+	return pinned
 
 def get_trend_window(period_length, trend_type):
 	trend_type, trend_value = trend_type
@@ -216,31 +325,486 @@ def get_trend_window(period_length, trend_type):
 	elif trend_type == 'value': return trend_value
 	else: assert False, self.arg_trend
 
+# cmdline - команда 'rrdtool graph ...' с print_min и print_max
 def detect_min_max(cmdline):
+	try:
+		prints = parse_prints(rrd_backend().graph(cmdline[2:])['prints'])
+	except RRDToolError as e:
+		print('Ошибка rrdtool: {}'.format(e), file=sys.stderr)
+		prints = dict()
+
+	b_min, b_max = prints.get('MIN'), prints.get('MAX')
+	if b_min is not None and not math.isfinite(b_min): b_min = None
+	if b_max is not None and not math.isfinite(b_max): b_max = None
+	print('Определены min, max: ', repr(b_min), repr(b_max), file=sys.stderr)
+
+	if b_min is not None and b_max is not None:
+		assert b_max > b_min, (b_max, b_min)
+
+	return b_min, b_max
+
+def rrdtool_env():
 	env = os.environ.copy()
 	env['LC_NUMERIC'] = 'en_US.UTF-8'
-	process = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=sys.stdout, env=env)
+	return env
+
+# Выгрузка рядов через rrdtool xport без рендера изображения.
+# Возвращает шаг и словарь { легенда: [ значения ] }.
+def xport(cmdline):
+	start, step, series = xport_full(cmdline)
+	return step, series
 
-	b_min, b_max = None, None
+# То же, что xport, но еще и с началом выгрузки: строка i относится ко времени start + (i + 1) * step
+def xport_full(cmdline):
+	result = rrd_backend().xport(cmdline[2:])
+	legend = result['legend']
+	series = { name: [ row[i] for row in result['data'] ] for i, name in enumerate(legend) }
+	print('Выгружено рядов: {}, шаг: {} сек'.format(len(legend), result['step']), file=sys.stderr)
+	return result['start'], result['step'], series
 
-	stdout = io.TextIOWrapper(process.stdout)
-	while True:
-		line = stdout.readline().strip()
-		if len(line) == 0: break
-		print('Линия: ', repr(line), file=sys.stderr)
+# Значения PRINT вида 'ИМЯ:число' или 'ИМЯ=число' -> { ИМЯ: float }
+def parse_prints(prints):
+	values = dict()
+	for line in prints:
+		match = re.match(r'\s*(\w+)[:=]\s*(\S+)\s*$', line)
+		if match is None: continue
 		try:
-			b_min = float(re.match(r'MIN:([0-9eE.,+-]+)', line).group(1).replace(',', '.'))
-			print('Определен min: ', repr(b_min), file=sys.stderr)
-		except Exception: pass
+			values[match.group(1)] = float(match.group(2).replace(',', '.'))
+		except ValueError:
+			pass
+	return values
+
+class RRDToolError(Exception):
+	def __init__(self, message, returncode=1):
+		super(RRDToolError, self).__init__(message)
+		self.returncode = returncode
+
+# Вызовы rrdtool. Аргументы - как в командной строке после 'rrdtool <команда>',
+# результаты - разобранные данные: graphv - словарь, graph - размер и строки PRINT,
+# xport - start, step, легенда и строки значений (NaN для неизвестных).
+
+# Запуск rrdtool на каждый вызов, разбор вывода
+class SubprocessBackend(object):
+	name = 'subprocess'
+
+	def run(self, command, args):
+		cmdline = [ 'rrdtool', command ] + [ str(arg) for arg in args ]
+		process = subprocess.run(cmdline, stdout=subprocess.PIPE, stderr=sys.stderr, env=rrdtool_env())
+		if process.returncode != 0:
+			raise RRDToolError('rrdtool {} завершился с кодом {}'.format(command, process.returncode), process.returncode)
+		return process.stdout
+
+	@staticmethod
+	def parse_value(value):
+		value = value.strip()
+		if value.startswith('"') and value.endswith('"'): return value[1:-1]
+		for t in (int, float):
+			try:
+				return t(value.replace(',', '.') if t is float else value)
+			except ValueError:
+				pass
+		return value
+
+	def graphv(self, args):
+		info = dict()
+		for line in self.run('graphv', args).decode('utf-8', errors='replace').splitlines():
+			key, sep, value = line.partition(' = ')
+			if sep: info[key.strip()] = self.parse_value(value)
+		return info
+
+	def graph(self, args):
+		lines = self.run('graph', args).decode('utf-8', errors='replace').splitlines()
+		width, height = None, None
+		if len(lines) > 0:
+			match = re.match(r'([0-9]+)x([0-9]+)$', lines[0].strip())
+			if match is not None:
+				width, height = int(match.group(1)), int(match.group(2))
+				lines = lines[1:]
+		return dict(width=width, height=height, prints=lines)
+
+	def xport(self, args):
+		root = xml.etree.ElementTree.fromstring(self.run('xport', args))
+		legend = [ str(entry.text).strip() for entry in root.findall('meta/legend/entry') ]
+		data = [ [ float(value.text.strip().replace(',', '.')) for value in row.findall('v') ] for row in root.findall('data/row') ]
+		return dict(
+			start=int(root.findtext('meta/start')), end=int(root.findtext('meta/end')),
+			step=int(root.findtext('meta/step')), legend=legend, data=data,
+		)
+
+	def last(self, rrd):
+		return int(self.run('last', [ rrd ]).strip())
+
+	def create(self, args):
+		self.run('create', args)
+
+	def update(self, args):
+		self.run('update', args)
+
+# Долгоживущие процессы 'rrdtool -' (remote control): команда - строка в stdin,
+# ответ - вывод команды и строка 'OK u:... s:... r:...' или 'ERROR: ...'.
+# Запуск rrdtool и загрузка библиотек на роутере дороже рендера суток, а так
+# они оплачиваются один раз на процесс пула. Процессы запускаются по мере
+# надобности, не больше size; упавший процесс перезапускается, команда
+# повторяется один раз. В пул возвращается только процесс, дочитавший ответ
+# (OK или ERROR), прерванный любым другим исключением останавливается. Строки длиннее PIPE_LINE_MAX (буфер rrdtool) и с
+# переводом строки выполняются отдельным запуском, как в SubprocessBackend.
+PIPE_LINE_MAX = 9000
+
+class PipeWorker(object):
+	def __init__(self):
+		super(PipeWorker, self).__init__()
+		self.process = subprocess.Popen([ 'rrdtool', '-' ], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+			stderr=sys.stderr, env=rrdtool_env())
+		self.calls = 0
+
+	def call(self, line):
+		self.process.stdin.write(line)
+		self.process.stdin.flush()
+		output = list()
+		while True:
+			response = self.process.stdout.readline()
+			if response == b'':
+				try:
+					returncode = self.process.wait(timeout=1)
+				except subprocess.TimeoutExpired:
+					returncode = None
+				raise BrokenPipeError('rrdtool - завершился с кодом {}'.format(returncode))
+			if response.startswith(b'OK u:'):
+				self.calls += 1
+				return b''.join(output)
+			if response.startswith(b'ERROR'):
+				self.calls += 1
+				raise RRDToolError(response.decode('utf-8', errors='replace').strip())
+			output.append(response)
+
+	def kill(self):
 		try:
-			b_max = float(re.match(r'MAX:([0-9eE.,+-]+)', line).group(1).replace(',', '.'))
-			print('Определен max: ', repr(b_max), file=sys.stderr)
-		except Exception: pass
+			self.process.kill()
+			self.process.wait(timeout=5)
+		except (OSError, subprocess.TimeoutExpired):
+			pass
 
-	if b_min is not None and b_max is not None:
-		assert b_max > b_min, (b_max, b_min)
+	def close(self):
+		try:
+			self.process.stdin.write(b'quit\n')
+			self.process.stdin.close()
+			self.process.wait(timeout=5)
+		except (OSError, ValueError, subprocess.TimeoutExpired):
+			self.process.kill()
 
-	return b_min, b_max
+class PipeBackend(SubprocessBackend):
+	name = 'pipe'
+
+	def __init__(self, size=None):
+		super(PipeBackend, self).__init__()
+		self.size = max(size if size is not None else int(os.environ.get('RRDTOOL_WORKERS', os.cpu_count() or 1)), 1)
+		self.idle = queue.LifoQueue()
+		self.lock = threading.Lock()
+		self.workers = list()
+		self.restarts = 0
+		atexit.register(self.close)
+
+	# Разбор строки в rrdtool (CreateArgs): слова через пробел, кавычки ' и "
+	# без экранирования. Одинарная кавычка внутри - в двойных: 'it'"'"'s'.
+	@staticmethod
+	def quote(arg):
+		return "'" + arg.replace("'", "'\"'\"'") + "'"
+
+	def acquire(self):
+		while True:
+			try:
+				worker = self.idle.get_nowait()
+			except queue.Empty:
+				with self.lock:
+					if len(self.workers) < self.size:
+						worker = PipeWorker()
+						self.workers.append(worker)
+						return worker
+				worker = self.idle.get()
+			# None - место выброшенного процесса: следующий круг запустит новый
+			if worker is not None: return worker
+
+	def replace(self, worker, error):
+		with self.lock:
+			self.restarts += 1
+			print('{}, перезапуск (выполнено команд: {})'.format(error, worker.calls), file=sys.stderr)
+			worker.close()
+			fresh = PipeWorker()
+			self.workers[self.workers.index(worker)] = fresh
+			return fresh
+
+	# Процесс, прерванный посреди ответа, мог не дочитать вывод прошлой команды:
+	# он останавливается и в пул не возвращается
+	def discard(self, worker, error):
+		with self.lock:
+			if worker in self.workers: self.workers.remove(worker)
+		print('{!r}, процесс остановлен (выполнено команд: {})'.format(error, worker.calls), file=sys.stderr)
+		worker.kill()
+		self.idle.put(None)
+
+	def run(self, command, args):
+		args = [ str(arg) for arg in args ]
+		line = (' '.join([ command ] + [ self.quote(arg) for arg in args ]) + '\n').encode('utf-8')
+		if len(line) > PIPE_LINE_MAX or any('\n' in arg or '\r' in arg for arg in args):
+			return super().run(command, args)
+		worker = self.acquire()
+		try:
+			try:
+				output = worker.call(line)
+			except (BrokenPipeError, ConnectionError) as e:
+				worker = self.replace(worker, e)
+				try:
+					output = worker.call(line)
+				except (BrokenPipeError, ConnectionError) as e:
+					worker = self.replace(worker, e)
+					raise RRDToolError('rrdtool {}: {}'.format(command, e))
+		except RRDToolError:
+			# Строка ERROR: дочитана, процесс готов к следующей команде
+			self.idle.put(worker)
+			raise
+		except BaseException as e:
+			self.discard(worker, e)
+			raise
+		self.idle.put(worker)
+		return output
+
+	def close(self):
+		with self.lock:
+			workers, self.workers = self.workers, list()
+		for worker in workers: worker.close()
+
+# librrd в том же процессе через модуль rrdtool (python-rrdtool).
+# Вызовы librrd последовательны: не все ее части потокобезопасны.
+class LibraryBackend(object):
+	name = 'library'
+
+	def __init__(self, module):
+		super(LibraryBackend, self).__init__()
+		self.module = module
+		self.lock = threading.Lock()
+
+	def call(self, function, args):
+		with self.lock:
+			try:
+				return function(*[ str(arg) for arg in args ])
+			except self.module.OperationalError as e:
+				raise RRDToolError(str(e))
+
+	def graphv(self, args):
+		return dict(self.call(self.module.graphv, args))
+
+	def graph(self, args):
+		width, height, prints = self.call(self.module.graph, args)
+		return dict(width=width, height=height, prints=list(prints or []))
+
+	def xport(self, args):
+		result = self.call(self.module.xport, args)
+		meta = result['meta']
+		data = [ [ math.nan if value is None else float(value) for value in row ] for row in result['data'] ]
+		return dict(
+			start=int(meta['start']), end=int(meta['end']), step=int(meta['step']),
+			legend=list(meta['legend']), data=data,
+		)
+
+	def last(self, rrd):
+		return int(self.call(self.module.last, [ rrd ]))
+
+	def create(self, args):
+		self.call(self.module.create, args)
+
+	def update(self, args):
+		self.call(self.module.update, args)
+
+BACKENDS = ('auto', 'library', 'subprocess', 'pipe')
+
+def make_backend(name='auto', workers=None):
+	if name == 'pipe': return PipeBackend(workers)
+	if name in ('auto', 'library'):
+		try:
+			import rrdtool as module
+		except ImportError:
+			if name == 'library': raise
+		else:
+			return LibraryBackend(module)
+	return SubprocessBackend()
+
+__backend = None
+
+# Текущий способ вызова rrdtool, по умолчанию - из RRDTOOL_BACKEND или auto
+def rrd_backend():
+	global __backend
+	if __backend is None: __backend = make_backend(os.environ.get('RRDTOOL_BACKEND', 'auto'))
+	return __backend
+
+def select_backend(name, workers=None):
+	global __backend
+	# Процессы пула прежнего способа больше не нужны
+	if isinstance(__backend, PipeBackend): __backend.close()
+	__backend = make_backend(name, workers)
+	return __backend
+
+# Способ вызова rrdtool для threads одновременных рендеров (batch_graph.py
+# --jobs, graph_server.py --renders). Вызовы librrd идут по очереди, поэтому
+# auto для нескольких потоков - пул 'rrdtool -' на threads процессов.
+def select_threaded_backend(name, threads):
+	if name is None: name = os.environ.get('RRDTOOL_BACKEND', 'auto')
+	if threads > 1 and name == 'auto': name = 'pipe'
+	backend = select_backend(name, threads)
+	if threads > 1 and backend.name == 'library':
+		print('Внимание! С --backend library вызовы rrdtool идут по очереди, {} потоков не ускорят рендер.'.format(threads), file=sys.stderr)
+	return backend
+
+# Аналоги операторов RPN и VDEF из rrdtool с той же семантикой NaN.
+# Вместо NaN в результатах VDEF возвращается None, как если бы PRINT не распознался.
+
+def __c_round(value):
+	# round() из C: половины от нуля, а не к четному
+	return int(math.floor(value + 0.5)) if value >= 0 else int(math.ceil(value - 0.5))
+
+def vdef_percentnan(values, percent):
+	values = sorted(v for v in values if not math.isnan(v))
+	if len(values) == 0: return None
+	return values[__c_round(percent * (len(values) - 1) / 100.0)]
+
+def vdef_minimum(values):
+	values = [ v for v in values if not math.isnan(v) ]
+	return min(values) if len(values) > 0 else None
+
+def vdef_maximum(values):
+	values = [ v for v in values if not math.isnan(v) ]
+	return max(values) if len(values) > 0 else None
+
+def rpn_limit(values, mn, mx):
+	if mn is None or mx is None: return [ math.nan ] * len(values)
+	return [ v if mn <= v <= mx else math.nan for v in values ]
+
+def rpn_prev(values):
+	return [ math.nan ] + list(values[:-1])
+
+# Общий для потоков кэш результатов: одинаковые вызовы выполняются один раз,
+# параллельные вызовы с теми же аргументами дожидаются первого.
+class CallCache(object):
+	def __init__(self):
+		super(CallCache, self).__init__()
+		self.lock = threading.Lock()
+		self.futures = dict()
+
+	def call(self, function, *args):
+		key = (function, ) + tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
+		with self.lock:
+			future = self.futures.get(key)
+			owner = future is None
+			if owner: future = self.futures[key] = concurrent.futures.Future()
+		if owner:
+			try:
+				future.set_result(function(*args))
+			except BaseException as e:
+				future.set_exception(e)
+		return future.result()
+
+# Кэш готовых изображений на диске. Ключ - хэш всего, от чего зависит картинка,
+# вытеснение - самые давно использованные файлы, пока кэш больше max_bytes.
+class RenderCache(object):
+	def __init__(self, directory, max_bytes):
+		super(RenderCache, self).__init__()
+		self.directory = pathlib.Path(directory)
+		self.max_bytes = max_bytes
+		self.directory.mkdir(parents=True, exist_ok=True)
+
+	@staticmethod
+	def mk_key(*parts):
+		return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+	def path(self, key):
+		return self.directory / (key + '.img')
+
+	def __copy(self, source, target):
+		target = pathlib.Path(target)
+		temp = target.with_name('.{}.{}.tmp'.format(target.name, threading.get_ident()))
+		shutil.copyfile(str(source), str(temp))
+		os.replace(str(temp), str(target))
+
+	def get(self, key, target):
+		path = self.path(key)
+		try:
+			self.__copy(path, target)
+		except FileNotFoundError:
+			return False
+		os.utime(str(path)) # Отметка использования для LRU
+		return True
+
+	def put(self, key, source):
+		self.__copy(source, self.path(key))
+		self.evict()
+
+	def evict(self):
+		entries = list()
+		for path in self.directory.glob('*.img'):
+			try:
+				stat = path.stat()
+			except FileNotFoundError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, path))
+		total = sum(size for mtime, size, path in entries)
+		for mtime, size, path in sorted(entries):
+			if total <= self.max_bytes: break
+			try:
+				path.unlink()
+			except FileNotFoundError:
+				pass
+			total -= size
+
+# Чтение /proc/self/io: rchar включает и завершенные дочерние процессы,
+# то есть и то, что прочитал rrdtool. None, если /proc нет.
+def read_proc_io():
+	try:
+		with open('/proc/self/io', 'r') as f:
+			return { key: int(value) for key, value in (line.split(': ') for line in f.read().splitlines() if ': ' in line) }
+	except (OSError, ValueError):
+		return None
+
+# Замеры по фазам рендера. Вложенные фазы получают имя через '/', время
+# включает вложенные. CPU - только текущего потока, а rusage дочерних
+# процессов и ввод-вывод - на весь процесс (в пакете с потоками смешиваются).
+class PhaseTimer(object):
+	def __init__(self):
+		super(PhaseTimer, self).__init__()
+		self.started = time.perf_counter()
+		self.stack = list()
+		self.phases = list()
+		self.notes = dict()
+
+	@staticmethod
+	def snapshot():
+		children = resource.getrusage(resource.RUSAGE_CHILDREN)
+		return dict(
+			wall=time.perf_counter(), cpu=time.thread_time(),
+			children_user=children.ru_utime, children_sys=children.ru_stime,
+			io=read_proc_io(),
+		)
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		self.stack.append(name)
+		before = self.snapshot()
+		try:
+			yield
+		finally:
+			after = self.snapshot()
+			entry = dict(name='/'.join(self.stack))
+			for key in ('wall', 'cpu', 'children_user', 'children_sys'):
+				entry[key] = after[key] - before[key]
+			if before['io'] is not None and after['io'] is not None:
+				entry['read_chars'] = after['io'].get('rchar', 0) - before['io'].get('rchar', 0)
+				entry['read_bytes'] = after['io'].get('read_bytes', 0) - before['io'].get('read_bytes', 0)
+			self.phases.append(entry)
+			self.stack.pop()
+
+	def note(self, **values):
+		self.notes.update(values)
+
+	def report(self, **values):
+		return dict(values, total_wall=time.perf_counter() - self.started, phases=self.phases, **self.notes)
 
 class AbstractGraph(object):
 	def __init__(self):
@@ -248,6 +812,11 @@ class AbstractGraph(object):
 		self._period_length = -1
 		self.argparse = argparse.ArgumentParser()
 		self.detect_min_max = False
+		self.shared_cache = None
+		self._error_bounds = -1
+		self.timer = None
+		self.cmdline_size = None # Число аргументов и байт последней команды рендера
+		self.multi_sensor = False
 
 	def init_argparse(self):
 		self.argparse.add_argument('rrd', type=argtype_file,
@@ -264,6 +833,38 @@ class AbstractGraph(object):
 			help='Собрать команду, но не выполнять её, а вывести.')
 		group.add_argument('--compat', dest='compat', action='store_true',
 			help='Собрать команду, но не выполнять её, а вывести.')
+		group.add_argument('--cache', dest='cache', type=str, default=None,
+			help='Каталог кэша готовых изображений, по умолчанию кэш не используется')
+		group.add_argument('--cache-size', dest='cache_size', type=float, default=64.0,
+			help='Наибольший размер кэша в МиБ, по умолчанию = 64')
+		group.add_argument('--detect', dest='detect', choices=('xport', 'graph'), default='xport',
+			help='Способ определения пределов: xport - выгрузка только нужных рядов, '
+				'graph - пробный рендер, по умолчанию = xport')
+		group.add_argument('--timing', dest='timing', type=str, nargs='?', const='-', default=None,
+			help='Записать время фаз в JSON: в файл (дописывается строкой) или в stderr, если файл не указан')
+		group.add_argument('--profile', dest='profile', type=str, default=None,
+			help='Записать профиль cProfile Python-части в файл (формат pstats)')
+		group.add_argument('--backend', dest='backend', choices=BACKENDS, default=None,
+			help='Как вызывать rrdtool: library - librrd через модуль rrdtool, subprocess - запуском rrdtool, '
+				'pipe - пулом процессов \'rrdtool -\' ($RRDTOOL_WORKERS, по умолчанию число CPU), '
+				'auto - library, если модуль установлен, по умолчанию = $RRDTOOL_BACKEND или auto')
+		group.add_argument('--stats', dest='stats', type=str, default=None,
+			help='Каталог статистики (stats_store.py): границы ошибочных данных берутся из него '
+				'вместо PERCENTNAN, если график читает RRA с шагом RRD, по умолчанию не используется')
+		group.add_argument('--events', dest='events', type=str, default=None,
+			help='Индекс событий (event_index.py): маркеры пропусков, выбросов и выходов за ±0.4 Hz берутся '
+				'из него вместо расчета по строкам окна, по умолчанию не используется')
+		group.add_argument('--no-optimize', dest='optimize', action='store_false',
+			help='Не компилировать DEF/CDEF/VDEF (rpn.py), передать команду в rrdtool как есть.')
+		group.add_argument('--no-plan', dest='plan', action='store_false',
+			help='Не закреплять RRA за DEF через :step=, оставить выбор rrdtool.')
+
+		if self.multi_sensor:
+			group = self.argparse.add_argument_group('Несколько датчиков')
+			group.add_argument('--label', dest='label', type=str, default=None,
+				help='Метка датчика из rrd, по умолчанию - имя файла без расширения')
+			group.add_argument('--sensor', dest='sensors', type=argtype_sensor, action='append', default=None,
+				help='Еще один датчик, МЕТКА=RRD, можно несколько раз. Все датчики рисуются на одном графике.')
 
 	def init_args(self):
 		self.arg_rrd = assert_t(self.raw_args.rrd, str)
@@ -271,25 +872,119 @@ class AbstractGraph(object):
 		self.arg_cmd = assert_t(self.raw_args.cmd, bool)
 		self.arg_trend = assert_t(self.raw_args.trend, tuple)
 		self.arg_error = assert_t(self.raw_args.error, float)
+		self.arg_detect = assert_t(self.raw_args.detect, str)
+		self.arg_cache = self.raw_args.cache
+		self.arg_cache_size = assert_t(self.raw_args.cache_size, float)
+		self.arg_stats = self.raw_args.stats
+		self.arg_events = self.raw_args.events
+		self.arg_timing = self.raw_args.timing
+		self.arg_profile = self.raw_args.profile
+		self.arg_optimize = assert_t(self.raw_args.optimize, bool)
+		self.arg_plan = assert_t(self.raw_args.plan, bool)
+		self.arg_sensors = [ (sensor_label(self.arg_rrd), self.arg_rrd) ]
+		if self.multi_sensor:
+			if self.raw_args.label is not None: self.arg_sensors[0] = (self.raw_args.label, self.arg_rrd)
+			if self.raw_args.sensors is not None: self.arg_sensors += self.raw_args.sensors
+			labels = [ label for label, rrd in self.arg_sensors ]
+			if len(set(labels)) != len(labels):
+				self.argparse.error('Метки датчиков повторяются: {}'.format(', '.join(labels)))
+		if self.arg_timing is not None: self.timer = PhaseTimer()
+		# auto не меняет уже выбранный способ: его мог выбрать пакет или сервер
+		if self.raw_args.backend not in (None, 'auto', rrd_backend().name):
+			select_backend(self.raw_args.backend)
 
-	def run(self):
+	def run(self, argv=None):
+		self.setup(argv)
+
+		if self.arg_cmd:
+			with self.phase('build'):
+				production_cmdline = self.mk_production_cmdline()
+			final_cmd = ''
+			for cmd_part in production_cmdline:
+				final_cmd += '\'' + cmd_part.replace('\'','\'\\\'\'') + '\' '
+			print(final_cmd, file=sys.stderr)
+			self.write_timing()
+		else:
+			status = self.produce()
+			print(repr(status), file=sys.stderr)
+
+	def setup(self, argv=None):
 		self.init_argparse()
-		self.raw_args = self.argparse.parse_args()
+		self.raw_args = self.argparse.parse_args(argv)
 		self.init_args()
 
-		impl_cmdline = unpack_list(self.mk_cmdline())
+	# Фаза для --timing, без него - пустой контекст
+	def phase(self, name):
+		if self.timer is None: return contextlib.nullcontext()
+		return self.timer.phase(name)
+
+	def write_timing(self, **values):
+		if self.timer is None: return
+		line = json.dumps(self.timer.report(graph=type(self).__name__, image=self.arg_image, **values), ensure_ascii=False)
+		if self.arg_timing == '-':
+			print(line, file=sys.stderr)
+		else:
+			with open(self.arg_timing, 'a') as f:
+				f.write(line + '\n')
+
+	# Вызов через общий кэш, если граф запущен в пакете с другими
+	def shared(self, function, *args):
+		if self.shared_cache is None: return function(*args)
+		return self.shared_cache.call(function, *args)
+
+	# function(метка, rrd) для всех датчиков параллельно, результаты в порядке датчиков.
+	# С библиотекой librrd (--backend library) сами вызовы rrdtool идут по очереди.
+	def map_sensors(self, function):
+		if len(self.arg_sensors) == 1: return [ function(*self.arg_sensors[0]) ]
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.arg_sensors)) as executor:
+			return list(executor.map(lambda sensor: function(*sensor), self.arg_sensors))
+
+	def mk_render_options(self):
+		return [
+			# TODO options
+			'--width', '960', '--height', '384', #'--full-size-mode',
+			'--pango-markup', '--tabwidth', '100',
+			'--alt-y-grid',
+			'--color', 'BACK#00000000',
+			'--color', 'SHADEA#00000000',
+			'--color', 'SHADEB#00000000',
+		]
+
+	# Слияние одинаковых и отбрасывание ненужных переменных (rpn.py).
+	# drawing=False - только PRINT и XPORT, для пробного рендера.
+	def optimize(self, cmdline, drawing=True):
+		if not self.arg_optimize: return cmdline
+		try:
+			program = rpn.Program(cmdline)
+			optimized = program.compile(drawing)
+		except rpn.CompileError as e:
+			print('Команда не оптимизирована: {}'.format(e), file=sys.stderr)
+			return cmdline
+		if self.timer is not None and drawing: self.timer.note(rpn=program.stats)
+		return optimized
+
+	# Закрепление RRA за DEF (plan_cmdline) по интервалу графика
+	def plan(self, cmdline):
+		if not self.arg_plan: return cmdline
+		cmdline, report = plan_cmdline(cmdline, self.get_window())
+		if report['defs'] > 0:
+			print('План чтения RRA: {} строк вместо {}, шаг {} сек вместо {} (пиксель {} сек)'.format(
+				report['rows'], report['naive_rows'],
+				'/'.join(map(str, report['steps'])), '/'.join(map(str, report['naive_steps'])), report['pixel']), file=sys.stderr)
+		if self.timer is not None: self.timer.note(plan=report)
+		return cmdline
+
+	def mk_production_cmdline(self, impl_cmdline=None):
+		if impl_cmdline is None: impl_cmdline = unpack_list(self.mk_cmdline())
+		with self.phase('compile'):
+			impl_cmdline = self.optimize(impl_cmdline)
+		with self.phase('plan'):
+			impl_cmdline = self.plan(impl_cmdline)
 
 		limits_cmdline = []
 		if not self.arg_cmd and self.detect_min_max:
-			# Определение пределов
-			detection_cmdline = [
-				'rrdtool', 'graph', os.devnull,
-				'--width', '960', '--height', '384',
-				# '--pango-markup', '--tabwidth', '100',
-				# '--alt-y-grid',
-			] + impl_cmdline
-			b_min, b_max = detect_min_max(detection_cmdline)
-
+			with self.phase('detect_limits'):
+				b_min, b_max = self.detect_limits(impl_cmdline)
 
 			if b_min is None and b_max is None:
 				print('Внимание! Запрошено определение пределов, но они не обнаружены.', file=sys.stderr)
@@ -310,32 +1005,232 @@ class AbstractGraph(object):
 
 		production_cmdline = [
 			'rrdtool', 'graph', self.arg_image,
-			# TODO options
-			'--width', '960', '--height', '384', #'--full-size-mode',
-			'--pango-markup', '--tabwidth', '100',
-			'--alt-y-grid',
-			'--color', 'BACK#00000000',
-			'--color', 'SHADEA#00000000',
-			'--color', 'SHADEB#00000000',
-		] + limits_cmdline + impl_cmdline
+		] + self.mk_render_options() + limits_cmdline + impl_cmdline
+		self.cmdline_size = (len(production_cmdline), sum(len(part.encode('utf-8')) + 1 for part in production_cmdline))
+		if self.timer is not None:
+			self.timer.note(cmdline_args=self.cmdline_size[0], cmdline_bytes=self.cmdline_size[1])
+		return production_cmdline
 
-		if self.arg_cmd:
-			final_cmd = ''
-			for cmd_part in production_cmdline:
-				final_cmd += '\'' + cmd_part.replace('\'','\'\\\'\'') + '\' '
-			print(final_cmd, file=sys.stderr)
-		else:
-			status = subprocess.run(production_cmdline, stdout=sys.stdout, stderr=sys.stderr)
-			print(repr(status), file=sys.stderr)
+	# production_cmdline - 'rrdtool graph ...', результат как у subprocess.run
+	def render(self, production_cmdline):
+		try:
+			result = rrd_backend().graph(production_cmdline[2:])
+		except RRDToolError as e:
+			print('Ошибка rrdtool: {}'.format(e), file=sys.stderr)
+			return subprocess.CompletedProcess(production_cmdline, e.returncode)
+		print('{}x{}'.format(result['width'], result['height']))
+		for line in result['prints']: print(line)
+		return subprocess.CompletedProcess(production_cmdline, 0)
+
+	# Интервал графика в секундах эпохи, по умолчанию как у rrdtool: сутки до now
+	def get_window(self):
+		now = int(time.time())
+		return now - LENGTH_DAY, now
+
+	# Интервал, по которому graph_scheduler.py решает, сдвинулись ли данные
+	# хотя бы на столбец пикселей. Должен быть дешевым: без выгрузок.
+	def get_schedule_window(self):
+		return self.get_window()
+
+	# Ключ кэша: параметры рендера, команда графика, интервал и состояние RRD
+	# всех датчиков. Пределы не входят в ключ - они определяются теми же данными.
+	# Интервал обрезается по последнему обновлению: правее него данных нет,
+	# и пока RRD не обновлялся, "now" в --end не сбрасывает кэш.
+	# Затем он округляется до ширины пикселя.
+	def mk_cache_key(self, impl_cmdline):
+		updates = [ [ detect_last_update(rrd), os.stat(rrd).st_mtime_ns ] for label, rrd in self.arg_sensors ]
+		last_update = max(update[0] for update in updates)
+		start, end = self.get_window()
+		pixel = max((end - start) // 960, 1)
+		window = [ min(start, last_update) // pixel, min(end, last_update) // pixel ]
+		return RenderCache.mk_key(self.mk_render_options(), impl_cmdline, window, updates)
+
+	# Рендер с учетом кэша, если он включен. С --profile Python-часть
+	# профилируется, с --timing замеры пишутся по окончании.
+	def produce(self):
+		profile = None
+		if self.arg_profile is not None:
+			import cProfile
+			profile = cProfile.Profile()
+			profile.enable()
+		status = None
+		try:
+			status = self.produce_impl()
+			return status
+		finally:
+			if profile is not None:
+				profile.disable()
+				profile.dump_stats(self.arg_profile)
+			self.write_timing(returncode=status.returncode if status is not None else None)
+
+	def produce_impl(self):
+		with self.phase('build'):
+			impl_cmdline = unpack_list(self.mk_cmdline())
+		cache, key = None, None
+		if self.arg_cache is not None:
+			with self.phase('cache_get'):
+				cache = RenderCache(self.arg_cache, int(self.arg_cache_size * 1024 * 1024))
+				key = self.mk_cache_key(impl_cmdline)
+				hit = cache.get(key, self.arg_image)
+			if self.timer is not None: self.timer.note(cache_hit=hit)
+			if hit:
+				print('Изображение взято из кэша: {}'.format(key), file=sys.stderr)
+				return subprocess.CompletedProcess([ 'cache', key, self.arg_image ], 0)
+
+		production_cmdline = self.mk_production_cmdline(impl_cmdline)
+		with self.phase('render'):
+			status = self.render(production_cmdline)
+		if cache is not None and status.returncode == 0:
+			with self.phase('cache_put'):
+				cache.put(key, self.arg_image)
+		return status
 
 	def mk_cmdline(self):
 		return []
 
+	# Шаг RRA, из которого график прочитает r_min (по плану или, с --no-plan,
+	# как выберет rrdtool), и шаг самого RRD. None, если RRD не читается напрямую.
+	def get_read_steps(self):
+		from rrd_file import RRDFile
+		try:
+			with RRDFile(self.arg_rrd) as rrd: base = rrd.pdp_step
+		except Exception:
+			return None
+		cmdline, report = plan_cmdline([ 'DEF:r_min={}:freq:MIN'.format(self.arg_rrd) ], self.get_window())
+		if report['defs'] == 0: return None
+		return (report['steps'] if self.arg_plan else report['naive_steps'])[0], base
+
+	# Границы ошибочных данных (g_min, g_max) из хранилища статистики
+	# или None, если оно не задано или за интервал в нем нет данных.
+	# Статистика накоплена по исходным измерениям, а PERCENTNAN считается по
+	# консолидированным r_min и r_max: на грубых RRA их MIN/MAX за строку
+	# выходят за процентили измерений, и f_min/f_max почти целиком стали бы NaN.
+	# Поэтому статистика берется, только если график читает строки с шагом RRD.
+	def get_error_bounds(self):
+		if self._error_bounds == -1:
+			self._error_bounds = None
+			steps = self.get_read_steps() if self.arg_stats is not None else None
+			if steps is not None and steps[0] != steps[1]:
+				print('Статистика не используется: шаг RRA {} сек, а не {} сек, как у измерений.'.format(*steps), file=sys.stderr)
+			elif self.arg_stats is not None:
+				start, end = self.get_window()
+				bucket = self.shared(stats_store.query, self.arg_stats, start, end)
+				if bucket.count > 0:
+					self._error_bounds = (bucket.percentile(self.arg_error), bucket.percentile(100 - self.arg_error))
+					print('Границы из статистики ({} значений): '.format(bucket.count), repr(self._error_bounds), file=sys.stderr)
+		return self._error_bounds
+
+	# VDEF g_min и g_max: готовые значения из статистики или PERCENTNAN по r_min и r_max
+	def mk_error_bounds_cmdline(self):
+		bounds = self.get_error_bounds()
+		if bounds is None:
+			return [
+				'VDEF:g_min=r_min,{},PERCENTNAN'.format(self.arg_error),
+				'VDEF:g_max=r_max,{},PERCENTNAN'.format(100 - self.arg_error),
+			]
+		return [
+			cdef('c_min', 'r_min,POP,{!r}'.format(bounds[0])),
+			cdef('c_max', 'r_max,POP,{!r}'.format(bounds[1])),
+			'VDEF:g_min=c_min,MAXIMUM',
+			'VDEF:g_max=c_max,MAXIMUM',
+		]
+
+	# То же для calc_limits по выгруженным рядам
+	def calc_error_bounds(self, series):
+		bounds = self.get_error_bounds()
+		if bounds is not None: return bounds
+		return vdef_percentnan(series['r_min'], self.arg_error), vdef_percentnan(series['r_max'], 100 - self.arg_error)
+
+	# Маркеры пропусков и ошибок: CDEF по строкам окна или, с --events, ничего -
+	# маркеры рисуются по индексу событий.
+	def mk_markers_defs(self):
+		if self.arg_events is not None: return []
+		return [
+			cdef('e_min', 'r_min,g_min,LT'),
+			cdef('e_max', 'r_max,g_max,GT'),
+			cdef('e_miss', 'r_avg,UN'),
+		]
+
+	def mk_markers_ticks(self, ztick):
+		if self.arg_events is None:
+			return [
+				tick('e_miss', '#BFBFBF', fraction=1, legend='  Нет данных'),
+				ztick,
+				tick('e_min', '#0000FF', fraction=0.02, legend='  Возм. ошибки вниз'),
+				tick('e_max', '#FF0000', fraction=-0.02, legend='  Возм. ошибки вверх\\n'),
+			]
+		start, end = self.get_window()
+		events = self.shared(event_index.query, self.arg_events, start, end)
+		if self.timer is not None: self.timer.note(events=len(events))
+		return [
+			self.mk_event_rules(events, ('gap', ), '#BFBFBF', '  Нет данных'),
+			ztick,
+			self.mk_event_rules(events, ('limit_low', 'limit_high'), '#7F007F7F', '  Вне ±0.4 Hz'),
+			self.mk_event_rules(events, ('outlier_low', ), '#0000FF7F', '  Возм. ошибки вниз'),
+			self.mk_event_rules(events, ('outlier_high', ), '#FF00007F', '  Возм. ошибки вверх\\n'),
+		]
+
+	# VRULE на каждый столбец пикселей, задетый событием, - не больше ширины графика
+	def mk_event_rules(self, events, kinds, color, legend):
+		start, end = self.get_window()
+		pixel = max((end - start) / 960.0, 1.0)
+		columns = set()
+		for event in events:
+			if event.kind not in kinds: continue
+			first = max(int((event.start - start) // pixel), 0)
+			last = min(int((event.end - start) // pixel), 959)
+			columns.update(range(first, last + 1))
+		if len(columns) == 0:
+			# VRULE вне графика не рисуется, но подпись остается в легенде
+			return 'VRULE:0{}:{}'.format(color, esc_colon(legend))
+		rules = [ 'VRULE:{}{}'.format(int(start + (column + 0.5) * pixel), color) for column in sorted(columns) ]
+		rules[0] += ':' + esc_colon(legend)
+		return rules
+
+	# Элементы для rrdtool xport (DEF, CDEF, XPORT), из которых calc_limits
+	# посчитает пределы. None - пределы определяются только пробным рендером.
+	def mk_limits_cmdline(self):
+		return None
+
+	def calc_limits(self, step, series):
+		return None, None
+
+	# Пределы только по хранилищу статистики, без выгрузки рядов, или None
+	def calc_stats_limits(self):
+		return None
+
+	def detect_limits(self, impl_cmdline):
+		stats_limits = self.calc_stats_limits()
+		limits_cmdline = self.mk_limits_cmdline() if self.arg_detect == 'xport' else None
+		if stats_limits is not None:
+			b_min, b_max = stats_limits
+			print('Определены min, max по статистике: ', repr(b_min), repr(b_max), file=sys.stderr)
+		elif limits_cmdline is not None:
+			# Определение пределов по выгрузке рядов, тем же разрешением и из тех же RRA, что и у рендера
+			limits_cmdline = pin_steps(self.optimize(unpack_list(limits_cmdline), drawing=False), impl_cmdline)
+			step, series = self.shared(xport, [ 'rrdtool', 'xport', '--maxrows', '960' ] + limits_cmdline)
+			b_min, b_max = self.calc_limits(step, series)
+			print('Определены min, max: ', repr(b_min), repr(b_max), file=sys.stderr)
+		else:
+			# Определение пределов пробным рендером
+			detection_cmdline = [
+				'rrdtool', 'graph', os.devnull,
+				'--width', '960', '--height', '384',
+				# '--pango-markup', '--tabwidth', '100',
+				# '--alt-y-grid',
+			] + self.optimize(impl_cmdline, drawing=False)
+			b_min, b_max = detect_min_max(detection_cmdline)
+
+		if b_min is not None and b_max is not None:
+			assert b_max > b_min, (b_max, b_min)
+		return b_min, b_max
+
 
 class FloatingPeriodGraph(AbstractGraph):
 	def __init__(self):
 		self.__period_length = -1
 		self.__trend_window = -1
+		self.__window = None
 		super().__init__()
 
 	def init_argparse(self):
@@ -352,10 +1247,22 @@ class FloatingPeriodGraph(AbstractGraph):
 		self.arg_end = assert_t(self.raw_args.end, str)
 
 	def mk_cmdline(self):
+		return self.mk_period_cmdline()
+
+	def mk_period_cmdline(self):
 		return [ '--start', self.arg_start, '--end', self.arg_end ]
 
+	def get_window(self):
+		if self.__window is None:
+			with self.phase('detect_length'):
+				self.__window = self.shared(detect_window, self.arg_rrd, self.arg_start, self.arg_end)
+		return self.__window
+
 	def get_period_length(self):
-		if self.__period_length < 0: self.__period_length = detect_length(self.arg_rrd, self.arg_start, self.arg_end)
+		if self.__period_length < 0:
+			start, end = self.get_window()
+			self.__period_length = end - start
+			print('Обнаружена длина периода: {} сек'.format(self.__period_length), file=sys.stderr)
 		return self.__period_length
 
 	def get_trend_window(self):
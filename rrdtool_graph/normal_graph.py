@@ -5,8 +5,11 @@ class NormalGraph(FloatingPeriodGraph):
 	def __init__(self):
 		super().__init__()
 		self.detect_min_max = True
+		self.multi_sensor = True
+		self.__sensor_stats = None
 
 	def mk_cmdline(self):
+		if len(self.arg_sensors) > 1: return self.mk_sensors_cmdline()
 		period = self.get_period_length()
 		trend_window = self.get_trend_window()
 		trend_humanized = humanize_time(trend_window)
@@ -17,8 +20,7 @@ class NormalGraph(FloatingPeriodGraph):
 			'DEF:r_max={}:freq:MAX'.format(self.arg_rrd),
 			'DEF:r_avg={}:freq:AVERAGE'.format(self.arg_rrd),
 			
-			'VDEF:g_min=r_min,{},PERCENTNAN'.format(self.arg_error),
-			'VDEF:g_max=r_max,{},PERCENTNAN'.format(100 - self.arg_error),
+			self.mk_error_bounds_cmdline(),
 			
 			cdef('f_min', expr_drop('r_min', 'g_min', 'g_max')),
 			cdef('f_max', expr_drop('r_max', 'g_min', 'g_max')),
@@ -32,27 +34,15 @@ class NormalGraph(FloatingPeriodGraph):
 			'VDEF:g_last=f_avg,LAST',
 			'VDEF:g_stdev=f_avg,STDEV',
 			
-			cdef('e_min', 'r_min,g_min,LT'),
-			cdef('e_max', 'r_max,g_max,GT'),
-			cdef('e_miss', 'r_avg,UN'),
+			self.mk_markers_defs(),
 			cdef('ztick', expr_0tick(period, 'r_avg')),
 			
 			'TEXTALIGN:left',
 			
 			comment('Маркеры:'),
-			tick('e_miss', '#BFBFBF', fraction=1, legend='  Нет данных'),
-			tick('ztick', '#FFFF00', fraction=1),
-			tick('e_min', '#0000FF', fraction=0.02, legend='  Возм. ошибки вниз'),
-			tick('e_max', '#FF0000', fraction=-0.02, legend='  Возм. ошибки вверх\\n'),
+			self.mk_markers_ticks(tick('ztick', '#FFFF00', fraction=1)),
 			
-			comment_header('Пределы:', extra_text='(ГОСТ 32144-2013 4.2.1)'),
-			'HRULE:50#7F007F:Номинальное (50 Hz);:dashes',
-			comment('Допуст. 100% времени (±0.4 Hz) и 95% времени (±0.2 Hz):'),
-			'HRULE:49.6#0000FF:Наим.:dashes',
-			'HRULE:49.8#0000FF::dashes',
-			'HRULE:50.2#FF0000:Наиб.:dashes',
-			'HRULE:50.4#FF0000::dashes',
-			comment('(Могут скрыться)\\n'),
+			self.mk_limits_rules(),
 
 			comment_header(
 				'Измерения:',
@@ -84,6 +74,147 @@ class NormalGraph(FloatingPeriodGraph):
 			print_max('g_max'),
 		]
 
+	def mk_limits_rules(self):
+		return [
+			comment_header('Пределы:', extra_text='(ГОСТ 32144-2013 4.2.1)'),
+			'HRULE:50#7F007F:Номинальное (50 Hz);:dashes',
+			comment('Допуст. 100% времени (±0.4 Hz) и 95% времени (±0.2 Hz):'),
+			'HRULE:49.6#0000FF:Наим.:dashes',
+			'HRULE:49.8#0000FF::dashes',
+			'HRULE:50.2#FF0000:Наиб.:dashes',
+			'HRULE:50.4#FF0000::dashes',
+			comment('(Могут скрыться)\\n'),
+		]
+
+	# Шаг, с которым рендер прочитает s<k>_avg каждого датчика: тот же план, что
+	# в mk_production_cmdline, он зависит только от DEF и окна. None - без плана.
+	def get_sensor_steps(self):
+		defs = [ 'DEF:s{}_avg={}:freq:AVERAGE'.format(k, rrd) for k, (label, rrd) in enumerate(self.arg_sensors) ]
+		if not self.arg_plan: return { rrd: None for label, rrd in self.arg_sensors }
+		steps = planned_steps(plan_cmdline(defs, self.get_window())[0])
+		return { rrd: steps.get((rrd, 'freq', 'AVERAGE')) for label, rrd in self.arg_sensors }
+
+	# Статистика каждого датчика по тем же строкам, что читает рендер.
+	# Датчики выгружаются и считаются параллельно.
+	def get_sensor_stats(self):
+		if self.__sensor_stats is None:
+			import numpy, analytics
+			steps = self.get_sensor_steps()
+			def compute(label, rrd):
+				start, step, series = self.shared(analytics.fetch_xport, rrd, self.arg_start, self.arg_end, steps[rrd])
+				stats = analytics.normal_stats(series['r_min'], series['r_max'], series['r_avg'], self.arg_error)
+				rows = len(series['r_avg'])
+				stats['coverage'] = 100.0 * int(numpy.count_nonzero(~numpy.isnan(series['r_avg']))) / rows if rows > 0 else 0.0
+				return stats
+			with self.phase('sensors'):
+				self.__sensor_stats = self.map_sensors(compute)
+		return self.__sensor_stats
+
+	# Несколько датчиков: тренд каждого и огибающие по всем. Границы ошибочных
+	# данных у каждого датчика свои, из get_sensor_stats().
+	def mk_sensors_cmdline(self):
+		period = self.get_period_length()
+		trend_window = self.get_trend_window()
+		trend_humanized = humanize_time(trend_window)
+		count = len(self.arg_sensors)
+		stats = self.get_sensor_stats()
+		if self.arg_stats is not None:
+			print('Внимание! --stats относится к одному датчику и для нескольких не используется.', file=sys.stderr)
+
+		def bound(value):
+			return 'UNKN' if value is None else repr(value)
+
+		def value(value, unit=' Hz'):
+			return '-' if value is None else '{:.4f}{}'.format(value, unit)
+
+		cmdline = super().mk_cmdline() + [
+			'--title', 'Частота в сети, <b>{}</b> датчиков, <b>{}</b>, Hz'.format(count, humanize_time(period)),
+		]
+		for k, (label, rrd) in enumerate(self.arg_sensors):
+			cmdline += [
+				'DEF:s{}_avg={}:freq:AVERAGE'.format(k, rrd),
+				cdef('f{}_avg'.format(k), expr_drop('s{}_avg'.format(k), bound(stats[k]['g_min']), bound(stats[k]['g_max']))),
+				cdef_trend('t{}_avg'.format(k), 'f{}_avg'.format(k), trend_window),
+			]
+		filtered = [ 'f{}_avg'.format(k) for k in range(count) ]
+
+		return cmdline + [
+			cdef('e_min', expr_f_chain('MINNAN', list(filtered))),
+			cdef('e_max', expr_f_chain('MAXNAN', list(filtered))),
+			cdef('e_avg', expr_avg(list(filtered))),
+			cdef('e_spread', 'e_max,e_min,-'),
+			cdef_trend('t_avg', 'e_avg', trend_window),
+
+			'VDEF:g_min=e_min,MINIMUM',
+			'VDEF:g_max=e_max,MAXIMUM',
+			'VDEF:g_avg=e_avg,AVERAGE',
+			'VDEF:g_spread=e_spread,MAXIMUM',
+
+			cdef('e_miss_all', 'e_avg,UN'),
+			cdef('e_miss_some', expr_f_chain('+', [ 's{}_avg,UN'.format(k) for k in range(count) ])),
+			cdef('ztick', expr_0tick(period, 's0_avg')),
+
+			'TEXTALIGN:left',
+
+			comment('Маркеры:'),
+			tick('e_miss_all', '#7F7F7F', fraction=1, legend='  Нет данных ни с одного датчика'),
+			tick('ztick', '#FFFF00', fraction=1),
+			tick('e_miss_some', '#BFBFBF', fraction=0.02, legend='  Нет данных с части датчиков\\n'),
+
+			self.mk_limits_rules(),
+
+			comment_header(
+				'Датчики:',
+				extra_text='(Полоса - разброс между датчиками, линии - тренд за {}, черная - среднее по датчикам)'.format(trend_humanized)
+			),
+
+			'AREA:e_min',
+			'AREA:e_spread#7F7F7F3F::STACK',
+			[
+				'LINE1:t{}_avg{}:{}'.format(k, color_grad_rgb('#0000FF', '#FF0000', k / (count - 1)), esc_colon(label))
+				for k, (label, rrd) in enumerate(self.arg_sensors)
+			],
+			comment('\\n'),
+			'LINE2:t_avg#000000',
+
+			comment('Датчик\\tНаим.\\tНаиб.\\tСред.\\tСтанд. откл.\\tПокрытие\\n'),
+			[
+				comment('{}\\t{}\\t{}\\t{}\\t{}\\t{:.1f}%\\n'.format(
+					label, value(s['g_min']), value(s['g_max']), value(s['g_avg']), value(s['g_stdev']), s['coverage']))
+				for (label, rrd), s in zip(self.arg_sensors, stats)
+			],
+			comment('Все датчики\\t'),
+			'GPRINT:g_min:%2.4lf %sHz\\t',
+			'GPRINT:g_max:%2.4lf %sHz\\t',
+			'GPRINT:g_avg:%2.4lf %sHz\\t',
+			'GPRINT:g_spread:наиб. разброс %2.4lf %sHz\\n',
+
+			comment_notice_errors(self.arg_error),
+
+			print_min('g_min'),
+			print_max('g_max'),
+		]
+
+	def mk_limits_cmdline(self):
+		if len(self.arg_sensors) > 1: return None
+		return self.mk_period_cmdline() + [
+			'DEF:r_min={}:freq:MIN'.format(self.arg_rrd),
+			'DEF:r_max={}:freq:MAX'.format(self.arg_rrd),
+			'XPORT:r_min:r_min',
+			'XPORT:r_max:r_max',
+		]
+
+	def calc_limits(self, step, series):
+		return self.calc_error_bounds(series)
+
+	# Для нескольких датчиков - самые широкие границы ошибочных данных из всех
+	def calc_stats_limits(self):
+		if len(self.arg_sensors) > 1:
+			bounds = [ (s['g_min'], s['g_max']) for s in self.get_sensor_stats() if s['g_min'] is not None and s['g_max'] is not None ]
+			if len(bounds) == 0: return None
+			return min(b_min for b_min, b_max in bounds), max(b_max for b_min, b_max in bounds)
+		return self.get_error_bounds()
+
 
 if __name__ == '__main__':
 	NormalGraph().run()
@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 from lib import *
 
+import atexit, tempfile
+
 DEFAULT_WIDTH = LENGTH_DAY
 DEFAULT_DEPTH = 7
+# С какой глубины --engine auto складывает периоды в Python
+FOLD_DEPTH = 32
+# Ряды временного RRD со сложенными периодами
+FOLD_SERIES = ('r_min', 'r_max', 'r_avg', 'f_avg', 't_avg', 'n_miss')
 
 class OverlapGraph(AbstractGraph):
 	def __init__(self):
 		super().__init__()
 		self.detect_min_max = True
+		self.__fold = None
 
 	def init_argparse(self):
 		super().init_argparse()
@@ -18,14 +25,24 @@ class OverlapGraph(AbstractGraph):
 			help='Число анализируемых интервалов, по умолчанию = {}'.format(DEFAULT_DEPTH))
 		group.add_argument('--end', dest='end', type=str, default='now',
 			help='Аналогичен --end из rrdtool, по умолчанию = now')
+		group.add_argument('--engine', dest='engine', choices=('auto', 'rrdtool', 'fold'), default='auto',
+			help='rrdtool - DEF и SHIFT на каждый период, fold - одна выгрузка и сложение периодов в Python, '
+				'auto - fold с глубины {}, по умолчанию = auto'.format(FOLD_DEPTH))
 
 	def init_args(self):
 		super().init_args()
 		self.arg_width = assert_t(self.raw_args.width, int)
 		self.arg_depth = assert_t(self.raw_args.depth, int)
 		self.arg_end = assert_t(self.raw_args.end, str)
+		self.arg_engine = assert_t(self.raw_args.engine, str)
+
+	def use_fold(self):
+		if self.arg_engine == 'auto': return self.arg_depth >= FOLD_DEPTH
+		return self.arg_engine == 'fold'
 
 	def mk_cmdline(self):
+		if self.use_fold(): return self.mk_fold_cmdline()
+
 		offset = self.arg_width
 		offset_humanized = humanize_time(offset)
 		counts = self.arg_depth
@@ -36,21 +53,9 @@ class OverlapGraph(AbstractGraph):
 			'--title', 'Cовмещенная частота в сети, <b>{}</b> периодов по <b>{}</b>, Hz'.format(counts, offset_humanized)
 		]
 
-		for i in range(0, counts):
-			v = dict(arg_rrd=self.arg_rrd, i=i, i1_offset = (i + 1) * offset, i_offset = i * offset)
-			cmdline += [
-				'DEF:r_i{i}_min={arg_rrd}:freq:MIN:start=now-{i1_offset}:end=now-{i_offset}'.format(**v),
-				'DEF:r_i{i}_max={arg_rrd}:freq:MAX:start=now-{i1_offset}:end=now-{i_offset}'.format(**v),
-				'DEF:r_i{i}_avg={arg_rrd}:freq:AVERAGE:start=now-{i1_offset}:end=now-{i_offset}'.format(**v),
-				'SHIFT:r_i{i}_min:{i_offset}'.format(**v),
-				'SHIFT:r_i{i}_max:{i_offset}'.format(**v),
-				'SHIFT:r_i{i}_avg:{i_offset}'.format(**v),
-			]
+		cmdline += self.mk_periods_cmdline()
 
 		cmdline += [
-			cdef('r_min', expr_f_chain('MINNAN', [ 'r_i{}_min'.format(x) for x in range(0, counts) ])),
-			cdef('r_max', expr_f_chain('MAXNAN', [ 'r_i{}_max'.format(x) for x in range(0, counts) ])),
-
 			'VDEF:g_min=r_min,{},PERCENTNAN'.format(self.arg_error),
 			'VDEF:g_max=r_max,{},PERCENTNAN'.format(100 - self.arg_error),
 
@@ -81,14 +86,7 @@ class OverlapGraph(AbstractGraph):
 			tick('e_min', '#0000FF', fraction=0.02, legend='  Возм. ошибки вниз'),
 			tick('e_max', '#FF0000', fraction=-0.02, legend='  Возм. ошибки вверх\\n'),
 			
-			comment_header('Пределы:', extra_text='(ГОСТ 32144-2013 4.2.1)'),
-			'HRULE:50#7F007F:Номинальное (50 Hz);:dashes',
-			comment('Допуст. 100% времени (±0.4 Hz) и 95% времени (±0.2 Hz):'),
-			'HRULE:49.6#0000FF:Наим.:dashes',
-			'HRULE:49.8#0000FF::dashes',
-			'HRULE:50.2#FF0000:Наиб.:dashes',
-			'HRULE:50.4#FF0000::dashes',
-			comment('(Могут скрыться)\\n'),
+			self.mk_limits_rules(),
 
 			comment_header(
 				'Измерения:',
@@ -127,6 +125,228 @@ class OverlapGraph(AbstractGraph):
 		]
 		return cmdline
 
+	def mk_limits_rules(self):
+		return [
+			comment_header('Пределы:', extra_text='(ГОСТ 32144-2013 4.2.1)'),
+			'HRULE:50#7F007F:Номинальное (50 Hz);:dashes',
+			comment('Допуст. 100% времени (±0.4 Hz) и 95% времени (±0.2 Hz):'),
+			'HRULE:49.6#0000FF:Наим.:dashes',
+			'HRULE:49.8#0000FF::dashes',
+			'HRULE:50.2#FF0000:Наиб.:dashes',
+			'HRULE:50.4#FF0000::dashes',
+			comment('(Могут скрыться)\\n'),
+		]
+
+	# Периоды, совмещенные сдвигом, и огибающие r_min, r_max по ним
+	def mk_periods_cmdline(self, cfs=(('min', 'MIN'), ('max', 'MAX'), ('avg', 'AVERAGE'))):
+		offset = self.arg_width
+		counts = self.arg_depth
+		cmdline = []
+		for i in range(0, counts):
+			v = dict(arg_rrd=self.arg_rrd, i=i, i1_offset = (i + 1) * offset, i_offset = i * offset)
+			for n, cf in cfs:
+				v['n'], v['cf'] = n, cf
+				cmdline += [
+					'DEF:r_i{i}_{n}={arg_rrd}:freq:{cf}:start=now-{i1_offset}:end=now-{i_offset}'.format(**v),
+					'SHIFT:r_i{i}_{n}:{i_offset}'.format(**v),
+				]
+		cmdline += [
+			cdef('r_min', expr_f_chain('MINNAN', [ 'r_i{}_min'.format(x) for x in range(0, counts) ])),
+			cdef('r_max', expr_f_chain('MAXNAN', [ 'r_i{}_max'.format(x) for x in range(0, counts) ])),
+		]
+		return cmdline
+
+	def mk_limits_cmdline(self):
+		if self.use_fold(): return None
+		return self.mk_periods_cmdline(cfs=(('min', 'MIN'), ('max', 'MAX'))) + [
+			'XPORT:r_min:r_min',
+			'XPORT:r_max:r_max',
+		]
+
+	def calc_limits(self, step, series):
+		g_min = vdef_percentnan(series['r_min'], self.arg_error)
+		g_max = vdef_percentnan(series['r_max'], 100 - self.arg_error)
+		return g_min, g_max
+
+	def detect_limits(self, impl_cmdline):
+		if self.use_fold():
+			fold = self.get_fold()
+			return fold['g_min'], fold['g_max']
+		return super().detect_limits(impl_cmdline)
+
+	def get_window(self):
+		if self.use_fold():
+			fold = self.get_fold()
+			return fold['end'] - self.arg_width, fold['end']
+		return super().get_window()
+
+	# Сложение периодов - целая выгрузка, а пиксель тот же: ширина периода / 960
+	def get_schedule_window(self):
+		now = int(time.time())
+		return now - self.arg_width, now
+
+	def get_fold(self):
+		if self.__fold is None:
+			with self.phase('fold'):
+				self.__fold = self.fold()
+		return self.__fold
+
+	# Одна выгрузка всей глубины и сложение периодов в массивы (глубина, фаза).
+	# Результат пишется во временный RRD, из которого рисует rrdtool.
+	def fold(self):
+		import numpy, analytics
+		width, depth = self.arg_width, self.arg_depth
+		start, step, series = self.shared(xport_full, [
+			'rrdtool', 'xport',
+			'--start', 'now-{}'.format(width * depth), '--end', 'now',
+			'--step', str(max(width // 960, 1)), '--maxrows', str(depth * 960 + 1),
+			'DEF:r_min={}:freq:MIN'.format(self.arg_rrd),
+			'DEF:r_max={}:freq:MAX'.format(self.arg_rrd),
+			'DEF:r_avg={}:freq:AVERAGE'.format(self.arg_rrd),
+			'XPORT:r_min:r_min',
+			'XPORT:r_max:r_max',
+			'XPORT:r_avg:r_avg',
+		])
+		rows = len(series['r_avg'])
+		end = start + rows * step # Время последней строки
+		phases = -(-width // step)
+
+		# Строка -> (период, фаза); период 0 - последний, он же определяет ось времени
+		offsets = end - (start + step * numpy.arange(1, rows + 1, dtype=numpy.int64))
+		periods = offsets // width
+		phase = phases - 1 - (offsets % width) // step
+		keep = periods < depth
+
+		grids = dict()
+		for name in ('r_min', 'r_max', 'r_avg'):
+			grids[name] = numpy.full((depth, phases), numpy.nan)
+			grids[name][periods[keep], phase[keep]] = numpy.asarray(series[name], dtype=numpy.float64)[keep]
+
+		def nanmean(grid):
+			counts = (~numpy.isnan(grid)).sum(axis=0)
+			sums = numpy.nansum(grid, axis=0)
+			return numpy.divide(sums, counts, out=numpy.full(sums.shape, numpy.nan), where=(counts > 0))
+
+		columns = dict(
+			r_min = numpy.fmin.reduce(grids['r_min'], axis=0),
+			r_max = numpy.fmax.reduce(grids['r_max'], axis=0),
+			r_avg = nanmean(grids['r_avg']),
+			n_miss = numpy.isnan(grids['r_avg']).sum(axis=0).astype(numpy.float64),
+		)
+
+		g_min = vdef_percentnan(columns['r_min'].tolist(), self.arg_error)
+		g_max = vdef_percentnan(columns['r_max'].tolist(), 100 - self.arg_error)
+
+		# f_i_avg = r_i_avg,g_min,g_max,LIMIT
+		f_grid = grids['r_avg'].copy()
+		if g_min is None or g_max is None: f_grid[:] = numpy.nan
+		else:
+			with numpy.errstate(invalid='ignore'):
+				f_grid[(f_grid < g_min) | (f_grid > g_max)] = numpy.nan
+		columns['f_avg'] = nanmean(f_grid)
+
+		# t_i_avg = f_i_avg,window,TRENDNAN со SHIFT на -window/2, затем AVG по периодам
+		trend_window = get_trend_window(width, self.arg_trend)
+		trend = analytics.shift(analytics.trend(f_grid, trend_window, step), trend_window // -2, step)
+		columns['t_avg'] = nanmean(trend)
+
+		path = self.write_fold_rrd(end, step, phases, columns)
+		print('Сложено периодов: {} по {} фаз, шаг {} сек'.format(depth, phases, step), file=sys.stderr)
+		return dict(rrd=path, end=end, step=step, g_min=g_min, g_max=g_max)
+
+	def write_fold_rrd(self, end, step, phases, columns):
+		directory = tempfile.mkdtemp(prefix='overlap_graph_')
+		atexit.register(shutil.rmtree, directory, True)
+		path = os.path.join(directory, 'fold.rrd')
+		first = end - (phases - 1) * step
+
+		rrd_backend().create([
+			path, '--start', str(first - step), '--step', str(step),
+		] + [
+			'DS:{}:GAUGE:{}:U:U'.format(name, 2 * step) for name in FOLD_SERIES
+		] + [
+			'RRA:AVERAGE:0.5:1:{}'.format(phases),
+		])
+
+		updates = [
+			':'.join([ str(first + j * step) ] + [
+				'U' if math.isnan(columns[name][j]) else repr(float(columns[name][j])) for name in FOLD_SERIES
+			]) for j in range(phases)
+		]
+		for i in range(0, len(updates), 1000):
+			rrd_backend().update([ path ] + updates[i:i + 1000])
+		return path
+
+	# Временный RRD свертки больше не нужен после рендера,
+	# иначе в долгоживущем процессе (graph_server.py) они копятся до выхода.
+	def produce(self):
+		try:
+			return super().produce()
+		finally:
+			if self.__fold is not None:
+				shutil.rmtree(os.path.dirname(self.__fold['rrd']), True)
+				self.__fold = None
+
+	def mk_fold_cmdline(self):
+		fold = self.get_fold()
+		offset = self.arg_width
+		offset_humanized = humanize_time(offset)
+		counts = self.arg_depth
+		trend_window = get_trend_window(offset, self.arg_trend)
+		trend_humanized = humanize_time(trend_window)
+
+		return super().mk_cmdline() + [
+			'--start', str(fold['end'] - offset), '--end', str(fold['end']),
+			'--title', 'Cовмещенная частота в сети, <b>{}</b> периодов по <b>{}</b>, Hz'.format(counts, offset_humanized),
+
+			[ 'DEF:{0}={1}:{0}:AVERAGE'.format(name, fold['rrd']) for name in FOLD_SERIES ],
+
+			'VDEF:g_min=r_min,{},PERCENTNAN'.format(self.arg_error),
+			'VDEF:g_max=r_max,{},PERCENTNAN'.format(100 - self.arg_error),
+			'VDEF:g_avg=f_avg,AVERAGE',
+
+			cdef('e_min', 'r_min,g_min,LT'),
+			cdef('e_max', 'r_max,g_max,GT'),
+			cdef('e_miss_all', 'r_avg,UN'),
+			cdef('e_miss_some', 'n_miss,0,GT'),
+			cdef('ztick', expr_0tick(offset, 'r_avg')),
+
+			'TEXTALIGN:left',
+
+			comment('Маркеры:'),
+			tick('e_miss_all', '#7F7F7F', fraction=1, legend='  Нет данных вообще'),
+			tick('ztick', '#FFFF00', fraction=1),
+			tick('e_miss_some', '#BFBFBF', fraction=-0.02),
+				tick('e_miss_some', '#BFBFBF', fraction=0.02, legend='  Нет части данных'),
+			tick('e_min', '#0000FF', fraction=0.02, legend='  Возм. ошибки вниз'),
+			tick('e_max', '#FF0000', fraction=-0.02, legend='  Возм. ошибки вверх\\n'),
+
+			self.mk_limits_rules(),
+
+			comment_header(
+				'Измерения:',
+				extra_text='(Бледные - огибающие и среднее по всем периодам, Яркие - тренд за {}, пунктир - за весь период)'.format(trend_humanized)
+			),
+
+			'LINE1:r_min#0000FF3F::skipscale',
+			'LINE1:r_max#FF00003F::skipscale',
+			'LINE1:r_avg#00FF003F::skipscale',
+
+			'LINE1:g_min#00007F:↓Общ. наим.\\t:dashes',
+			'LINE1:g_max#7F0000:↓Общ. наиб.\\t:dashes',
+			'LINE1:g_avg#000000::dashes:dash-offset=5',
+			'LINE2:t_avg#000000:↓Общ. сред.\\n',
+
+			'GPRINT:g_min:%2.4lf %sHz\\t',
+			'GPRINT:g_max:%2.4lf %sHz\\t',
+			'GPRINT:g_avg:%2.4lf %sHz\\n',
+
+			comment_notice_errors(self.arg_error),
+
+			print_min('g_min'),
+			print_max('g_max'),
+		]
+
 
 if __name__ == '__main__':
 	OverlapGraph().run()
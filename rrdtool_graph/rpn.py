@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+import re
+
+# Компиляция аргументов rrdtool graph/xport. DEF, CDEF, VDEF и SHIFT
+# разбираются в граф выражений, затем:
+#  - одинаковые DEF, CDEF и VDEF (с одинаковыми SHIFT) сливаются в один;
+#  - цепочки MIN/MAX/MINNAN/MAXNAN выпрямляются в левую цепочку без повторов,
+#    самый глубокий операнд - первым, тогда стек не растет;
+#  - переменные, на которые не ссылается ни один элемент, отбрасываются;
+#  - общие подвыражения CDEF, которые выгоднее посчитать один раз, выносятся
+#    в отдельные CDEF или заменяются уже определенной переменной.
+# Остальные аргументы остаются на своих местах. Выражения с операторами,
+# которых нет в таблицах ниже, не разбираются и сливаются только целиком.
+
+class CompileError(Exception):
+	pass
+
+ARITY = dict(
+	[ (op, 1) for op in ('UN', 'ISINF', 'SIN', 'COS', 'LOG', 'EXP', 'SQRT', 'ATAN', 'FLOOR', 'CEIL', 'ABS', 'DEG2RAD', 'RAD2DEG') ] +
+	[ (op, 2) for op in ('LT', 'LE', 'GT', 'GE', 'EQ', 'NE', '+', '-', '*', '/', '%', 'ADDNAN', 'ATAN2', 'POW',
+		'MIN', 'MAX', 'MINNAN', 'MAXNAN') ] +
+	[ (op, 3) for op in ('IF', 'LIMIT') ]
+)
+# Число операндов берется со стека: a,b,c,3,AVG
+COUNT_OPS = ('AVG', 'MEDIAN', 'SMIN', 'SMAX', 'STDEV')
+# Ассоциативны, коммутативны, идемпотентны и точны: порядок и повторы не важны
+CHAIN_OPS = ('MIN', 'MAX', 'MINNAN', 'MAXNAN')
+# Значение зависит не только от операндов, но и от времени, шага или прошлой строки
+IMPURE = ('PREV', 'COUNT', 'TIME', 'LTIME', 'NOW', 'STEPWIDTH', 'NEWDAY', 'NEWWEEK', 'NEWMONTH', 'NEWYEAR')
+CONSTANTS = ('UNKN', 'INF', 'NEGINF') + IMPURE
+
+# Отдельный CDEF - это еще массив и проход по нему, примерно как лишние токены
+CDEF_COST = 2
+
+DEFINITION_RE = re.compile(r'^(DEF|CDEF|VDEF):([\w-]+)=(.*)$')
+SHIFT_RE = re.compile(r'^SHIFT:([\w-]+):(.*)$')
+ELEMENT_RE = re.compile(r'^(LINE[0-9.]*|AREA|TICK|GPRINT|PRINT|HRULE|VRULE|XPORT|STACK|COMMENT|TEXTALIGN):([^#:]*)(.*)$')
+DRAWING = ('LINE', 'AREA', 'TICK', 'GPRINT', 'HRULE', 'VRULE', 'STACK', 'COMMENT', 'TEXTALIGN')
+PREV_RE = re.compile(r'^PREV\(([\w-]+)\)$')
+NUMBER_RE = re.compile(r'^[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?$')
+
+# Узлы выражения - кортежи: ('ref', имя), ('prev', имя), ('num', токен), ('op', оператор, операнды)
+
+def parse_rpn(tokens, names):
+	stack = list()
+	for token in tokens:
+		prev = PREV_RE.match(token)
+		if token in names:
+			stack.append(('ref', token))
+		elif prev is not None and prev.group(1) in names:
+			stack.append(('prev', prev.group(1)))
+		elif token in ARITY:
+			n = ARITY[token]
+			if len(stack) < n: raise CompileError('Не хватает операндов для {}'.format(token))
+			operands = tuple(stack[-n:])
+			del stack[-n:]
+			stack.append(('op', token, operands))
+		elif token in COUNT_OPS:
+			if len(stack) == 0 or stack[-1][0] != 'num' or not stack[-1][1].isdigit():
+				raise CompileError('{} без числа операндов'.format(token))
+			n = int(stack.pop()[1])
+			if n < 1 or len(stack) < n: raise CompileError('Не хватает операндов для {}'.format(token))
+			operands = tuple(stack[-n:])
+			del stack[-n:]
+			stack.append(('op', token, operands))
+		elif token in CONSTANTS or NUMBER_RE.match(token):
+			stack.append(('num', token))
+		else:
+			raise CompileError('Неизвестный токен {!r}'.format(token))
+	if len(stack) != 1: raise CompileError('На стеке {} значений'.format(len(stack)))
+	return stack[0]
+
+# Глубина стека при вычислении выражения
+def stack_depth(tree):
+	if tree[0] != 'op': return 1
+	operands = tree[2]
+	if tree[1] in CHAIN_OPS:
+		return max([ stack_depth(operands[0]) ] + [ 1 + stack_depth(x) for x in operands[1:] ])
+	depth = max(i + stack_depth(x) for i, x in enumerate(operands))
+	if tree[1] in COUNT_OPS: depth = max(depth, len(operands) + 1)
+	return depth
+
+def normalize(tree):
+	if tree[0] != 'op': return tree
+	op = tree[1]
+	operands = tuple(normalize(x) for x in tree[2])
+	if op not in CHAIN_OPS: return ('op', op, operands)
+	flat = list()
+	for x in operands:
+		for y in (x[2] if x[0] == 'op' and x[1] == op else (x, )):
+			if y not in flat: flat.append(y)
+	if len(flat) == 1: return flat[0]
+	flat.sort(key=lambda x: -stack_depth(x))
+	return ('op', op, tuple(flat))
+
+# Форма для сравнения: операнды цепочек в одном порядке
+def canon(tree):
+	if tree[0] != 'op': return tree
+	operands = tuple(canon(x) for x in tree[2])
+	if tree[1] in CHAIN_OPS: operands = tuple(sorted(operands, key=repr))
+	return ('op', tree[1], operands)
+
+def emit_rpn(tree, out=None):
+	if out is None: out = list()
+	kind = tree[0]
+	if kind == 'prev': out.append('PREV({})'.format(tree[1]))
+	elif kind != 'op': out.append(tree[1])
+	elif tree[1] in CHAIN_OPS:
+		emit_rpn(tree[2][0], out)
+		for x in tree[2][1:]:
+			emit_rpn(x, out)
+			out.append(tree[1])
+	else:
+		for x in tree[2]: emit_rpn(x, out)
+		if tree[1] in COUNT_OPS: out.append(str(len(tree[2])))
+		out.append(tree[1])
+	return out
+
+def rename(tree, resolve):
+	if tree[0] in ('ref', 'prev'): return (tree[0], resolve(tree[1]))
+	if tree[0] == 'op': return ('op', tree[1], tuple(rename(x, resolve) for x in tree[2]))
+	return tree
+
+def tree_refs(tree, to):
+	if tree[0] in ('ref', 'prev'): to.add(tree[1])
+	elif tree[0] == 'op':
+		for x in tree[2]: tree_refs(x, to)
+	return to
+
+# Подвыражение можно посчитать отдельным CDEF: поточечное и зависит от данных
+def is_pure(tree):
+	if tree[0] == 'prev': return False
+	if tree[0] == 'num': return tree[1] not in IMPURE
+	if tree[0] == 'ref': return True
+	return all(is_pure(x) for x in tree[2])
+
+def subtrees(tree):
+	if tree[0] == 'op':
+		for x in tree[2]:
+			yield x
+			yield from subtrees(x)
+
+def replace(tree, key, to):
+	if tree[0] != 'op': return tree
+	if canon(tree) == key: return to
+	return ('op', tree[1], tuple(replace(x, key, to) for x in tree[2]))
+
+class Var(object):
+	def __init__(self, kind, name, index, body):
+		super(Var, self).__init__()
+		self.kind = kind
+		self.name = name
+		self.index = index # Номер аргумента с определением, None у вынесенных подвыражений
+		self.body = body
+		self.tokens = body.split(',') if kind != 'DEF' else None
+		self.tree = None # Разобранное выражение CDEF
+		self.shifts = list()
+		self.used = False
+		self.alias = None # Такая же переменная, определенная раньше
+
+	def definition(self):
+		if self.tree is not None: body = ','.join(emit_rpn(self.tree))
+		elif self.tokens is not None: body = ','.join(self.tokens)
+		else: body = self.body
+		return '{}:{}={}'.format(self.kind, self.name, body)
+
+	def rpn_size(self):
+		if self.tree is not None: return len(emit_rpn(self.tree))
+		return len(self.tokens) if self.tokens is not None else 0
+
+class Program(object):
+	def __init__(self, args):
+		super(Program, self).__init__()
+		self.args = list(args)
+		self.vars = dict()
+		self.sequence = list() # Переменные в порядке определения
+		self.definitions = dict() # Номер аргумента -> Var
+		self.shifts = dict() # Номер аргумента -> (Var, смещение)
+		self.elements = dict() # Номер аргумента -> (тип, имя или значение, остаток)
+		self.stats = dict(definitions=0, merged=0, pruned=0, extracted=0, reused=0, tokens_before=0, tokens_after=0)
+		self.parse()
+
+	def use(self, names):
+		for name in names:
+			self.vars[name].used = True
+
+	def token_refs(self, tokens):
+		refs = set()
+		for token in tokens:
+			prev = PREV_RE.match(token)
+			if token in self.vars: refs.add(token)
+			elif prev is not None and prev.group(1) in self.vars: refs.add(prev.group(1))
+		return refs
+
+	def parse(self):
+		for index, arg in enumerate(self.args):
+			m = DEFINITION_RE.match(arg)
+			if m is not None:
+				kind, name, body = m.groups()
+				if name in self.vars: raise CompileError('Повторное определение {}'.format(name))
+				var = Var(kind, name, index, body)
+				if var.tokens is not None:
+					self.use(self.token_refs(var.tokens))
+					if kind == 'CDEF':
+						try: var.tree = normalize(parse_rpn(var.tokens, self.vars))
+						except CompileError: pass
+				self.vars[name] = var
+				self.sequence.append(var)
+				self.definitions[index] = var
+				self.stats['tokens_before'] += len(var.tokens) if var.tokens is not None else 0
+				continue
+			m = SHIFT_RE.match(arg)
+			if m is not None:
+				name, offset = m.groups()
+				var = self.vars.get(name)
+				if var is None: raise CompileError('SHIFT до определения {}'.format(name))
+				# SHIFT сдвигает уже посчитанные значения: нельзя сливать, если их успели использовать
+				if var.used: raise CompileError('SHIFT:{} после использования'.format(name))
+				if offset in self.vars: self.use([ offset ])
+				var.shifts.append(offset)
+				self.shifts[index] = (var, offset)
+				continue
+			m = ELEMENT_RE.match(arg)
+			if m is not None:
+				element, ref, rest = m.groups()
+				# COMMENT и TEXTALIGN ни на что не ссылаются
+				if element in ('COMMENT', 'TEXTALIGN'): ref, rest = None, arg
+				elif ref in self.vars: self.use([ ref ])
+				self.elements[index] = (element, ref, rest)
+		self.stats['definitions'] = len(self.sequence)
+
+	def resolve(self, name):
+		var = self.vars.get(name)
+		if var is None: return name
+		return var.alias.name if var.alias is not None else var.name
+
+	def resolve_token(self, token):
+		prev = PREV_RE.match(token)
+		if prev is not None and prev.group(1) in self.vars: return 'PREV({})'.format(self.resolve(prev.group(1)))
+		return self.resolve(token)
+
+	def deps(self, var):
+		refs = set(offset for offset in var.shifts if offset in self.vars)
+		if var.tree is not None: tree_refs(var.tree, refs)
+		elif var.tokens is not None: refs |= self.token_refs(var.tokens)
+		return refs
+
+	# Слияние одинаковых определений: ссылки на уже слитые переменные
+	# заменяются раньше, поэтому сливаются и целые одинаковые цепочки
+	def merge(self):
+		seen = dict()
+		for var in self.sequence:
+			shifts = tuple(self.resolve(offset) for offset in var.shifts)
+			if var.tree is not None:
+				var.tree = normalize(rename(var.tree, self.resolve))
+				key = (var.kind, canon(var.tree), shifts)
+			elif var.tokens is not None:
+				var.tokens = [ self.resolve_token(token) for token in var.tokens ]
+				key = (var.kind, tuple(var.tokens), shifts)
+			else:
+				key = (var.kind, var.body, shifts)
+			if key in seen:
+				var.alias = seen[key]
+				self.stats['merged'] += 1
+			else:
+				seen[key] = var
+
+	def reachable(self, roots):
+		live = set()
+		stack = [ self.resolve(name) for name in roots if name in self.vars ]
+		while len(stack) > 0:
+			name = stack.pop()
+			if name in live: continue
+			live.add(name)
+			stack += [ self.resolve(ref) for ref in self.deps(self.vars[name]) ]
+		return live
+
+	# CDEF только из VDEF не имеет шага, его не выносим
+	def has_series(self, tree):
+		return any(self.vars[name].kind != 'VDEF' for name in tree_refs(tree, set()))
+
+	def new_name(self):
+		n = len(self.vars)
+		while 'cse{}'.format(n) in self.vars: n += 1
+		return 'cse{}'.format(n)
+
+	# Вынос общих подвыражений. Выигрыш - сколько токенов на строку не придется
+	# вычислять: подвыражение из size токенов, встреченное count раз, заменяется
+	# одной ссылкой, но само считается один раз и стоит CDEF_COST.
+	def extract(self, live):
+		while True:
+			users = [ var for var in self.sequence if var.name in live and var.alias is None and var.tree is not None ]
+			position = { var.name: i for i, var in enumerate(self.sequence) }
+			found = dict() # Форма подвыражения -> (подвыражение, список переменных-пользователей)
+			for var in users:
+				for tree in subtrees(var.tree):
+					if tree[0] != 'op' or not is_pure(tree) or not self.has_series(tree): continue
+					key = canon(tree)
+					if key not in found: found[key] = (tree, list())
+					found[key][1].append(var)
+			named = { canon(var.tree): var for var in users if len(var.shifts) == 0 and is_pure(var.tree) and self.has_series(var.tree) }
+
+			best, best_gain = None, 0
+			for key, (tree, occurrences) in found.items():
+				size = len(emit_rpn(tree))
+				target = named.get(key)
+				if target is not None:
+					count = len([ var for var in occurrences if position[var.name] > position[target.name] ])
+					gain = count * (size - 1)
+				else:
+					gain = len(occurrences) * (size - 1) - size - CDEF_COST
+				if gain > best_gain: best, best_gain = (key, tree, occurrences, target), gain
+			if best is None: return
+
+			key, tree, occurrences, target = best
+			if target is None:
+				target = Var('CDEF', self.new_name(), None, '')
+				target.tree = tree
+				self.vars[target.name] = target
+				self.sequence.insert(min(position[var.name] for var in occurrences), target)
+				live.add(target.name)
+				self.stats['extracted'] += 1
+			else:
+				occurrences = [ var for var in occurrences if position[var.name] > position[target.name] ]
+				self.stats['reused'] += 1
+			for var in occurrences:
+				var.tree = normalize(replace(var.tree, key, ('ref', target.name)))
+
+	def compile(self, drawing=True):
+		self.merge()
+		skip = set()
+		if not drawing:
+			skip = set(index for index, (element, ref, rest) in self.elements.items()
+				if element.rstrip('0123456789.') in DRAWING)
+		roots = [ ref for index, (element, ref, rest) in self.elements.items() if index not in skip and ref is not None ]
+		live = self.reachable(roots)
+		self.extract(live)
+
+		# Вынесенные CDEF выводятся перед ближайшим следующим исходным определением
+		before = dict()
+		pending = list()
+		for var in self.sequence:
+			if var.index is None:
+				pending.append(var)
+			else:
+				before[var.index] = pending
+				pending = list()
+
+		out = list()
+		for index, arg in enumerate(self.args):
+			if index in skip: continue
+			if index in self.definitions:
+				var = self.definitions[index]
+				for new in before.get(index, ()):
+					out.append(new.definition())
+					self.stats['tokens_after'] += new.rpn_size()
+				if var.alias is None and var.name in live:
+					out.append(var.definition())
+					self.stats['tokens_after'] += var.rpn_size()
+				elif var.alias is None:
+					self.stats['pruned'] += 1
+			elif index in self.shifts:
+				var, offset = self.shifts[index]
+				if var.alias is None and var.name in live:
+					out.append('SHIFT:{}:{}'.format(var.name, self.resolve(offset)))
+			elif index in self.elements:
+				element, ref, rest = self.elements[index]
+				out.append('{}:{}{}'.format(element, self.resolve(ref), rest) if ref is not None else arg)
+			else:
+				out.append(arg)
+		return out
+
+def compile_args(args, drawing=True):
+	return Program(args).compile(drawing)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+import mmap, fcntl, struct
+
+try:
+	import numpy
+except ImportError:
+	numpy = None # Нужен только для array() и series()
+
+# Разбор бинарного RRD-файла так же, как это делает rrd_open из librrd.
+# Структуры из rrd_format.h пишутся в файл как есть, по этому их разметка
+# зависит от платформы: размеры и выравнивание берутся нативные ('@'),
+# а файл должен быть создан на той же архитектуре, на которой читается.
+
+COOKIE = b'RRD\0'
+FLOAT_COOKIE = 8.642135E130
+
+# stat_head_t: cookie[4], version[5], float_cookie, ds_cnt, rra_cnt, pdp_step, par[10]
+STAT_HEAD = struct.Struct('@4s5sdLLL10d')
+# ds_def_t: ds_nam[20], dst[20], par[10]
+DS_DEF = struct.Struct('@20s20s10d')
+# rra_def_t: cf_nam[20], row_cnt, pdp_cnt, par[10]
+RRA_DEF = struct.Struct('@20sLL10d')
+# live_head_t: last_up (time_t), last_up_usec (с версии 0003)
+LIVE_HEAD = struct.Struct('@ll')
+LIVE_HEAD_OLD = struct.Struct('@l')
+# pdp_prep_t: last_ds[30], scratch[10]
+PDP_PREP = struct.Struct('@30s10d')
+# cdp_prep_t: scratch[10]
+CDP_PREP = struct.Struct('@10d')
+# rra_ptr_t: cur_row
+RRA_PTR = struct.Struct('@L')
+VALUE = struct.Struct('@d')
+
+def _cstr(raw):
+	return raw.split(b'\0', 1)[0].decode('ascii', errors='replace')
+
+class RRA(object):
+	def __init__(self, index, cf, row_cnt, pdp_cnt, xff, step, offset, cur_row, last_row_time):
+		super(RRA, self).__init__()
+		self.index = index
+		self.cf = cf
+		self.row_cnt = row_cnt
+		self.pdp_cnt = pdp_cnt
+		self.xff = xff
+		self.step = step
+		self.offset = offset # Смещение данных в файле
+		self.cur_row = cur_row
+		self.last_row_time = last_row_time # Время строки cur_row
+
+	def __repr__(self):
+		return 'RRA({}, {}, step={}, rows={})'.format(self.index, self.cf, self.step, self.row_cnt)
+
+	@property
+	def first_row_time(self):
+		return self.last_row_time - (self.row_cnt - 1) * self.step
+
+	# Время строки row (как в rrdtool dump - конец интервала консолидации)
+	def row_time(self, row):
+		return self.last_row_time - ((self.cur_row - row) % self.row_cnt) * self.step
+
+	# Диапазон "возрастов" строк k (0 - самая свежая строка cur_row),
+	# время которых попадает в [begin, end], или None.
+	def age_range(self, begin, end):
+		k_min = max(-((end - self.last_row_time) // self.step), 0) # ceil((L - end) / step)
+		k_max = min((self.last_row_time - begin) // self.step, self.row_cnt - 1)
+		if k_min > k_max: return None
+		return k_min, k_max
+
+	# Непрерывные диапазоны строк [row_from, row_to) в файле для возрастов [k_min, k_max].
+	# Кольцевой буфер дает не более двух диапазонов.
+	def row_spans(self, k_min, k_max):
+		row_newest = self.cur_row - k_min
+		row_oldest = self.cur_row - k_max
+		if row_oldest >= 0:
+			return [ (row_oldest, row_newest + 1) ]
+		if row_newest < 0:
+			return [ (row_oldest + self.row_cnt, row_newest + self.row_cnt + 1) ]
+		return [ (row_oldest + self.row_cnt, self.row_cnt), (0, row_newest + 1) ]
+
+# Один DS одного RRA в порядке времени. Кольцевой буфер разрезается по cur_row
+# на две части, каждая - представление поверх файла без копирования.
+class RRASeries(object):
+	def __init__(self, rra, column):
+		super(RRASeries, self).__init__()
+		self.rra = rra
+		split = (rra.cur_row + 1) % rra.row_cnt
+		self.parts = [ part for part in (column[split:], column[:split]) if len(part) > 0 ]
+
+	def __len__(self):
+		return self.rra.row_cnt
+
+	def times(self):
+		return numpy.arange(self.rra.first_row_time, self.rra.last_row_time + 1, self.rra.step, dtype=numpy.int64)
+
+	# Все значения в порядке времени (копия, если буфер разрезан)
+	def values(self):
+		if len(self.parts) == 1: return self.parts[0]
+		return numpy.concatenate(self.parts)
+
+	# Время и значения строк из [start, end]. Без копирования, если диапазон
+	# не пересекает границу кольцевого буфера.
+	def fetch(self, start, end):
+		i_from = max(-((self.rra.first_row_time - start) // self.rra.step), 0)
+		i_to = min((end - self.rra.first_row_time) // self.rra.step + 1, self.rra.row_cnt)
+		i_to = max(i_to, i_from)
+		times = self.rra.first_row_time + numpy.arange(i_from, i_to, dtype=numpy.int64) * self.rra.step
+		head = len(self.parts[0])
+		if i_to <= head:
+			values = self.parts[0][i_from:i_to]
+		elif i_from >= head:
+			values = self.parts[1][i_from - head:i_to - head]
+		else:
+			values = numpy.concatenate((self.parts[0][i_from:], self.parts[1][:i_to - head]))
+		return times, values
+
+class RRDFile(object):
+	def __init__(self, path, writable=False):
+		super(RRDFile, self).__init__()
+		self.path = path
+		self.writable = writable
+		self.file = open(path, 'r+b' if writable else 'rb')
+		try:
+			self.map = mmap.mmap(self.file.fileno(), 0, access=(mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ))
+			self.parse_header()
+		except Exception:
+			self.file.close()
+			raise
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		if self.map is not None:
+			if self.writable: self.map.flush()
+			try:
+				self.map.close()
+			except BufferError:
+				pass # Еще живы массивы numpy поверх файла, отображение закроется вместе с ними
+			self.map = None
+		self.file.close()
+
+	# Блокировка, совместимая с rrd_lock. rrd_lock не ждет: rrdtool update, пока
+	# файл правится или читается, завершится ошибкой 'could not lock RRD', и
+	# повторить его должен тот, кто пишет (ingest.py повторяет пачку позже).
+	# Сама блокировка здесь ждет, пока не закончится идущий update.
+	def lock(self):
+		fcntl.lockf(self.file.fileno(), fcntl.LOCK_EX if self.writable else fcntl.LOCK_SH)
+
+	def parse_header(self):
+		offset = 0
+		cookie, version, float_cookie, ds_cnt, rra_cnt, pdp_step, *par = STAT_HEAD.unpack_from(self.map, offset)
+		if cookie != COOKIE:
+			raise Exception('{!r} не RRD-файл.'.format(self.path))
+		if float_cookie != FLOAT_COOKIE:
+			raise Exception('{!r} создан на другой архитектуре (float_cookie = {!r}).'.format(self.path, float_cookie))
+		self.version = int(_cstr(version))
+		self.ds_cnt = ds_cnt
+		self.rra_cnt = rra_cnt
+		self.pdp_step = pdp_step
+		offset += STAT_HEAD.size
+
+		self.ds = list()
+		for i in range(ds_cnt):
+			ds_nam, dst, *par = DS_DEF.unpack_from(self.map, offset)
+			# par[0] - u_cnt из union unival, а не double
+			heartbeat = struct.unpack('@L', struct.pack('@d', par[0]))[0]
+			self.ds.append(dict(name=_cstr(ds_nam), type=_cstr(dst), heartbeat=heartbeat, min=par[1], max=par[2]))
+			offset += DS_DEF.size
+
+		rra_defs = list()
+		for i in range(rra_cnt):
+			cf_nam, row_cnt, pdp_cnt, *par = RRA_DEF.unpack_from(self.map, offset)
+			rra_defs.append((_cstr(cf_nam), row_cnt, pdp_cnt, par[0]))
+			offset += RRA_DEF.size
+
+		if self.version >= 3:
+			self.last_up, self.last_up_usec = LIVE_HEAD.unpack_from(self.map, offset)
+			offset += LIVE_HEAD.size
+		else:
+			self.last_up, = LIVE_HEAD_OLD.unpack_from(self.map, offset)
+			self.last_up_usec = 0
+			offset += LIVE_HEAD_OLD.size
+
+		offset += PDP_PREP.size * ds_cnt
+		offset += CDP_PREP.size * ds_cnt * rra_cnt
+
+		cur_rows = list()
+		for i in range(rra_cnt):
+			cur_rows.append(RRA_PTR.unpack_from(self.map, offset)[0])
+			offset += RRA_PTR.size
+		self.header_size = offset
+
+		self.rra = list()
+		for i, (cf, row_cnt, pdp_cnt, xff) in enumerate(rra_defs):
+			step = pdp_cnt * pdp_step
+			self.rra.append(RRA(
+				i, cf, row_cnt, pdp_cnt, xff, step, offset, cur_rows[i],
+				self.last_up - self.last_up % step,
+			))
+			offset += row_cnt * ds_cnt * VALUE.size
+
+		if offset != len(self.map):
+			raise Exception('Размер {!r} ({}) не совпадает с заголовком ({}).'.format(self.path, len(self.map), offset))
+
+	def ds_index(self, name):
+		for i, ds in enumerate(self.ds):
+			if ds['name'] == name: return i
+		raise KeyError(name)
+
+	# RRA с функцией cf и наибольшим шагом не больше step
+	def find_rra(self, cf, step=None):
+		candidates = [ rra for rra in self.rra if rra.cf == cf and (step is None or rra.step <= step) ]
+		if len(candidates) == 0: candidates = [ rra for rra in self.rra if rra.cf == cf ]
+		if len(candidates) == 0: raise KeyError(cf)
+		if step is None: return min(candidates, key=lambda rra: rra.step)
+		return max(candidates, key=lambda rra: (rra.step, rra.row_cnt))
+
+	# Выбор RRA как в rrd_fetch: среди покрывающих [start, end] целиком - с шагом,
+	# ближайшим к запрошенному, иначе - покрывающий наибольшую часть интервала.
+	def choose_rra(self, cf, start, end, step):
+		best_full, best_part = None, None
+		for rra in self.rra:
+			if rra.cf != cf: continue
+			cal_start = rra.last_row_time - rra.row_cnt * rra.step
+			if cal_start <= start:
+				diff = abs(step - rra.step)
+				if best_full is None or diff < best_full[0]: best_full = (diff, rra)
+			else:
+				match = (end - start) - (cal_start - start)
+				if best_part is None or best_part[0] < match: best_part = (match, rra)
+		if best_full is not None: return best_full[1]
+		if best_part is not None: return best_part[1]
+		raise KeyError(cf)
+
+	# Аналог rrd_fetch: выравнивание интервала по шагу выбранного RRA,
+	# строка i относится ко времени start + (i + 1) * step, вне архива - NaN.
+	def fetch(self, cf, start, end, step, ds=0):
+		return self.fetch_rra(self.choose_rra(cf, start, end, step), start, end, ds)
+
+	def fetch_rra(self, rra, start, end, ds=0):
+		step = rra.step
+		start -= start % step
+		if end % step: end += step - end % step
+		rows = (end - start) // step
+		values = numpy.full(rows, numpy.nan)
+		times, part = self.series(rra, ds).fetch(start + step, end)
+		if len(times) > 0:
+			first = (int(times[0]) - start) // step - 1
+			values[first:first + len(part)] = part
+		return start, step, values
+
+	# Данные RRA как есть, без копирования: массив (row_cnt, ds_cnt) поверх файла
+	def array(self, rra):
+		if numpy is None: raise Exception('Для чтения массивов RRA нужен numpy.')
+		return numpy.frombuffer(
+			self.map, dtype=numpy.float64, count=rra.row_cnt * self.ds_cnt, offset=rra.offset,
+		).reshape(rra.row_cnt, self.ds_cnt)
+
+	def series(self, rra, ds=0):
+		if isinstance(ds, str): ds = self.ds_index(ds)
+		return RRASeries(rra, self.array(rra)[:, ds])
+
+	def row_offset(self, rra, row):
+		return rra.offset + row * self.ds_cnt * VALUE.size
+
+	def read_row(self, rra, row):
+		offset = self.row_offset(rra, row)
+		return struct.unpack_from('@{}d'.format(self.ds_cnt), self.map, offset)
+
+	# Заполнить строки [row_from, row_to) во всех DS значением value
+	def fill_rows(self, rra, row_from, row_to, value):
+		if not self.writable: raise Exception('{!r} открыт только для чтения.'.format(self.path))
+		start, end = self.row_offset(rra, row_from), self.row_offset(rra, row_to)
+		self.map[start:end] = VALUE.pack(value) * ((end - start) // VALUE.size)
+
+if __name__ == '__main__':
+	import argparse
+	args = argparse.ArgumentParser()
+	args.add_argument('rrd', type=str)
+	args = args.parse_args()
+
+	with RRDFile(args.rrd) as rrd:
+		print('version = {}, step = {}, last_update = {}, header = {} байт'.format(
+			rrd.version, rrd.pdp_step, rrd.last_up, rrd.header_size))
+		for ds in rrd.ds:
+			print('ds[{name}]: {type}, heartbeat = {heartbeat}, min = {min}, max = {max}'.format(**ds))
+		for rra in rrd.rra:
+			print('rra[{}]: {}, step = {}, rows = {}, cur_row = {}, {} .. {}'.format(
+				rra.index, rra.cf, rra.step, rra.row_cnt, rra.cur_row, rra.first_row_time, rra.last_row_time))
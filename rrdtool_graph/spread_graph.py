@@ -17,8 +17,7 @@ class SpreadGraph(FloatingPeriodGraph):
 			'DEF:r_min={}:freq:MIN'.format(self.arg_rrd),
 			'DEF:r_max={}:freq:MAX'.format(self.arg_rrd),
 			
-			'VDEF:g_min=r_min,{},PERCENTNAN'.format(self.arg_error),
-			'VDEF:g_max=r_max,{},PERCENTNAN'.format(100 - self.arg_error),
+			self.mk_error_bounds_cmdline(),
 			
 			cdef('f_min', expr_drop('r_min', 'g_min', 'g_max')),
 			cdef('f_max', expr_drop('r_max', 'g_min', 'g_max')),
@@ -65,6 +64,21 @@ class SpreadGraph(FloatingPeriodGraph):
 			print_max('g_diff_max'),
 		]
 
+	def mk_limits_cmdline(self):
+		return self.mk_period_cmdline() + [
+			'DEF:r_min={}:freq:MIN'.format(self.arg_rrd),
+			'DEF:r_max={}:freq:MAX'.format(self.arg_rrd),
+			'XPORT:r_min:r_min',
+			'XPORT:r_max:r_max',
+		]
+
+	def calc_limits(self, step, series):
+		g_min, g_max = self.calc_error_bounds(series)
+		f_min = rpn_limit(series['r_min'], g_min, g_max)
+		f_max = rpn_limit(series['r_max'], g_min, g_max)
+		# Выводится только g_diff_max
+		return None, vdef_maximum([ mx - mn for mn, mx in zip(f_min, f_max) ])
+
 
 if __name__ == '__main__':
 	SpreadGraph().run()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+import sys, os, math, json, time, argparse
+
+# Хранилище накопленной статистики рядом с freq.rrd (freq.rrd.stats/),
+# пополняется при приеме измерений (ingest.py --stats). На каждый час и сутки
+# (UTC) - корзина: count, sum, sumsq, min, max и гистограмма с шагом resolution.
+# Корзины складываются, поэтому процентили (как PERCENTNAN), среднее и станд.
+# отклонение за любой интервал считаются слиянием корзин с точностью до часа,
+# без сортировки исходных данных. Только стандартная библиотека: модуль
+# работает и на роутере.
+
+VERSION = 1
+DEFAULT_RESOLUTION = 0.001
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+def default_path(rrd):
+	return rrd + '.stats'
+
+class Bucket(object):
+	def __init__(self, resolution=DEFAULT_RESOLUTION):
+		super(Bucket, self).__init__()
+		self.resolution = resolution
+		self.count = 0
+		self.sum = 0.0
+		self.sumsq = 0.0
+		self.min = None
+		self.max = None
+		self.bins = dict() # Номер ячейки гистограммы -> число значений
+
+	@classmethod
+	def from_dict(cls, data, resolution):
+		bucket = cls(resolution)
+		bucket.count = data['count']
+		bucket.sum = data['sum']
+		bucket.sumsq = data['sumsq']
+		bucket.min = data['min']
+		bucket.max = data['max']
+		bucket.bins = { int(k): v for k, v in data['bins'].items() }
+		return bucket
+
+	def to_dict(self):
+		return dict(
+			count=self.count, sum=self.sum, sumsq=self.sumsq, min=self.min, max=self.max,
+			bins={ str(k): v for k, v in self.bins.items() },
+		)
+
+	def add(self, value):
+		if math.isnan(value): return
+		self.count += 1
+		self.sum += value
+		self.sumsq += value * value
+		self.min = value if self.min is None else min(self.min, value)
+		self.max = value if self.max is None else max(self.max, value)
+		k = int(round(value / self.resolution))
+		self.bins[k] = self.bins.get(k, 0) + 1
+
+	def merge(self, other):
+		if other.resolution != self.resolution:
+			raise Exception('Разный шаг гистограмм: {} и {}.'.format(self.resolution, other.resolution))
+		if other.count == 0: return self
+		self.count += other.count
+		self.sum += other.sum
+		self.sumsq += other.sumsq
+		self.min = other.min if self.min is None else min(self.min, other.min)
+		self.max = other.max if self.max is None else max(self.max, other.max)
+		for k, v in other.bins.items():
+			self.bins[k] = self.bins.get(k, 0) + v
+		return self
+
+	def mean(self):
+		return self.sum / self.count if self.count > 0 else None
+
+	# Как VDEF STDEV: по генеральной совокупности
+	def stdev(self):
+		if self.count == 0: return None
+		mean = self.sum / self.count
+		return math.sqrt(max(self.sumsq / self.count - mean * mean, 0.0))
+
+	# Как PERCENTNAN: значение с номером round(percent * (count - 1) / 100)
+	# среди отсортированных, с точностью до resolution. Крайние ячейки
+	# уточняются точными min и max.
+	def percentile(self, percent):
+		if self.count == 0: return None
+		rank = int(math.floor(percent * (self.count - 1) / 100.0 + 0.5))
+		if rank <= 0: return self.min
+		if rank >= self.count - 1: return self.max
+		seen = 0
+		for k in sorted(self.bins.keys()):
+			seen += self.bins[k]
+			if seen > rank: return min(max(k * self.resolution, self.min), self.max)
+		return self.max
+
+# Файл на сутки: корзина суток и корзины часов
+class Day(object):
+	def __init__(self, index, resolution):
+		super(Day, self).__init__()
+		self.index = index
+		self.resolution = resolution
+		self.day = Bucket(resolution)
+		self.hours = dict() # Час суток -> Bucket
+		self.dirty = False
+
+	def add(self, timestamp, value):
+		hour = (timestamp % DAY) // HOUR
+		if hour not in self.hours: self.hours[hour] = Bucket(self.resolution)
+		self.hours[hour].add(value)
+		self.day.add(value)
+		self.dirty = True
+
+class StatsStore(object):
+	def __init__(self, directory, resolution=DEFAULT_RESOLUTION):
+		super(StatsStore, self).__init__()
+		self.directory = directory
+		self.resolution = resolution
+		self.days = dict()
+
+	def day_path(self, index):
+		return os.path.join(self.directory, time.strftime('%Y%m%d.json', time.gmtime(index * DAY)))
+
+	def load_day(self, index):
+		if index in self.days: return self.days[index]
+		day = Day(index, self.resolution)
+		path = self.day_path(index)
+		if os.path.exists(path):
+			with open(path, 'r') as f:
+				data = json.load(f)
+			if data.get('version') != VERSION:
+				raise Exception('Неизвестная версия {!r}.'.format(path))
+			# Шаг гистограммы задается при создании файла
+			day.resolution = data['resolution']
+			day.day = Bucket.from_dict(data['day'], day.resolution)
+			day.hours = { int(k): Bucket.from_dict(v, day.resolution) for k, v in data['hours'].items() }
+		self.days[index] = day
+		return day
+
+	def add(self, timestamp, value):
+		self.load_day(int(timestamp) // DAY).add(int(timestamp), value)
+
+	def flush(self):
+		os.makedirs(self.directory, exist_ok=True)
+		for day in self.days.values():
+			if not day.dirty: continue
+			data = dict(
+				version=VERSION, resolution=day.resolution, day=day.day.to_dict(),
+				hours={ str(k): v.to_dict() for k, v in day.hours.items() },
+			)
+			path = self.day_path(day.index)
+			temp = path + '.tmp'
+			with open(temp, 'w') as f:
+				json.dump(data, f)
+			os.replace(temp, path)
+			day.dirty = False
+
+	# Сброшенные на диск сутки, кроме текущих, больше не нужны в памяти
+	def forget(self, keep_from):
+		for index in list(self.days.keys()):
+			if index < keep_from // DAY and not self.days[index].dirty: del self.days[index]
+
+	# Слияние корзин всех часов, пересекающихся с [start, end).
+	# Целые сутки берутся одной корзиной.
+	def query(self, start, end):
+		result = None
+		hour_from, hour_to = start // HOUR, -(-end // HOUR)
+		for index in range(hour_from // 24, (hour_to - 1) // 24 + 1):
+			if not os.path.exists(self.day_path(index)) and index not in self.days: continue
+			day = self.load_day(index)
+			if result is None: result = Bucket(day.resolution)
+			first, last = index * 24, index * 24 + 24
+			if hour_from <= first and last <= hour_to:
+				result.merge(day.day)
+			else:
+				for hour, bucket in day.hours.items():
+					if hour_from <= first + hour < hour_to: result.merge(bucket)
+		return result if result is not None else Bucket(self.resolution)
+
+# Для CallCache: результат зависит только от аргументов
+def query(directory, start, end):
+	return StatsStore(directory).query(start, end)
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	args.add_argument('directory', type=str,
+		help='Каталог статистики, обычно <rrd>.stats')
+	commands = args.add_subparsers(dest='command', required=True)
+	command = commands.add_parser('add',
+		help='Добавить измерения "время:значение" со стандартного ввода, как для rrdtool update.')
+	command.add_argument('--resolution', dest='resolution', type=float, default=DEFAULT_RESOLUTION,
+		help='Шаг гистограммы для новых файлов, по умолчанию = {}'.format(DEFAULT_RESOLUTION))
+	command = commands.add_parser('query',
+		help='Статистика за интервал [start, end) в секундах эпохи.')
+	command.add_argument('start', type=int)
+	command.add_argument('end', type=int)
+	command.add_argument('--error', dest='error', type=float, default=0.5,
+		help='Процентили error и 100 - error, по умолчанию = 0.5')
+
+	args = args.parse_args()
+
+	if args.command == 'add':
+		store = StatsStore(args.directory, args.resolution)
+		added = 0
+		for line in sys.stdin:
+			line = line.strip()
+			if len(line) == 0: continue
+			timestamp, value = line.split(':', 1)
+			store.add(int(timestamp), float(value))
+			added += 1
+		store.flush()
+		print('Добавлено значений: {}'.format(added), file=sys.stderr)
+	else:
+		bucket = query(args.directory, args.start, args.end)
+		json.dump(dict(
+			count=bucket.count, min=bucket.min, max=bucket.max, mean=bucket.mean(), stdev=bucket.stdev(),
+			low=bucket.percentile(args.error), high=bucket.percentile(100 - args.error),
+		), sys.stdout, indent='\t')
+		print()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import sys, os, re, math, time, struct, argparse
+import numpy
+from rrd_file import *
+import attime
+
+# Синтетический RRD с разметкой из make_rrd.sh и правдоподобными данными 50 Hz:
+# медленный дрейф (сумма синусоид от минут до года), шум внутри строки,
+# пропуски и выбросы. Файл пишется сразу в бинарном виде, как его оставил бы
+# rrdtool на этой архитектуре, - без миллионов rrdtool update для многих лет.
+# Значения каждого RRA считаются прямо в его разрешении, но из одних и тех же
+# функций времени, по этому архивы согласованы между собой.
+
+MAKE_RRD = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'openwrt_daemon', 'root', 'freq_report', 'make_rrd.sh')
+
+NOISE = 0.02 # Станд. отклонение измерений вокруг дрейфа, Hz
+OUTLIER_RATE = 1e-4 # Доля измерений-выбросов
+GAP_EVERY = 3 * 24 * 60 * 60 # Среднее время между пропусками
+
+# unival из rrd_format.h: счетчики (u_cnt) хранятся в тех же 8 байтах, что и double
+def _cnt(value):
+	return struct.unpack('@d', struct.pack('@L', value))[0]
+
+def read_layout(path=MAKE_RRD):
+	with open(path, 'r') as f:
+		text = f.read()
+	step = int(re.search(r"--step\s+'?([0-9]+)", text).group(1))
+	ds = [ (m.group(1), m.group(2), int(m.group(3)), m.group(4), m.group(5))
+		for m in re.finditer(r"DS:(\w+):(\w+):([0-9]+):([^:']+):([^:'\s]+)", text) ]
+	rra = [ (m.group(1), float(m.group(2)), int(m.group(3)), int(m.group(4)))
+		for m in re.finditer(r"RRA:(\w+):([0-9.]+):([0-9]+):([0-9]+)", text) ]
+	return step, ds, rra
+
+class Signal(object):
+	def __init__(self, seed, start, end):
+		super(Signal, self).__init__()
+		self.random = numpy.random.default_rng(seed)
+		# (период, амплитуда, фаза): суточный и недельный ход, годовой, быстрые колебания
+		periods = [ 365 * 86400, 7 * 86400, 86400, 6 * 3600, 3600, 900, 300 ]
+		amplitudes = [ 0.015, 0.01, 0.03, 0.015, 0.02, 0.015, 0.01 ]
+		self.waves = [ (p, a, self.random.uniform(0, 2 * math.pi)) for p, a in zip(periods, amplitudes) ]
+		# Пропуски: [начало, конец), длины от минуты до суток
+		count = max(int((end - start) / GAP_EVERY), 1)
+		begins = numpy.sort(self.random.uniform(start, end, count))
+		lengths = numpy.exp(self.random.uniform(math.log(60), math.log(86400), count))
+		ends = numpy.minimum(begins + lengths, numpy.append(begins[1:], end))
+		# Накопленная длительность пропусков к моменту времени, кусочно-линейная
+		self.gap_times = numpy.ravel(numpy.column_stack((begins, ends)))
+		self.gap_totals = numpy.ravel(numpy.column_stack((
+			numpy.concatenate(([ 0.0 ], numpy.cumsum(ends - begins)[:-1])),
+			numpy.cumsum(ends - begins),
+		)))
+		self.gaps = list(zip(begins.astype(int).tolist(), ends.astype(int).tolist()))
+
+	def drift(self, t):
+		value = numpy.full(t.shape, 50.0)
+		for period, amplitude, phase in self.waves:
+			value += amplitude * numpy.sin(2 * math.pi * t / period + phase)
+		return value
+
+	def gap_fraction(self, t, step):
+		if len(self.gap_times) == 0: return numpy.zeros(t.shape)
+		total = lambda x: numpy.interp(x, self.gap_times, self.gap_totals)
+		return (total(t) - total(t - step)) / step
+
+	# Строки RRA, заканчивающиеся в t: консолидация cf по pdp_cnt измерений шага step
+	def consolidate(self, cf, t, step, pdp_cnt, xff):
+		center = self.drift(t - step / 2.0)
+		if cf == 'AVERAGE':
+			values = center + self.random.normal(0, NOISE / math.sqrt(pdp_cnt), t.shape)
+		else:
+			# Ожидаемый экстремум pdp_cnt нормальных величин
+			spread = NOISE * math.sqrt(2 * math.log(pdp_cnt)) if pdp_cnt > 1 else 0.0
+			spread = spread + numpy.abs(self.random.normal(0, NOISE, t.shape))
+			values = center - spread if cf == 'MIN' else center + spread
+			outliers = self.random.random(t.shape) < min(OUTLIER_RATE * pdp_cnt, 1.0)
+			if cf == 'MIN': values[outliers] = self.random.uniform(40.0, 49.5, int(outliers.sum()))
+			else: values[outliers] = self.random.uniform(50.5, 70.0, int(outliers.sum()))
+		values[self.gap_fraction(t, step) > xff] = numpy.nan
+		return values
+
+# Заголовок RRD с одним DS (имя, тип, heartbeat, min, max) и архивами rra
+# (cf, xff, pdp_cnt, row_cnt), последнее обновление - end. cur_row - последняя
+# строка: после заголовка данные RRA пишутся подряд в порядке времени.
+def pack_header(pdp_step, ds, rra, end):
+	name, dst, heartbeat, ds_min, ds_max = ds
+	header = [ STAT_HEAD.pack(COOKIE, b'0003\0', FLOAT_COOKIE, 1, len(rra), pdp_step, *([ 0.0 ] * 10)) ]
+	header.append(DS_DEF.pack(name.encode('ascii'), dst.encode('ascii'), _cnt(heartbeat), ds_min, ds_max, *([ 0.0 ] * 7)))
+	for cf, xff, pdp_cnt, row_cnt in rra:
+		header.append(RRA_DEF.pack(cf.encode('ascii'), row_cnt, pdp_cnt, xff, *([ 0.0 ] * 9)))
+	header.append(LIVE_HEAD.pack(end, 0))
+	# Последнее значение неизвестно, с начала шага прошло end % step секунд
+	header.append(PDP_PREP.pack(b'U', _cnt(end % pdp_step), 0.0, *([ 0.0 ] * 8)))
+	for cf, xff, pdp_cnt, row_cnt in rra:
+		header.append(CDP_PREP.pack(math.nan, *([ 0.0 ] * 9)))
+	for cf, xff, pdp_cnt, row_cnt in rra:
+		header.append(RRA_PTR.pack(row_cnt - 1))
+	return b''.join(header)
+
+def write_rrd(path, end, span, seed=1, layout=None):
+	pdp_step, ds, rra = layout if layout is not None else read_layout()
+	if len(ds) != 1: raise Exception('Поддерживается только один DS, в разметке: {}.'.format(len(ds)))
+	start = end - span
+	signal = Signal(seed, start, end)
+	name, dst, heartbeat, ds_min, ds_max = ds[0]
+	ds_min = math.nan if ds_min == 'U' else float(ds_min)
+	ds_max = math.nan if ds_max == 'U' else float(ds_max)
+
+	temp = path + '.tmp'
+	with open(temp, 'wb') as f:
+		f.write(pack_header(pdp_step, (name, dst, heartbeat, ds_min, ds_max), rra, end))
+		rows = 0
+		for cf, xff, pdp_cnt, row_cnt in rra:
+			step = pdp_cnt * pdp_step
+			last = end - end % step
+			t = last - numpy.arange(row_cnt - 1, -1, -1, dtype=numpy.int64) * step
+			values = signal.consolidate(cf, t.astype(numpy.float64), step, pdp_cnt, xff)
+			values[t <= start] = numpy.nan
+			f.write(values.astype(numpy.float64).tobytes())
+			rows += row_cnt
+	os.replace(temp, path)
+	return dict(path=path, start=start, end=end, rows=rows, bytes=os.path.getsize(path), gaps=signal.gaps)
+
+# Длительность вида 1d, 20y, 6mon - как смещение в --start
+def parse_span(text, now=None):
+	if now is None: now = int(time.time())
+	window = attime.resolve_window('now-' + text, 'now', now)
+	if window is None: raise argparse.ArgumentTypeError('Неверная длительность: {!r}'.format(text))
+	return window[1] - window[0]
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	args.add_argument('rrd', type=str,
+		help='Путь к создаваемому RRD-файлу.')
+	args.add_argument('--span', dest='span', type=parse_span, default=parse_span('1y'),
+		help='Сколько истории заполнить, например 1d, 7d, 20y, по умолчанию = 1y')
+	args.add_argument('--end', dest='end', type=int, default=None,
+		help='Время последнего обновления, по умолчанию = сейчас')
+	args.add_argument('--seed', dest='seed', type=int, default=1,
+		help='Зерно генератора, по умолчанию = 1')
+	args = args.parse_args()
+
+	end = args.end if args.end is not None else int(time.time())
+	info = write_rrd(args.rrd, end, args.span, args.seed)
+	print('{}: {} строк, {} байт, пропусков {}'.format(info['path'], info['rows'], info['bytes'], len(info['gaps'])), file=sys.stderr)
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+import sys, os, json, math, time, tempfile, argparse
+import numpy
+from rrd_file import RRDFile
+import attime
+
+# Пирамида min/avg/max/count для просмотра многолетней истории с любым
+# масштабом. Уровень 0 - интервалы base секунд (по умолчанию шаг RRD),
+# уровень k - интервалы base * 2^k. Интервал уровня k с номером b покрывает
+# (b * size, (b + 1) * size], как строка RRD. Каталог (по умолчанию
+# <rrd>.pyramid/) содержит meta.json и level_<k>.bin - записи LEVEL подряд,
+# запись i - интервал begins[k] // size + i. Пустой интервал - NaN в min/max
+# и нулевой count, count - в шагах RRD.
+#
+# Каждый уровень собирается из строк RRA: отрезок времени берется из самого
+# подробного RRA, который его покрывает. Уровень начинается с того времени, с
+# которого в RRD есть строки не грубее его интервала: более старая история
+# лежит только в уровнях, интервал которых не меньше шага ее RRA, и не
+# размножается копиями строк в подробных уровнях. Строка, задевающая несколько
+# интервалов, входит в min/max каждого, а в сумму и число - долей по длине.
+# Повторная сборка (update) дописывает интервалы новее последнего собранного
+# на всех начатых уровнях, а то, что уже вытеснено из RRD, остается в пирамиде.
+#
+# Для окна просмотра берется уровень с интервалом не больше пикселя, а если он
+# начинается позже окна - более грубый, как RRA у rrdtool. Читается не больше
+# 2 * width + 2 записей, сколько бы лет ни накопилось. Окно можно отдать
+# графикам normal/diff/spread: оно пишется маленьким RRD с шагом уровня.
+#
+# Размер - около 2 * 28 байт на интервал уровня 0 с того времени, как в RRD
+# были строки с шагом base: сборка по RRD за 20 лет с сутками по 10 сек - 2 МБ,
+# дальше - по мере пополнения (176 МБ на год непрерывных измерений по 10 сек).
+
+VERSION = 2
+DEFAULT_LEVELS = 20
+BLOCK = 1 << 20 # Интервалов за один проход при сборке
+
+LEVEL = numpy.dtype([ ('min', '<f8'), ('max', '<f8'), ('sum', '<f8'), ('count', '<u4') ])
+
+CFS = ('MIN', 'AVERAGE', 'MAX')
+
+def default_path(rrd):
+	return rrd + '.pyramid'
+
+def empty_records(count):
+	records = numpy.zeros(count, dtype=LEVEL)
+	records['min'] = numpy.nan
+	records['max'] = numpy.nan
+	return records
+
+# Слияние записей одних и тех же интервалов
+def combine(a, b):
+	combined = numpy.zeros(len(a), dtype=LEVEL)
+	combined['min'] = numpy.fmin(a['min'], b['min'])
+	combined['max'] = numpy.fmax(a['max'], b['max'])
+	combined['sum'] = a['sum'] + b['sum']
+	combined['count'] = a['count'] + b['count']
+	return combined
+
+# Отрезки (lo, hi], задевающие окна (edges[p], edges[p + 1]]: номера [i_from, i_to).
+# Отрезки отсортированы и не пересекаются, окна идут подряд.
+def overlaps(lo, hi, edges):
+	return numpy.searchsorted(hi, edges[:-1], side='right'), numpy.searchsorted(lo, edges[1:], side='left')
+
+# ufunc (fmin, fmax) по values[i_from:i_to] для каждого окна, пустые - NaN.
+# Своя часть окна [i_from[p], i_from[p + 1]) считается reduceat, сверх нее
+# окно задевает не больше одного отрезка - тот, что лежит на его правой границе.
+def reduce_spans(values, ufunc, i_from, i_to):
+	if len(values) == 0 or len(i_from) == 0: return numpy.full(len(i_from), numpy.nan)
+	used = int(i_to[-1])
+	own_to = numpy.append(i_from[1:], used)
+	padded = numpy.append(values[:used], numpy.nan) # reduceat не принимает номер used
+	result = numpy.where(own_to > i_from, ufunc.reduceat(padded, numpy.minimum(i_from, used)), numpy.nan)
+	extra = i_to - 1
+	edge = (extra >= own_to) & (extra >= i_from)
+	result[edge] = ufunc(result[edge], values[extra[edge]])
+	return result
+
+# Доли totals отрезков (lo, hi] в окнах (edges[p], edges[p + 1]]: каждый
+# отрезок считается равномерно распределенным по своей длине.
+def spread(lo, hi, totals, edges):
+	if len(lo) == 0: return numpy.zeros(len(edges) - 1)
+	cumulative = numpy.cumsum(totals)
+	xp = numpy.column_stack((lo, hi)).ravel()
+	fp = numpy.column_stack((numpy.concatenate(([ 0.0 ], cumulative[:-1])), cumulative)).ravel()
+	return numpy.diff(numpy.interp(edges, xp, fp))
+
+# Строки cf, покрывающие (begin, until]: каждый отрезок времени - из самого
+# подробного RRA, который его покрывает. Возвращает отрезки строк (lo, hi],
+# обрезанные по интервалу, по возрастанию, и их значения.
+def pieces(rrd, cf, ds, begin, until):
+	parts = list()
+	for rra in sorted((rra for rra in rrd.rra if rra.cf == cf), key=lambda rra: rra.step):
+		covered = rra.first_row_time - rra.step # RRA покрывает (covered, last_row_time]
+		low, high = max(covered, begin), min(until, rra.last_row_time)
+		if high > low:
+			times, values = rrd.series(rra, ds).fetch(low - low % rra.step + rra.step, high + (-high % rra.step))
+			parts.append((numpy.maximum(times - rra.step, low), numpy.minimum(times, high), values))
+		until = min(until, covered)
+		if until <= begin: break
+	parts.reverse()
+	if len(parts) == 0: return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+	return tuple(numpy.concatenate([ part[x] for part in parts ]) for x in range(3))
+
+# Записи интервалов size с номерами [b_from, b_to) по отрезкам строк spans
+# (cf -> pieces()); отрезки раньше begin не учитываются.
+def accumulate(spans, pdp_step, b_from, b_to, size, begin):
+	edges = numpy.arange(b_from, b_to + 1, dtype=numpy.int64) * size
+	edges[0] = max(edges[0], begin)
+	records = empty_records(b_to - b_from)
+	for cf, field, ufunc in (('MIN', 'min', numpy.fmin), ('MAX', 'max', numpy.fmax)):
+		lo, hi, values = spans[cf]
+		records[field] = reduce_spans(values, ufunc, *overlaps(lo, hi, edges))
+	lo, hi, values = spans['AVERAGE']
+	# Только отрезки блока: накопленные суммы остаются небольшими и точными
+	i_from, i_to = numpy.searchsorted(hi, edges[0], side='right'), numpy.searchsorted(lo, edges[-1], side='left')
+	lo, hi, values = lo[i_from:i_to], hi[i_from:i_to], values[i_from:i_to]
+	known = ~numpy.isnan(values)
+	length = numpy.where(known, (hi - lo) / pdp_step, 0.0)
+	records['sum'] = spread(lo, hi, numpy.where(known, values, 0.0) * length, edges)
+	records['count'] = numpy.rint(spread(lo, hi, length, edges))
+	return records
+
+# Начало отрезка времени, где в RRD есть строки AVERAGE с шагом не больше size,
+# или None - тогда уровень заполнялся бы копиями более грубых строк.
+def era_begin(rrd, size):
+	covered = [ rra.first_row_time - rra.step for rra in rrd.rra if rra.cf == 'AVERAGE' and rra.step <= size ]
+	return min(covered) if len(covered) > 0 else None
+
+# Начало самой старой известной строки AVERAGE или None: пустое начало RRA
+# (файл создан недавно) в пирамиду не попадает.
+def first_known(rrd, ds):
+	first = None
+	for rra in rrd.rra:
+		if rra.cf != 'AVERAGE': continue
+		times, values = rrd.series(rra, ds).fetch(rra.first_row_time, rra.last_row_time)
+		known = numpy.flatnonzero(~numpy.isnan(values))
+		if len(known) == 0: continue
+		begin = int(times[known[0]]) - rra.step
+		first = begin if first is None else min(first, begin)
+	return first
+
+class Pyramid(object):
+	def __init__(self, directory):
+		super(Pyramid, self).__init__()
+		self.directory = directory
+		self.meta_path = os.path.join(directory, 'meta.json')
+		with open(self.meta_path, 'r') as f:
+			meta = json.load(f)
+		if meta.get('version') != VERSION:
+			raise Exception('Неизвестная версия {!r}.'.format(self.meta_path))
+		self.rrd = meta['rrd']
+		self.ds = meta['ds']
+		self.base = meta['base']
+		self.levels = meta['levels']
+		self.begins = meta['begins'] # Начало каждого уровня или None, если он еще не начат
+		self.tails = meta['tails'] # Неполный последний интервал уровня: [min, max, sum, count] или None
+		self.first = meta['first'] # Начало и конец собранного
+		self.last = meta['last']
+
+	@classmethod
+	def create(cls, directory, rrd, ds, base, levels=DEFAULT_LEVELS):
+		os.makedirs(directory, exist_ok=True)
+		meta = dict(
+			version=VERSION, rrd=rrd, ds=ds, base=base, levels=levels,
+			begins=[ None ] * levels, tails=[ None ] * levels, first=None, last=None,
+		)
+		with open(os.path.join(directory, 'meta.json'), 'w') as f:
+			json.dump(meta, f, indent='\t')
+		return cls(directory)
+
+	# meta.json пишется после уровней: прерванная сборка повторится с того же места
+	def save(self):
+		meta = dict(
+			version=VERSION, rrd=self.rrd, ds=self.ds, base=self.base, levels=self.levels,
+			begins=self.begins, tails=self.tails, first=self.first, last=self.last,
+		)
+		temp = self.meta_path + '.tmp'
+		with open(temp, 'w') as f:
+			json.dump(meta, f, indent='\t')
+		os.replace(temp, self.meta_path)
+
+	def level_path(self, level):
+		return os.path.join(self.directory, 'level_{:02d}.bin'.format(level))
+
+	def size(self, level):
+		return self.base << level
+
+	def records(self, level):
+		path = self.level_path(level)
+		if not os.path.exists(path) or os.path.getsize(path) < LEVEL.itemsize: return empty_records(0)
+		return numpy.memmap(path, dtype=LEVEL, mode='r')
+
+	# Записи [i_from, i_to) уровня, недостающие - пустые
+	def read(self, level, i_from, i_to):
+		records = self.records(level)[i_from:i_to]
+		if len(records) == i_to - i_from: return records
+		return numpy.concatenate((records, empty_records(i_to - i_from - len(records))))
+
+	# Записать records с места i; пропуск до него заполняется пустыми записями
+	def write(self, level, i, records):
+		path = self.level_path(level)
+		if not os.path.exists(path): open(path, 'wb').close()
+		with open(path, 'r+b') as f:
+			count = os.fstat(f.fileno()).st_size // LEVEL.itemsize
+			f.seek(count * LEVEL.itemsize)
+			for gap in range(count, i, BLOCK):
+				f.write(empty_records(min(BLOCK, i - gap)).tobytes())
+			f.seek(i * LEVEL.itemsize)
+			f.write(records.tobytes())
+
+	# Дописать интервалы новее собранных. Возвращает число новых интервалов base.
+	def update(self, rrd):
+		if self.ds not in [ ds['name'] for ds in rrd.ds ]:
+			raise Exception('В {!r} нет DS {!r}.'.format(rrd.path, self.ds))
+		if self.base % rrd.pdp_step != 0:
+			raise Exception('Интервал {} не кратен шагу {!r} ({}).'.format(self.base, rrd.path, rrd.pdp_step))
+		available = [ cf for cf in CFS if any(rra.cf == cf for rra in rrd.rra) ]
+		if 'AVERAGE' not in available: raise Exception('В {!r} нет RRA AVERAGE.'.format(rrd.path))
+		# Только целые интервалы base: последний неполный дособерется в следующий раз
+		until = max(rra.last_row_time for rra in rrd.rra if rra.cf == 'AVERAGE')
+		until -= until % self.base
+		after = self.last
+		if after is None:
+			after = first_known(rrd, self.ds)
+			if after is None: return 0
+			after -= after % self.base
+			self.first = after
+		if until <= after: return 0
+		spans = { cf: pieces(rrd, cf if cf in available else 'AVERAGE', self.ds, after, until) for cf in CFS }
+
+		for level in range(self.levels):
+			size, begin = self.size(level), after
+			if self.begins[level] is None:
+				begin = era_begin(rrd, size)
+				if begin is None: continue
+				begin = max(begin + (-begin % self.base), after)
+				if begin >= until: continue
+				self.begins[level] = begin
+			origin = self.begins[level] // size
+			b_from, b_to = begin // size, -(-until // size)
+			for block_from in range(b_from, b_to, BLOCK):
+				records = accumulate(spans, rrd.pdp_step, block_from, min(block_from + BLOCK, b_to), size, begin)
+				# Интервал, начатый прошлой сборкой, дополняется
+				if block_from == b_from and begin % size != 0 and self.tails[level] is not None:
+					tail = numpy.array([ tuple(self.tails[level]) ], dtype=LEVEL)
+					records[:1] = combine(tail, records[:1])
+				self.write(level, block_from - origin, records)
+			self.tails[level] = records[-1].tolist() if until % size != 0 else None
+
+		self.last = until
+		self.save()
+		return (until - after) // self.base
+
+	# Самый грубый уровень с интервалом не больше пикселя (или уровень 0).
+	# Уровень, начатый позже окна (и собранного), заменяется более грубым.
+	def level_for(self, start, end, width):
+		pixel = (end - start) / width
+		level = 0
+		while level + 1 < self.levels and self.size(level + 1) <= pixel: level += 1
+		start = max(start, self.first if self.first is not None else start)
+		while level + 1 < self.levels and (self.begins[level] is None or self.begins[level] > start): level += 1
+		return level
+
+	# Интервалы уровня, задевающие (start, end]: концы интервалов и записи
+	# (без копирования, поверх файла)
+	def buckets(self, level, start, end):
+		size = self.size(level)
+		if self.begins[level] is None: return numpy.zeros(0, dtype=numpy.int64), empty_records(0)
+		origin = self.begins[level] // size
+		records = self.records(level)
+		b_from = max(math.floor(start / size), origin)
+		b_to = min(math.ceil(end / size), origin + len(records))
+		if b_to <= b_from: return numpy.zeros(0, dtype=numpy.int64), empty_records(0)
+		times = (numpy.arange(b_from, b_to, dtype=numpy.int64) + 1) * size
+		return times, records[b_from - origin:b_to - origin]
+
+	# Окно (start, end] по width пикселям: концы пикселей, min, avg, max, count.
+	# Интервал, задевающий несколько пикселей, входит в min/max каждого, а в
+	# сумму и число - долей по длине, поэтому число в пикселях не скачет между
+	# одним и двумя интервалами.
+	def query(self, start, end, width=960):
+		level = self.level_for(start, end, width)
+		size = self.size(level)
+		times, records = self.buckets(level, start, end)
+		pixel = (end - start) / width
+		edges = start + numpy.arange(width + 1) * pixel
+		result = dict(
+			level=level, size=size, pixel=pixel, times=edges[1:],
+			min=numpy.full(width, numpy.nan), avg=numpy.full(width, numpy.nan), max=numpy.full(width, numpy.nan),
+			count=numpy.zeros(width),
+		)
+		if len(times) == 0: return result
+		i_from, i_to = overlaps(times - size, times, edges)
+		result['min'] = reduce_spans(records['min'], numpy.fmin, i_from, i_to)
+		result['max'] = reduce_spans(records['max'], numpy.fmax, i_from, i_to)
+		total = spread(times - size, times, records['sum'], edges)
+		count = spread(times - size, times, records['count'].astype(numpy.float64), edges)
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			result['avg'] = numpy.where(count > 0, total / count, numpy.nan)
+		result['count'] = count
+		return result
+
+	# Окно как RRD с шагом уровня и архивами MIN/AVERAGE/MAX по строке на
+	# интервал: его рисуют обычные графики с --start и --end окна.
+	def write_view(self, path, start, end, width=960):
+		from synth_rrd import pack_header
+		level = self.level_for(start, end, width)
+		size = self.size(level)
+		times, records = self.buckets(level, start, end)
+		if len(times) == 0: raise Exception('В пирамиде нет данных за {} .. {}.'.format(start, end))
+		count = records['count']
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			average = numpy.where(count > 0, records['sum'] / count, numpy.nan)
+		rra = [ (cf, 0.5, 1, len(times)) for cf in CFS ]
+		with open(path, 'wb') as f:
+			f.write(pack_header(size, (self.ds, 'GAUGE', 2 * size, math.nan, math.nan), rra, int(times[-1])))
+			for values in (records['min'], average, records['max']):
+				f.write(numpy.ascontiguousarray(values, dtype=numpy.float64).tobytes())
+		return level, size, len(times)
+
+def update(rrd_path, directory, ds=None, base=None, levels=DEFAULT_LEVELS):
+	with RRDFile(rrd_path) as rrd:
+		# rrdtool update не правит файл, пока он читается
+		rrd.lock()
+		if os.path.exists(os.path.join(directory, 'meta.json')):
+			pyramid = Pyramid(directory)
+		else:
+			pyramid = Pyramid.create(directory, os.path.abspath(rrd_path), ds if ds is not None else rrd.ds[0]['name'],
+				base if base is not None else rrd.pdp_step, levels)
+		return pyramid, pyramid.update(rrd)
+
+def mk_window(pyramid, arg_start, arg_end):
+	# now - конец собранного: пирамида может быть старой
+	window = attime.resolve_window(arg_start, arg_end if arg_end is not None else 'now', pyramid.last)
+	if window is None: raise Exception('Неверный интервал: {!r} .. {!r}.'.format(arg_start, arg_end))
+	return window
+
+if __name__ == '__main__':
+	args = argparse.ArgumentParser()
+	commands = args.add_subparsers(dest='command', required=True)
+	command = commands.add_parser('update',
+		help='Собрать пирамиду или дописать в нее новые строки RRD.')
+	command.add_argument('rrd', type=str)
+	command.add_argument('directory', type=str, nargs='?', default=None,
+		help='Каталог пирамиды, по умолчанию = <rrd>.pyramid')
+	command.add_argument('--ds', dest='ds', type=str, default=None,
+		help='DS для новой пирамиды, по умолчанию - первый')
+	command.add_argument('--base', dest='base', type=int, default=None,
+		help='Интервал уровня 0 новой пирамиды в секундах, кратный шагу RRD, по умолчанию = шаг RRD')
+	command.add_argument('--levels', dest='levels', type=int, default=DEFAULT_LEVELS,
+		help='Число уровней новой пирамиды, по умолчанию = {}'.format(DEFAULT_LEVELS))
+	command = commands.add_parser('info',
+		help='Уровни пирамиды и их размеры.')
+	command.add_argument('directory', type=str)
+	command = commands.add_parser('query',
+		help='Окно по пикселям: строки "время:min:avg:max:count".')
+	command.add_argument('directory', type=str)
+	command.add_argument('--start', dest='start', type=str, default='end-1d',
+		help='Начало в формате AT-style, по умолчанию = end-1d')
+	command.add_argument('--end', dest='end', type=str, default=None,
+		help='Конец в формате AT-style, по умолчанию - конец собранного')
+	command.add_argument('--width', dest='width', type=int, default=960,
+		help='Число пикселей, по умолчанию = 960')
+	command = commands.add_parser('graph',
+		help='Нарисовать окно графиком normal, diff или spread. Остальные опции передаются графику.')
+	command.add_argument('directory', type=str)
+	command.add_argument('graph', type=str, choices=('normal', 'diff', 'spread'))
+	command.add_argument('image', type=str)
+	command.add_argument('--start', dest='start', type=str, default='end-1d',
+		help='Начало в формате AT-style, по умолчанию = end-1d')
+	command.add_argument('--end', dest='end', type=str, default=None,
+		help='Конец в формате AT-style, по умолчанию - конец собранного')
+
+	parser = args
+	args, options = parser.parse_known_args()
+	if args.command != 'graph' and len(options) > 0:
+		parser.error('неизвестные опции: {}'.format(' '.join(options)))
+
+	if args.command == 'update':
+		directory = args.directory if args.directory is not None else default_path(args.rrd)
+		started = time.time()
+		pyramid, added = update(args.rrd, directory, args.ds, args.base, args.levels)
+		print('{}: {} новых интервалов по {} сек за {:.2f} сек'.format(directory, added, pyramid.base, time.time() - started), file=sys.stderr)
+	elif args.command == 'info':
+		pyramid = Pyramid(args.directory)
+		print('{}: {}, ds = {}, собрано {} .. {}'.format(pyramid.directory, pyramid.rrd, pyramid.ds, pyramid.first, pyramid.last))
+		for level in range(pyramid.levels):
+			records = pyramid.records(level)
+			print('{:2d}: интервал {} сек, с {}, {} записей, {} байт'.format(
+				level, pyramid.size(level), pyramid.begins[level], len(records), records.nbytes))
+	elif args.command == 'query':
+		pyramid = Pyramid(args.directory)
+		start, end = mk_window(pyramid, args.start, args.end)
+		started = time.time()
+		result = pyramid.query(start, end, args.width)
+		fmt = lambda value: 'U' if math.isnan(value) else repr(value)
+		for t, low, avg, high, count in zip(*(result[key].tolist() for key in ('times', 'min', 'avg', 'max', 'count'))):
+			print('{}:{}:{}:{}:{:g}'.format(int(round(t)), fmt(low), fmt(avg), fmt(high), count))
+		print('Уровень {} ({} сек), {:.2f} сек на пиксель, {:.4f} сек'.format(
+			result['level'], result['size'], result['pixel'], time.time() - started), file=sys.stderr)
+	else:
+		from batch_graph import mk_graph
+		pyramid = Pyramid(args.directory)
+		start, end = mk_window(pyramid, args.start, args.end)
+		with tempfile.TemporaryDirectory() as temp:
+			view = os.path.join(temp, os.path.basename(pyramid.rrd))
+			level, size, rows = pyramid.write_view(view, start, end)
+			print('Окно: уровень {} ({} сек), {} строк'.format(level, size, rows), file=sys.stderr)
+			graph = mk_graph((args.graph, args.image, [ '--start', str(start), '--end', str(end) ] + options), view)
+			status = graph.produce()
+		sys.exit(status.returncode)